@@ -1,11 +1,80 @@
 # import nonebot
 import os
+from nonebot import get_driver
 from pathlib import Path
 from loguru import logger
 from .config import plugin_config
+from .anti_cpdaily.school import tenant_cache
+from .anti_cpdaily.session import session_store
+from .anti_cpdaily.transport import shared_transport
+from .anti_cpdaily.ratelimit import rate_limiter
+from .anti_cpdaily.policy import request_policy
+from .anti_cpdaily.tracing import tracer
+from .anti_cpdaily.journal import run_journal
+from .anti_cpdaily.captcha_service import captcha_service
+from .anti_cpdaily.task.schema_cache import schema_cache
+from .anti_cpdaily.persist import flush_all
+from .notify import dispatcher
 
 profile_path = Path(plugin_config.anti_cpdaily_profile_path)
 logger.debug('anti_cpdaily profile path: "{}"'.format(profile_path))
+cache_path = Path(plugin_config.anti_cpdaily_cache_path)
+logger.debug('anti_cpdaily cache path: "{}"'.format(cache_path))
+
+# keep the school list across restarts
+tenant_cache.ttl = plugin_config.anti_cpdaily_tenant_cache_ttl
+tenant_cache.persist_to(cache_path / 'tenants.json')
+# reuse authenticated sessions instead of logging in every run
+session_store.persist_to(cache_path / 'sessions')
+# remember what was done, a restarted run skips it
+if plugin_config.anti_cpdaily_journal:
+    run_journal.persist_to(cache_path / 'journal.sqlite3')
+# daily forms keep their fields, don't download them every run
+schema_cache.ttl = plugin_config.anti_cpdaily_form_cache_ttl
+schema_cache.persist_to(cache_path / 'forms.json')
+shared_transport.configure(
+    max_connections=plugin_config.anti_cpdaily_max_connections,
+    max_keepalive_connections=plugin_config.anti_cpdaily_max_keepalive_connections,
+    keepalive_expiry=plugin_config.anti_cpdaily_keepalive_expiry,
+    max_per_host=plugin_config.anti_cpdaily_max_connections_per_host,
+    http2=plugin_config.anti_cpdaily_http2
+)
+rate_limiter.configure(
+    rate=plugin_config.anti_cpdaily_rate_limit,
+    burst=plugin_config.anti_cpdaily_rate_burst,
+    host_rates=plugin_config.anti_cpdaily_host_rate_limits
+)
+request_policy.configure(
+    connect_timeout=plugin_config.anti_cpdaily_connect_timeout,
+    read_timeout=plugin_config.anti_cpdaily_read_timeout,
+    retries=plugin_config.anti_cpdaily_retries,
+    backoff=plugin_config.anti_cpdaily_retry_backoff,
+    breaker_threshold=plugin_config.anti_cpdaily_breaker_threshold,
+    breaker_cooldown=plugin_config.anti_cpdaily_breaker_cooldown
+)
+tracer.configure(
+    enabled=plugin_config.anti_cpdaily_trace_on_failure,
+    limit=plugin_config.anti_cpdaily_log_dump_limit
+)
+dispatcher.configure(
+    window=plugin_config.anti_cpdaily_notify_window,
+    rate=plugin_config.anti_cpdaily_notify_rate
+)
+captcha_service.configure(
+    max_workers=plugin_config.anti_cpdaily_captcha_workers,
+    timeout=plugin_config.anti_cpdaily_captcha_timeout,
+    min_confidence=plugin_config.anti_cpdaily_captcha_min_confidence
+)
+
+
+@get_driver().on_shutdown
+async def _release_resources():
+    await dispatcher.shutdown()
+    captcha_service.shutdown(wait=False)
+    await shared_transport.shutdown()
+    flush_all()
+    run_journal.close()
+
 
 logger.info('checking whether profile path exists')
 if not profile_path.exists():
@@ -16,7 +85,9 @@ else:
         anti_cpdaily_check_routine,
         anti_cpdaily_launch
     )
-    from .command import handle_command
+    from .command import handle_command, handle_metrics_command
+    if plugin_config.anti_cpdaily_schedule_mode == 'adaptive':
+        from .adaptive import anti_cpdaily_adaptive_seed
     
 
 # Export something for other plugin
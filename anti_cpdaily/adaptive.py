@@ -0,0 +1,235 @@
+from typing import Optional, Dict, Set, Tuple
+from datetime import datetime, timedelta, time as dt_time
+import asyncio
+import hashlib
+import random
+from loguru import logger
+
+from .anti_cpdaily.runner import WorkerPool, UserResult
+from .config import plugin_config
+from .anti_cpdaily.journal import run_journal, USER_IDLE
+from .schedule import (
+    scheduler,
+    profile_registry,
+    exception_notification,
+    on_profiles_changed,
+    _notify_user,
+    _report_failures,
+    _export_metrics
+)
+
+
+_intervals: Dict[str, float] = dict()  # username -> current polling interval(seconds)
+_finished: Set[str] = set()  # users done for today
+_last_status: Dict[str, Tuple] = dict()  # username -> forms status and error last notified
+_pool: Optional[WorkerPool] = None  # created lazily, bound to the running loop
+_metrics_task: Optional[asyncio.Task] = None  # pending metrics export
+METRICS_DELAY = 60.0  # seconds, checks finished meanwhile are exported at once
+
+
+def _run_id(now: datetime) -> str:
+    """one journaled run per day"""
+    return now.strftime('adaptive-%Y-%m-%d')
+
+
+def _done(username: str, run_id: str):
+    _intervals.pop(username, None)
+    _finished.add(username)
+    if len(_intervals) == 0:
+        run_journal.finish_run(run_id)
+
+
+async def _export_metrics_soon():
+    await asyncio.sleep(METRICS_DELAY)
+    _export_metrics()
+
+
+def _export_metrics_later():
+    """export the metrics after the checks of the next minute, not after each one"""
+    global _metrics_task
+    if _metrics_task is None or _metrics_task.done():
+        _metrics_task = asyncio.get_running_loop().create_task(_export_metrics_soon())
+
+
+def _job_id(username: str) -> str:
+    return 'anti_cpdaily_user_' + hashlib.md5(username.encode('utf-8')).hexdigest()[:16]
+
+
+def _parse_clock(text: str) -> dt_time:
+    hour, minute = text.split(':')
+    return dt_time(int(hour), int(minute))
+
+
+def _window(now: datetime) -> Tuple[datetime, datetime]:
+    """today's polling window"""
+    start = datetime.combine(now.date(), _parse_clock(plugin_config.anti_cpdaily_adaptive_start))
+    end = datetime.combine(now.date(), _parse_clock(plugin_config.anti_cpdaily_adaptive_end))
+    return start, end
+
+
+def _spread_offset(username: str) -> float:
+    """stable offset of the first check, so users of a run don't start at once"""
+    spread = max(1, plugin_config.anti_cpdaily_adaptive_spread)
+    return int(hashlib.md5(username.encode('utf-8')).hexdigest(), 16) % spread
+
+
+def _handled_today(result: UserResult, now: datetime) -> bool:
+    """a form published today is handled, earlier or by this check
+
+    Forms lasting several days are listed before today's one is published, they
+    don't end the day.
+    """
+    today = datetime.combine(now.date(), dt_time.min)
+    forms = list(result.handled_forms)
+    if result.finished:  # every open form was just submitted
+        forms.extend(result.open_forms)
+    return any(start_time is not None and start_time >= today for start_time, _ in forms)
+
+
+def next_check(result: UserResult, interval: float, now: datetime) -> Optional[Tuple[datetime, float]]:
+    """decide when a user should be checked again
+
+    Args:
+        result (UserResult): outcome of the last check
+        interval (float): current polling interval in seconds
+        now (datetime): current time
+
+    Returns:
+        Optional[Tuple[datetime, float]]: next run time and the new interval, None if done for today
+    """
+    min_interval = plugin_config.anti_cpdaily_adaptive_min_interval
+    max_interval = max(min_interval, plugin_config.anti_cpdaily_adaptive_max_interval)
+    if result.skipped:  # done earlier today
+        return None
+    if not result.ok:  # retry, less and less often
+        interval = min(max(interval, min_interval) * 2, max_interval)
+    elif _handled_today(result, now):
+        return None
+    elif len(result.open_forms) > 0 and not result.finished:
+        # forms which can't be filled or are rejected won't change soon
+        interval = max_interval
+    else:  # today's form not published yet, back off
+        interval = min(max(interval, min_interval) * 2, max_interval)
+    run_date = now + timedelta(seconds=interval)
+
+    # check right after a known form opens, and before it closes
+    for start_time, end_time in (result.open_forms if not result.finished else list()):
+        if start_time is not None and start_time > now:
+            run_date = min(run_date, start_time + timedelta(seconds=60))
+        elif end_time is not None and end_time - timedelta(seconds=min_interval) > now:
+            run_date = min(run_date, end_time - timedelta(seconds=min_interval))
+
+    run_date += timedelta(seconds=random.uniform(0, interval * 0.1))
+    if run_date > _window(now)[1]:
+        return None
+    return run_date, interval
+
+
+def _schedule_user(username: str, run_date: datetime):
+    scheduler.add_job(
+        anti_cpdaily_user_check,
+        'date',
+        run_date=run_date,
+        args=[username],
+        id=_job_id(username),
+        replace_existing=True
+    )
+
+
+@exception_notification
+async def anti_cpdaily_user_check(username: str):
+    """check one user, then reschedule it"""
+    global _pool
+    if _pool is None:
+        _pool = WorkerPool(
+            concurrency=plugin_config.anti_cpdaily_concurrency,
+            school_concurrency=plugin_config.anti_cpdaily_school_concurrency,
+            form_concurrency=plugin_config.anti_cpdaily_form_concurrency,
+            page_size=plugin_config.anti_cpdaily_page_size,
+            start_jitter=plugin_config.anti_cpdaily_start_jitter,
+            journal=run_journal
+        )
+    run_id = _run_id(datetime.now())
+    current_user = next((user for user in profile_registry.users if user.username == username), None)
+    if current_user is None:  # profile removed meanwhile
+        logger.info('user {} is gone, stop checking it'.format(username))
+        _done(username, run_id)
+        return
+
+    result = await _pool.run(current_user, run_id=run_id)
+    _export_metrics_later()
+    # the same outcome is not sent again at every check
+    status = (tuple(result.forms_status), result.error)
+    if _last_status.get(username) != status:
+        _last_status[username] = status
+        await _notify_user(result)
+        if not result.ok:
+            await _report_failures([result])
+
+    decision = next_check(result, _intervals.get(username, 0.0), datetime.now())
+    if decision is None:
+        logger.info('user {} done for today'.format(username))
+        _done(username, run_id)
+        return
+    if result.finished and len(result.forms_status) > 0:
+        # journaled as done, but not today's form: a restart must check it again
+        run_journal.record(run_id, username, USER_IDLE)
+    run_date, _intervals[username] = decision
+    logger.debug('next check of user {} at {}'.format(username, run_date))
+    _schedule_user(username, run_date)
+
+
+@exception_notification
+async def anti_cpdaily_adaptive_seed():
+    """schedule the first check of every user for today"""
+    await profile_registry.refresh_async()
+    now = datetime.now()
+    start, end = _window(now)
+    base = max(now, start)
+    if base >= end:
+        logger.info('outside of the polling window, nothing scheduled')
+        return
+    run_journal.begin_run(_run_id(now))
+    _intervals.clear()
+    _finished.clear()
+    _last_status.clear()
+    users = profile_registry.users
+    for user in users:
+        _intervals[user.username] = plugin_config.anti_cpdaily_adaptive_min_interval
+        _schedule_user(user.username, base + timedelta(seconds=_spread_offset(user.username)))
+    logger.info('scheduled {} user(s) from {}'.format(len(users), base))
+
+
+@on_profiles_changed
+async def anti_cpdaily_adaptive_new_users():
+    """schedule users added after today's seed"""
+    now = datetime.now()
+    start, end = _window(now)
+    if now < start or now >= end:  # the next seed takes them
+        return
+    users = [user for user in profile_registry.users if user.username not in _intervals and user.username not in _finished]
+    for user in users:
+        _intervals[user.username] = plugin_config.anti_cpdaily_adaptive_min_interval
+        run_date = min(now + timedelta(seconds=_spread_offset(user.username)), end)
+        _schedule_user(user.username, run_date)
+    if len(users) > 0:
+        logger.info('scheduled {} new user(s)'.format(len(users)))
+
+
+_window_start = _parse_clock(plugin_config.anti_cpdaily_adaptive_start)
+scheduler.add_job(
+    anti_cpdaily_adaptive_seed,
+    'cron',
+    hour=_window_start.hour,
+    minute=_window_start.minute,
+    id='anti_cpdaily_adaptive_seed',
+    replace_existing=True
+)
+# also cover the rest of today when started inside the window
+scheduler.add_job(
+    anti_cpdaily_adaptive_seed,
+    'date',
+    run_date=datetime.now() + timedelta(seconds=30),
+    id='anti_cpdaily_adaptive_seed_startup',
+    replace_existing=True
+)
@@ -0,0 +1 @@
+"""offline benchmarks, run them as modules, e.g. `python -m anti_cpdaily.benchmark.captcha`"""
@@ -0,0 +1,89 @@
+"""benchmark of the slider captcha offset search
+
+Run from the plugin folder: `python -m anti_cpdaily.benchmark.captcha`
+"""
+from typing import Tuple
+import argparse
+import base64
+import timeit
+from io import BytesIO
+import numpy as np
+from PIL import Image
+
+from ..slider_captcha import _score_offsets
+
+
+# image sizes given by the CAS server
+BIG_SIZE = (590, 360)
+SMALL_SIZE = (93, 360)
+
+
+def make_images(offset: int, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """create a noisy big image and a small one sharing a white square outline
+
+    Args:
+        offset (int): column where the piece fits in the big image
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: big and small RGB arrays
+    """
+    rng = np.random.default_rng(seed)
+    big = rng.integers(0, 230, size=(BIG_SIZE[1], BIG_SIZE[0], 3), dtype=np.uint8)
+    small = rng.integers(0, 230, size=(SMALL_SIZE[1], SMALL_SIZE[0], 3), dtype=np.uint8)
+    top, left, size = 120, 10, 70
+    for image, x in ((small, left), (big, left + offset)):
+        image[top, x:x + size] = 255
+        image[top + size, x:x + size] = 255
+        image[top:top + size, x] = 255
+        image[top:top + size, x + size] = 255
+    return big, small
+
+
+def to_captcha_data(big: np.ndarray, small: np.ndarray) -> dict:
+    """encode arrays the way the server sends them"""
+    data = dict()
+    for key, array in (('bigImage', big), ('smallImage', small)):
+        buffer = BytesIO()
+        Image.fromarray(array).save(buffer, format='PNG')
+        data[key] = base64.b64encode(buffer.getvalue()).decode('utf-8')
+    return data
+
+
+def score_offsets_loop(ar_big: np.ndarray, ar_small: np.ndarray) -> np.ndarray:
+    """the previous implementation, one fancy indexing per offset"""
+    boundary = np.where(ar_small == [255,255,255])
+    mul_result = np.zeros((ar_big.shape[1] - ar_small.shape[1]))
+    selection = [ar for ar in boundary]
+    for offset in range(mul_result.shape[0]):
+        mul_result[offset] = np.sum(255 - ar_big[tuple(selection)])
+        selection[1] += 1
+    return mul_result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='slider captcha offset search benchmark')
+    parser.add_argument('-n', '--number', type=int, default=50, help='runs per measurement')
+    parser.add_argument('-s', '--samples', type=int, default=5, help='captchas to check')
+    args = parser.parse_args()
+
+    for seed in range(args.samples):
+        offset = 40 + seed * 80
+        big, small = make_images(offset, seed)
+        expected = score_offsets_loop(big, small)
+        actual = _score_offsets(big, small)
+        assert np.array_equal(expected, actual), 'results differ'
+        assert np.argmin(actual) == offset, 'wrong offset'
+    print('results identical on {} sample(s)'.format(args.samples))
+
+    big, small = make_images(200)
+    loop_time = min(timeit.repeat(lambda: score_offsets_loop(big, small), number=args.number, repeat=3)) / args.number
+    vector_time = min(timeit.repeat(lambda: _score_offsets(big, small), number=args.number, repeat=3)) / args.number
+    print('image size: big{}, small{}'.format(big.shape, small.shape))
+    print('loop:       {:8.3f} ms'.format(loop_time * 1000))
+    print('vectorized: {:8.3f} ms'.format(vector_time * 1000))
+    print('speedup:    {:8.1f}x'.format(loop_time / vector_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""solve rate and latency of every registered captcha solver on a local corpus
+
+Run from the plugin folder: `python -m anti_cpdaily.benchmark.captcha_corpus path/to/corpus`
+
+A corpus is a folder of json files, one captcha per file:
+
+    {"type": "slider", "data": {"bigImage": "...", "smallImage": "..."}, "answer": 71}
+    {"type": "text", "data": {"image": "..."}, "answer": "ab3d"}
+
+For sliders, `answer` is the expected `moveLength`, for texts the expected text.
+Use `--generate N` to write N synthetic slider captchas into the folder first.
+"""
+from typing import Dict, List
+from pathlib import Path
+import argparse
+import json
+import statistics
+import time
+
+from ..captcha_solver import CAPTCHA_SLIDER, get_solver, list_solvers
+from .captcha import make_images, to_captcha_data, BIG_SIZE, SMALL_SIZE
+
+
+def generate_corpus(path: Path, count: int):
+    """write synthetic slider captchas"""
+    path.mkdir(parents=True, exist_ok=True)
+    max_offset = BIG_SIZE[0] - SMALL_SIZE[0] - 1
+    for idx in range(count):
+        offset = (idx * 37) % max_offset
+        big, small = make_images(offset, seed=idx)
+        sample = {
+            'type': CAPTCHA_SLIDER,
+            'data': to_captcha_data(big, small),
+            'answer': int(offset / BIG_SIZE[0] * 280)
+        }
+        with open(path / 'synthetic_{:04d}.json'.format(idx), 'w', encoding='utf-8') as f:
+            json.dump(sample, f)
+
+
+def load_corpus(path: Path) -> Dict[str, List[Dict]]:
+    """load samples grouped by captcha type"""
+    corpus = dict()
+    for sample_file in sorted(path.glob('*.json')):
+        with open(sample_file, encoding='utf-8') as f:
+            sample = json.load(f)
+        corpus.setdefault(sample.get('type'), list()).append(sample)
+    return corpus
+
+
+def is_solved(captcha_type: str, params: Dict, answer, tolerance: int) -> bool:
+    if captcha_type == CAPTCHA_SLIDER:
+        return abs(params.get('moveLength', -1) - answer) <= tolerance
+    return str(params.get('captchaResponse', '')).lower() == str(answer).lower()
+
+
+def run(corpus: Dict[str, List[Dict]], tolerance: int) -> List[Dict]:
+    """run every solver on the samples of its type"""
+    reports = list()
+    for captcha_type, names in list_solvers().items():
+        samples = corpus.get(captcha_type, [])
+        if len(samples) == 0:
+            continue
+        for name in names:
+            solver = get_solver(captcha_type, name)
+            latencies = list()
+            confidences = list()
+            solved = 0
+            for sample in samples:
+                start = time.perf_counter()
+                solution = solver(sample['data'])
+                latencies.append(time.perf_counter() - start)
+                confidences.append(solution.confidence)
+                solved += is_solved(captcha_type, solution.params, sample['answer'], tolerance)
+            latencies.sort()
+            reports.append({
+                'type': captcha_type,
+                'solver': name,
+                'samples': len(samples),
+                'solve_rate': solved / len(samples),
+                'latency_p50_ms': latencies[len(latencies) // 2] * 1000,
+                'latency_p95_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000,
+                'mean_confidence': statistics.mean(confidences),
+            })
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(description='captcha solver benchmark')
+    parser.add_argument('corpus', type=Path, help='folder of captcha samples')
+    parser.add_argument('--generate', type=int, default=0, help='write N synthetic slider captchas first')
+    parser.add_argument('--tolerance', type=int, default=3, help='slider distance still accepted')
+    args = parser.parse_args()
+
+    if args.generate > 0:
+        generate_corpus(args.corpus, args.generate)
+    corpus = load_corpus(args.corpus)
+    print('corpus: {}'.format({captcha_type: len(samples) for captcha_type, samples in corpus.items()}))
+    print('{:<8} {:<12} {:>7} {:>10} {:>9} {:>9} {:>10}'.format(
+        'type', 'solver', 'samples', 'solve_rate', 'p50(ms)', 'p95(ms)', 'confidence'))
+    for report in run(corpus, args.tolerance):
+        print('{type:<8} {solver:<12} {samples:>7} {solve_rate:>10.1%} {latency_p50_ms:>9.2f} {latency_p95_ms:>9.2f} {mean_confidence:>10.3f}'.format(**report))
+
+
+if __name__ == '__main__':
+    main()
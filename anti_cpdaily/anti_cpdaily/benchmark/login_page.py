@@ -0,0 +1,73 @@
+"""benchmark of the login page parser against the BeautifulSoup one
+
+Run from the plugin folder: `python -m anti_cpdaily.benchmark.login_page [saved pages...]`
+
+Without saved pages, synthetic ones are used.
+"""
+from typing import Optional, Dict, Tuple
+from pathlib import Path
+import argparse
+import re
+import timeit
+from bs4 import BeautifulSoup
+
+from ..login_page import parse_login_page, parse_error_message
+from .pages import make_login_page, make_error_page
+
+
+def parse_login_page_bs4(raw_html: str) -> Tuple[bool, Dict[str, str], Optional[str]]:
+    """the previous implementation"""
+    soup = BeautifulSoup(raw_html, 'lxml')
+    form_found = len(soup.select('#casLoginForm')) > 0
+    fields = dict()
+    for entry in soup.select('#casLoginForm > input'):
+        if (entry_name := entry.get('name', '')):
+            fields[entry_name] = entry.get('value', '')
+    salt = None
+    salt_tag = soup.select("#pwdDefaultEncryptSalt")
+    if len(salt_tag) > 0:
+        salt = salt_tag[0].get('value')
+    else:
+        salt_result = re.search(r'(?<=var pwdDefaultEncryptSalt = ")\w{16}(?=")', raw_html)
+        if salt_result is not None:
+            salt = salt_result[0]
+    return form_found, fields, salt
+
+
+def parse_error_message_bs4(raw_html: str) -> Optional[str]:
+    """the previous implementation"""
+    error_msg = BeautifulSoup(raw_html, 'lxml').select('#errorMsg')
+    return error_msg[0].get_text() if len(error_msg) > 0 else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='login page parser benchmark')
+    parser.add_argument('pages', type=Path, nargs='*', help='saved login pages')
+    parser.add_argument('-n', '--number', type=int, default=50, help='runs per measurement')
+    args = parser.parse_args()
+
+    if len(args.pages) > 0:
+        pages = [page.read_text(encoding='utf-8') for page in args.pages]
+    else:
+        pages = [make_login_page(), make_login_page(mobile=True), make_login_page(slider=False)]
+    error_page = make_error_page()
+
+    for page in pages:
+        page_result = parse_login_page(page)
+        assert (page_result.form_found, page_result.fields, page_result.salt) == parse_login_page_bs4(page), 'results differ'
+    assert parse_error_message(error_page) == parse_error_message_bs4(error_page), 'results differ'
+    print('results identical on {} page(s), average size {:.1f}KB'.format(
+        len(pages), sum(map(len, pages)) / len(pages) / 1024))
+
+    for title, old, new, samples in (
+        ('login page', parse_login_page_bs4, parse_login_page, pages),
+        ('error page', parse_error_message_bs4, parse_error_message, [error_page]),
+    ):
+        old_time = min(timeit.repeat(lambda: [old(page) for page in samples], number=args.number, repeat=3)) / args.number / len(samples)
+        new_time = min(timeit.repeat(lambda: [new(page) for page in samples], number=args.number, repeat=3)) / args.number / len(samples)
+        print('{}: BeautifulSoup {:.3f} ms, lxml xpath {:.3f} ms, speedup {:.1f}x'.format(
+            title, old_time * 1000, new_time * 1000, old_time / new_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+"""local stand-in for the cpdaily and CAS servers
+
+The tenant list/info, the CAS login(salted password, needCaptcha, slider
+captcha) and the collector endpoints are served in process through an httpx
+transport, with a configurable latency.
+"""
+from typing import Optional, Dict
+from urllib.parse import urlencode
+import asyncio
+import base64
+import json
+import random
+import httpx
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import unpad
+
+from ..constant import *
+from ..task.submission import _AES_KEY, _AES_IV
+from .pages import make_login_page, make_error_page
+from .captcha import make_images, to_captcha_data, BIG_SIZE
+
+
+# the slider captcha images are scaled to 280 pixels wide by the client
+SLIDER_WIDTH = 280
+SALT = 'aBcDeFgH12345678'
+
+FORM_FIELDS = [
+    {'wid': '1', 'title': '今日体温', 'fieldType': '2', 'isRequired': 1, 'sort': '1', 'colName': 'field001',
+     'fieldItems': [{'itemWid': '11', 'content': '正常'}, {'itemWid': '12', 'content': '发热'}], 'value': ''},
+    {'wid': '2', 'title': '所在地址', 'fieldType': '1', 'isRequired': 1, 'sort': '2', 'colName': 'field002',
+     'fieldItems': [], 'value': ''},
+    {'wid': '3', 'title': '症状', 'fieldType': '3', 'isRequired': 1, 'sort': '3', 'colName': 'field003',
+     'fieldItems': [{'itemWid': '31', 'content': '无'}, {'itemWid': '32', 'content': '咳嗽'}, {'itemWid': '33', 'content': '乏力'}], 'value': ''},
+    {'wid': '4', 'title': '备注', 'fieldType': '1', 'isRequired': 0, 'sort': '4', 'colName': 'field004',
+     'fieldItems': [], 'value': ''},
+]
+
+# user defined fields answering FORM_FIELDS
+USER_FIELDS = [
+    {'title': '今日体温', 'col_name': 'field001', 'answer': ['正常']},
+    {'title': '所在地址', 'col_name': 'field002', 'answer': ['somewhere']},
+    {'title': '症状', 'col_name': 'field003', 'answer': ['无']},
+]
+
+
+def school_name(idx: int) -> str:
+    return 'School {}'.format(idx)
+
+
+def form_subject(idx: int) -> str:
+    return 'daily collection {}'.format(idx)
+
+
+def _decrypt_password(encrypted: str, salt: str) -> Optional[str]:
+    """the iv is not sent, a wrong one only garbles the random prefix"""
+    try:
+        data = AES.new(key=salt.encode('utf-8'), mode=AES.MODE_CBC, iv=b'\0' * 16).decrypt(base64.b64decode(encrypted))
+        data = data[:-data[-1]]
+        return data[64:].decode('utf-8')
+    except (ValueError, IndexError, UnicodeDecodeError):
+        return None
+
+
+def _decrypt_body(body_string: str) -> Optional[Dict]:
+    try:
+        data = AES.new(key=_AES_KEY, mode=AES.MODE_CBC, iv=_AES_IV).decrypt(base64.b64decode(body_string))
+        return json.loads(unpad(data, 16).decode('utf-8'))
+    except ValueError:
+        return None
+
+
+class MockCpdailyServer:
+    """in process cpdaily and CAS servers
+
+    Use `transport()` as the transport of the clients.
+    """
+
+    def __init__(self,
+        schools: int = 4,
+        forms_per_user: int = 1,
+        latency: float = 0.0,
+        latency_jitter: float = 0.0,
+        captcha: bool = False,
+        passwords: Optional[Dict[str, str]] = None,
+        tenant_padding: int = 2000,
+        page_padding: int = 30):
+        """
+        Args:
+            schools (int, optional): schools served, see `school_name`. Defaults to 4.
+            forms_per_user (int, optional): open forms of each user. Defaults to 1.
+            latency (float, optional): seconds before each response. Defaults to 0.0.
+            latency_jitter (float, optional): max random seconds added to the latency. Defaults to 0.0.
+            captcha (bool, optional): require a slider captcha to login. Defaults to False.
+            passwords (Optional[Dict[str, str]], optional): username -> password, None to accept any. Defaults to None.
+            tenant_padding (int, optional): other schools in the tenant list, the real one is long. Defaults to 2000.
+            page_padding (int, optional): filler elements of the login page. Defaults to 30.
+        """
+        self.schools = schools
+        self.forms_per_user = forms_per_user
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.captcha = captcha
+        self.passwords = passwords
+        self.sessions: Dict[str, str] = dict()  # cookie -> username
+        self.submitted = set()  # (username, instanceWid)
+        self.requests = 0
+        self.requests_by_path: Dict[str, int] = dict()
+        self._captcha_offset = int(150 / BIG_SIZE[0] * SLIDER_WIDTH)
+        self._captcha_data = to_captcha_data(*make_images(150))
+        self._tenants = [{'name': 'Other {}'.format(idx), 'id': 'o{}'.format(idx)} for idx in range(tenant_padding)]
+        self._tenants += [{'name': school_name(idx), 'id': 't{}'.format(idx)} for idx in range(schools)]
+        self._login_page = make_login_page(salt=SALT, padding=page_padding)
+        self._error_page = make_error_page(padding=page_padding)
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        path = request.url.path
+        self.requests_by_path[path] = self.requests_by_path.get(path, 0) + 1
+        delay = self.latency + (random.uniform(0, self.latency_jitter) if self.latency_jitter > 0 else 0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        host = request.url.host
+        if host == 'mobile.campushoy.com':
+            return self.handle_tenant(request)
+        tenant = host.split('.')[0].replace('cas-', '')
+        if host.endswith('.campusphere.net'):
+            return self.handle_amp(request, tenant)
+        if host.endswith('.mock'):
+            return self.handle_cas(request, tenant)
+        return httpx.Response(404)
+
+    def handle_tenant(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path
+        if path.endswith('/tenant/list'):
+            return httpx.Response(200, json={'errCode': 0, 'errMsg': None, 'data': self._tenants})
+        if path.endswith('/tenant/info'):
+            tenant = request.url.params.get('ids')
+            return httpx.Response(200, json={'errCode': 0, 'errMsg': None, 'data': [{
+                'id': tenant,
+                'idsUrl': 'https://cas-{}.mock/authserver'.format(tenant),
+                'ampUrl': 'https://{}.campusphere.net/portal'.format(tenant),
+                'ampUrl2': 'https://{}.campusphere.net/portal'.format(tenant),
+            }]})
+        return httpx.Response(404)
+
+    def handle_amp(self, request: httpx.Request, tenant: str) -> httpx.Response:
+        path = request.url.path
+        amp_root = 'https://{}.campusphere.net'.format(tenant)
+        if path == '/portal/login':
+            ticket = request.url.params.get('ticket')
+            if ticket is None:
+                location = 'https://cas-{}.mock/authserver/login?'.format(tenant) + urlencode({'service': amp_root + '/portal/login'})
+                return httpx.Response(302, headers={'Location': location})
+            cookie = 'session-' + ticket
+            return httpx.Response(302, headers={'Location': amp_root + '/portal/index.html', 'Set-Cookie': 'MOD_AUTH_CAS={}; Path=/'.format(cookie)})
+        if path == '/portal/index.html':
+            return httpx.Response(200, text='<html>portal</html>')
+        username = self.sessions.get(request.headers.get('cookie', '').replace('MOD_AUTH_CAS=', ''))
+        if username is None:
+            return httpx.Response(302, headers={'Location': amp_root + '/portal/login'})
+        payload = json.loads(request.content or b'{}')
+        if path == URI_FORM_LIST:
+            rows = [self.form_summary(username, idx) for idx in range(self.forms_per_user)]
+            page_size = payload.get('pageSize', 6)
+            start = (payload.get('pageNumber', 1) - 1) * page_size
+            datas = {'totalSize': len(rows), 'pageSize': page_size, 'pageNumber': payload.get('pageNumber'), 'rows': rows[start:start + page_size]}
+            return httpx.Response(200, json={'code': '0', 'message': 'SUCCESS', 'datas': datas})
+        if path == URI_FORM_DETAIL:
+            return httpx.Response(200, json={'code': '0', 'message': 'SUCCESS', 'datas': {
+                'collector': {'wid': payload.get('collectorWid'), 'formWid': 'f1', 'schoolTaskWid': 'st1', 'instanceWid': payload.get('instanceWid')},
+                'form': {'wid': 'f1', 'formTitle': 'daily', 'formContent': 'x' * 200},
+            }})
+        if path == URI_FORM_ENTRIES:
+            return httpx.Response(200, json={'code': '0', 'message': 'SUCCESS', 'datas': {'totalSize': len(FORM_FIELDS), 'rows': FORM_FIELDS}})
+        if path == URI_FORM_SUBMIT:
+            body = _decrypt_body(payload.get('bodyString', ''))
+            if request.headers.get('Cpdaily-Extension') is None or body is None:
+                return httpx.Response(200, json={'code': '1', 'message': 'bad request'})
+            self.submitted.add((username, body.get('instanceWid')))
+            return httpx.Response(200, json={'code': '0', 'message': 'SUCCESS'})
+        return httpx.Response(404)
+
+    def form_summary(self, username: str, idx: int) -> Dict:
+        return {
+            'subject': form_subject(idx), 'wid': 'c{}'.format(idx), 'formWid': 'f1', 'instanceWid': 100 + idx,
+            'content': '', 'senderUserName': 'admin', 'priority': '1',
+            'createTime': '2021-01-01 00:00', 'startTime': '2021-01-01 00:00', 'endTime': '2099-01-01 00:00',
+            'currentTime': '2021-01-01 12:00:00', 'isHandled': 1 if (username, 100 + idx) in self.submitted else 0, 'isRead': 0,
+        }
+
+    def handle_cas(self, request: httpx.Request, tenant: str) -> httpx.Response:
+        path = request.url.path
+        if path == '/authserver/login' and request.method == 'GET':
+            return httpx.Response(200, text=self._login_page)
+        if path == '/authserver/needCaptcha.html':
+            return httpx.Response(200, text='true' if self.captcha else 'false')
+        if path == '/authserver/sliderCaptcha.do':
+            return httpx.Response(200, json=self._captcha_data)
+        if path == '/authserver/verifySliderImageCode.do':
+            ok = abs(int(request.url.params.get('moveLength', -100)) - self._captcha_offset) <= 3
+            return httpx.Response(200, json={'code': 0 if ok else 1, 'message': 'ok' if ok else 'error', 'sign': 'sign-ok' if ok else ''})
+        if path == '/authserver/login' and request.method == 'POST':
+            username = request.url.params.get('username')
+            if self.passwords is not None:
+                password = _decrypt_password(request.url.params.get('password', ''), SALT)
+                if password is None or self.passwords.get(username) != password:
+                    return httpx.Response(200, text=self._error_page)
+            if self.captcha and request.url.params.get('sign') != 'sign-ok':
+                return httpx.Response(200, text=make_error_page('验证码错误'))
+            ticket = 'ST-{}-{}'.format(username, random.randrange(10 ** 9))
+            self.sessions['session-' + ticket] = username
+            service = request.url.params.get('service', 'https://{}.campusphere.net/portal/login'.format(tenant))
+            return httpx.Response(302, headers={'Location': service + '?ticket=' + ticket})
+        return httpx.Response(404)
+
+    def transport(self) -> httpx.MockTransport:
+        return httpx.MockTransport(self.handle)
@@ -0,0 +1,57 @@
+"""synthetic CAS pages, shaped like the real ones"""
+import random
+
+
+def make_login_page(salt: str = 'aBcDeFgH12345678', mobile: bool = False, slider: bool = True, padding: int = 300) -> str:
+    """create a CAS login page
+
+    Args:
+        salt (str, optional): password salt. Defaults to 'aBcDeFgH12345678'.
+        mobile (bool, optional): put the salt in javascript like the mobile page. Defaults to False.
+        slider (bool, optional): slider captcha, otherwise text captcha. Defaults to True.
+        padding (int, optional): filler elements, real pages are 20~60KB. Defaults to 300.
+
+    Returns:
+        str: html
+    """
+    rng = random.Random(salt)
+    filler = '\n'.join(
+        '<div class="item-{0}"><span>{1}</span><a href="/link/{0}">link {0}</a></div>'.format(idx, rng.random())
+        for idx in range(padding)
+    )
+    salt_html = '' if mobile else '<input type="hidden" id="pwdDefaultEncryptSalt" value="{}"/>'.format(salt)
+    salt_js = 'var pwdDefaultEncryptSalt = "{}";'.format(salt) if mobile else ''
+    captcha_html = '<div id="sliderCaptchaDiv"></div>' if slider else '<input id="captchaResponse" name="captchaResponse" type="text"/>'
+    return '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="UTF-8"/>
+<title>统一身份认证</title>
+<script type="text/javascript">
+var contextPath = "/authserver";
+{salt_js}
+</script>
+</head>
+<body>
+<div class="header">{filler}</div>
+<form id="casLoginForm" method="post" action="/authserver/login">
+<input id="username" name="username" type="text" value=""/>
+<input id="password" name="password" type="password" value=""/>
+{captcha_html}
+<input type="hidden" name="lt" value="LT-{lt}-cas"/>
+<input type="hidden" name="dllt" value="userNamePasswordLogin"/>
+<input type="hidden" name="execution" value="e1s1"/>
+<input type="hidden" name="_eventId" value="submit"/>
+<input type="hidden" name="rmShown" value="1"/>
+{salt_html}
+</form>
+<div class="footer">{filler}</div>
+</body>
+</html>
+'''.format(salt_js=salt_js, filler=filler, captcha_html=captcha_html, lt=rng.randrange(10 ** 8), salt_html=salt_html)
+
+
+def make_error_page(message: str = '您提供的用户名或者密码有误', padding: int = 300) -> str:
+    """create a CAS page shown after a failed login"""
+    page = make_login_page(padding=padding)
+    return page.replace('<form id="casLoginForm"', '<span id="errorMsg">{}</span>\n<form id="casLoginForm"'.format(message))
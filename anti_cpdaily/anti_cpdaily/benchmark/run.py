@@ -0,0 +1,109 @@
+"""end to end benchmark against the local mock server
+
+Run from the plugin folder: `python -m anti_cpdaily.benchmark.run --users 200`
+
+Users are processed like the scheduled routine does, through `run_users` and
+a `SharedTransport` pool in front of the mock server.
+"""
+from typing import List
+import argparse
+import asyncio
+import sys
+import time
+import tracemalloc
+from loguru import logger
+
+from ..config import UserConfig
+from ..ratelimit import rate_limiter
+from ..runner import run_users, UserResult
+from ..metrics import metrics
+from ..cli import percentile
+from ..transport import SharedTransport
+from .mock_server import MockCpdailyServer, USER_FIELDS, school_name, form_subject
+
+
+def make_users(count: int, schools: int, forms: int) -> List[UserConfig]:
+    collections = [{'subject': form_subject(idx), 'fields': USER_FIELDS} for idx in range(forms)]
+    return [
+        UserConfig(
+            username='2021{:06d}'.format(idx),
+            password='password{}'.format(idx),
+            school_name=school_name(idx % schools),
+            address='somewhere',
+            collections=collections
+        )
+        for idx in range(count)
+    ]
+
+
+def report(label: str, results: List[UserResult], total: float, requests: int):
+    latencies = [result.elapsed for result in results]
+    failed = sum(1 for result in results if not result.ok)
+    print('{}: {} user(s) in {:.2f}s, {} failed, {} request(s)'.format(label, len(results), total, failed, requests))
+    print('  users/min: {:10.1f}'.format(len(results) / total * 60 if total > 0 else 0.0))
+    print('  p50:       {:10.3f} s'.format(percentile(latencies, 0.5)))
+    print('  p99:       {:10.3f} s'.format(percentile(latencies, 0.99)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='end to end benchmark against a mock server')
+    parser.add_argument('-u', '--users', type=int, default=100, help='simulated users')
+    parser.add_argument('-s', '--schools', type=int, default=4, help='schools the users belong to')
+    parser.add_argument('-f', '--forms', type=int, default=1, help='open forms per user')
+    parser.add_argument('-l', '--latency', type=float, default=0.05, help='server latency in seconds')
+    parser.add_argument('-j', '--jitter', type=float, default=0.02, help='max random latency added in seconds')
+    parser.add_argument('-r', '--runs', type=int, default=2, help='runs, later ones reuse the caches')
+    parser.add_argument('--captcha', action='store_true', help='require a slider captcha to login')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--school-concurrency', type=int, default=4)
+    parser.add_argument('--form-concurrency', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=0.0, help='requests per second per host and school, 0 to disable')
+    parser.add_argument('--max-per-host', type=int, default=10, help='max concurrent requests per host of the pool')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show the library logs')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logger.remove()
+        logger.add(sys.stderr, level='ERROR')
+    rate_limiter.configure(rate=args.rate)
+    users = make_users(args.users, args.schools, args.forms)
+    print('{} user(s), {} school(s), {} form(s) each, latency {}+{}s, captcha: {}'.format(
+        args.users, args.schools, args.forms, args.latency, args.jitter, args.captcha))
+
+    async def run():
+        for idx in range(args.runs):
+            # a fresh server every run, so every form is open again
+            server = MockCpdailyServer(
+                schools=args.schools,
+                forms_per_user=args.forms,
+                latency=args.latency,
+                latency_jitter=args.jitter,
+                captcha=args.captcha,
+                passwords={user.username: user.password for user in users}
+            )
+            # the mock replaces the network, the requests still go through a pool
+            pool = SharedTransport(max_per_host=args.max_per_host, transport=server.transport())
+            start = time.perf_counter()
+            results = await run_users(
+                users,
+                concurrency=args.concurrency,
+                school_concurrency=args.school_concurrency,
+                form_concurrency=args.form_concurrency,
+                transport=pool
+            )
+            report('run {}'.format(idx + 1), results, time.perf_counter() - start, server.requests)
+            print('  host wait: {:10.3f} s'.format(pool.stats.wait_time))  # per-host slots only
+            await pool.shutdown()
+
+    tracemalloc.start()
+    asyncio.run(run())
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('peak memory: {:.1f} MiB'.format(peak / 2 ** 20))
+    print('stages(count, not ok, mean, p50, p99):')
+    for stage, count, errors, mean, p50, p99 in metrics.summary():
+        print('  {:16s}{:6d}{:6d}{:10.3f}{:8g}{:8g}'.format(stage, count, errors, mean, p50, p99))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""benchmark of the submission encryption
+
+Run from the plugin folder: `python -m anti_cpdaily.benchmark.submission`
+"""
+from typing import Dict, Tuple
+import argparse
+import hashlib
+import json
+import time
+import uuid
+
+from ..constant import *
+from ..task.submission import SubmissionContext, _des_encrypt_b64, _aes_encrypt_b64, _generate_extension_signature
+
+
+def make_user(idx: int) -> Dict:
+    return {
+        'username': '2021{:06d}'.format(idx),
+        'school_name': 'School {}'.format(idx % 8),
+        'address': 'Somewhere, Some Road {}'.format(idx),
+        'longitude': 120.0 + idx % 100 / 1000,
+        'latitude': 30.0 + idx % 100 / 1000,
+    }
+
+
+def make_payload(idx: int, fields: int = 8) -> Dict:
+    form = [
+        {'wid': str(n), 'title': 'item {}'.format(n), 'fieldType': '1', 'colName': 'field{:03d}'.format(n),
+         'value': 'answer {} of form {}'.format(n, idx), 'fieldItems': []}
+        for n in range(fields)
+    ]
+    return {
+        "formWid": 'f1',
+        "instanceWid": 100 + idx,
+        "address": 'Somewhere',
+        "collectWid": 'c{}'.format(idx),
+        "schoolTaskWid": 'st1',
+        "form": form,
+        "uaIsCpadaily": True
+    }
+
+
+def build_legacy(user_data: Dict, payload: Dict, tenant_id: str) -> Tuple[Dict, Dict]:
+    """the previous implementation, everything computed per submission"""
+    generated_device_uuid = user_data.get('device_uuid', None)
+    if generated_device_uuid == None:
+        seed_string = user_data.get('username') + user_data.get('school_name')
+        seed_hash = hashlib.md5(seed_string.encode('utf-8'))
+        seed = int(seed_hash.hexdigest(), 16)
+        generated_device_uuid = str(uuid.UUID(int=seed))
+    extension = {
+        "appVersion": CPDAILY_APP_VERSION,
+        "model": "MI 6",
+        "systemName": "android",
+        "systemVersion": "7.1.1",
+        "userId": user_data.get('username'),
+        "lon": user_data.get('longitude'),
+        "lat": user_data.get('latitude'),
+        "deviceId": generated_device_uuid,
+        "calVersion": "firstv",
+        "version": "first_v2"
+    }
+    partial_extension = _des_encrypt_b64(json.dumps(extension))
+    body_string = _aes_encrypt_b64(json.dumps(payload))
+    signature = _generate_extension_signature(extension)
+    extension['bodyString'] = body_string
+    extension['sign'] = signature
+    headers = {
+        'tenantId': tenant_id,
+        'CpdailyStandAlone': '0',
+        'extension': '1',
+        'sign': '1',
+        'Cpdaily-Extension': _des_encrypt_b64(json.dumps(extension)),
+        'User-Agent': USER_AGENT_SUBMIT
+    }
+    return headers, extension
+
+
+def main():
+    parser = argparse.ArgumentParser(description='submission encryption benchmark')
+    parser.add_argument('-n', '--submissions', type=int, default=5000, help='submissions to encrypt')
+    parser.add_argument('-u', '--users', type=int, default=500, help='distinct users')
+    parser.add_argument('-f', '--fields', type=int, default=8, help='fields per form')
+    args = parser.parse_args()
+
+    users = [make_user(idx) for idx in range(args.users)]
+    jobs = [(users[idx % args.users], make_payload(idx, args.fields)) for idx in range(args.submissions)]
+
+    for user_data, payload in jobs[:args.users]:
+        assert build_legacy(user_data, payload, 't1') == SubmissionContext(user_data).build(payload, 't1'), 'results differ'
+    print('results identical on {} submission(s)'.format(min(args.users, args.submissions)))
+
+    start = time.perf_counter()
+    for user_data, payload in jobs:
+        build_legacy(user_data, payload, 't1')
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    contexts = dict()
+    for user_data, payload in jobs:
+        context = contexts.get(user_data['username'])
+        if context is None:
+            context = contexts[user_data['username']] = SubmissionContext(user_data)
+        context.build(payload, 't1')
+    context_time = time.perf_counter() - start
+
+    print('{} submission(s) of {} user(s), {} field(s) each'.format(args.submissions, args.users, args.fields))
+    print('legacy:  {:8.0f} submissions/s'.format(args.submissions / legacy_time))
+    print('context: {:8.0f} submissions/s'.format(args.submissions / context_time))
+    print('speedup: {:8.2f}x'.format(legacy_time / context_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+from typing import Optional, Dict, Set
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import asyncio
+import os
+from loguru import logger
+
+from .captcha_solver import CaptchaSolution, solve as solve_captcha
+
+
+class CaptchaService:
+    """solve captchas in a process pool so the event loop keeps running
+
+    At most `max_pending` captchas are queued or being solved, others wait for a
+    place. `timeout` covers both the waiting and the solving, a job that timed
+    out holds its place until the worker is done with it.
+    """
+
+    max_workers: int
+    max_pending: int
+    timeout: float
+    min_confidence: float
+
+    def __init__(self,
+        max_workers: Optional[int] = None,
+        max_pending: int = 64,
+        timeout: float = 20.0,
+        min_confidence: float = 0.3):
+        """
+        Args:
+            max_workers (Optional[int], optional): processes in the pool. Defaults to None(cpu count).
+            max_pending (int, optional): max captchas queued or being solved. Defaults to 64.
+            timeout (float, optional): seconds before giving up a captcha. Defaults to 20.0.
+            min_confidence (float, optional): solutions below it are replaced by a new captcha while attempts remain. Defaults to 0.3.
+        """
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._pending: Optional[asyncio.Semaphore] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._in_flight: Set[Future] = set()
+        self.configure(max_workers=max_workers, max_pending=max_pending, timeout=timeout, min_confidence=min_confidence)
+
+    def configure(self,
+        max_workers: Optional[int] = None,
+        max_pending: int = 64,
+        timeout: float = 20.0,
+        min_confidence: float = 0.3):
+        """change the settings, takes effect on the next new pool"""
+        self.max_workers = max_workers if max_workers else (os.cpu_count() or 1)
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.min_confidence = min_confidence
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            logger.debug('starting captcha process pool({} worker(s))'.format(self.max_workers))
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    def _get_pending(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._pending is None or self._loop is not loop:
+            self._pending = asyncio.Semaphore(self.max_pending)
+            self._loop = loop
+        return self._pending
+
+    def _release_when_done(self, job: Future, pending: asyncio.Semaphore, loop: asyncio.AbstractEventLoop):
+        """free the place once the worker is done with the job, not when the caller gives up"""
+        self._in_flight.add(job)
+
+        def release(_):
+            self._in_flight.discard(job)
+            try:
+                loop.call_soon_threadsafe(pending.release)
+            except RuntimeError:  # the loop is closed, so is the semaphore
+                pass
+
+        job.add_done_callback(release)
+
+    @property
+    def in_flight(self) -> int:
+        """jobs queued or running in the pool, including those whose caller timed out"""
+        return len(self._in_flight)
+
+    async def solve(self,
+        captcha_type: str,
+        data: Dict,
+        name: Optional[str] = None,
+        timeout: Optional[float] = None) -> CaptchaSolution:
+        """solve a captcha in the process pool
+
+        Args:
+            captcha_type (str): captcha type, see `captcha_solver`
+            data (Dict): captcha data
+            name (Optional[str], optional): solver name. Defaults to None(the default one).
+            timeout (Optional[float], optional): seconds before giving up. Defaults to None(use `self.timeout`).
+
+        Returns:
+            CaptchaSolution: the solution
+
+        Raises:
+            asyncio.TimeoutError: if not solved in time
+
+        A job still running when the caller gives up keeps its place until it ends.
+        """
+        timeout = timeout if timeout is not None else self.timeout
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        pending = self._get_pending()
+        await asyncio.wait_for(pending.acquire(), timeout)
+        try:
+            job = self._get_executor().submit(solve_captcha, captcha_type, data, name)
+        except BaseException:
+            pending.release()
+            raise
+        self._release_when_done(job, pending, loop)
+        result = asyncio.wrap_future(job)
+        result.add_done_callback(lambda f: f.cancelled() or f.exception())  # retrieved even if abandoned
+        try:
+            return await asyncio.wait_for(asyncio.shield(result), max(0.0, deadline - loop.time()))
+        except BrokenProcessPool:
+            # a worker died, start a new pool for the next captcha
+            logger.warning('captcha process pool broken, restarting')
+            self.shutdown(wait=False)
+            raise
+        except asyncio.TimeoutError:
+            if not job.cancel():  # only a job not started yet can be cancelled
+                logger.warning('captcha not solved in {}s, {} job(s) in flight'.format(timeout, self.in_flight))
+            raise
+
+    def shutdown(self, wait: bool = True):
+        """stop the worker processes"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+
+captcha_service = CaptchaService()
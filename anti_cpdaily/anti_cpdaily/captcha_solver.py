@@ -0,0 +1,109 @@
+from typing import Optional, Dict, List, Callable
+from dataclasses import dataclass
+import base64
+from loguru import logger
+
+from .slider_captcha import solve_captcha_rated
+
+try:  # text captchas need an OCR engine, `ddddocr` is supported
+    import ddddocr
+except ImportError:
+    ddddocr = None
+
+
+CAPTCHA_SLIDER = 'slider'
+CAPTCHA_TEXT = 'text'
+
+
+@dataclass
+class CaptchaSolution:
+    params: Dict  # slider: verification params, text: {'captchaResponse': answer}
+    confidence: float  # between 0 and 1
+    solver: str = ''
+
+
+SolverFunc = Callable[[Dict], CaptchaSolution]
+
+_solvers: Dict[str, Dict[str, SolverFunc]] = dict()  # captcha type -> name -> solver
+_default_solvers: Dict[str, str] = dict()  # captcha type -> name
+
+
+def register_solver(captcha_type: str, name: str, default: bool = False):
+    """register a solver for a type of captcha
+
+    Args:
+        captcha_type (str): `CAPTCHA_SLIDER`, `CAPTCHA_TEXT` or a new type
+        name (str): solver name
+        default (bool, optional): use it by default for this type. Defaults to False(only if it's the first one).
+
+    The solver takes the captcha data and returns a `CaptchaSolution`. It must be
+    a module level function, since it may run in another process.
+    """
+    def decorator(func: SolverFunc) -> SolverFunc:
+        _solvers.setdefault(captcha_type, dict())[name] = func
+        if default or captcha_type not in _default_solvers:
+            _default_solvers[captcha_type] = name
+        return func
+    return decorator
+
+
+def get_solver(captcha_type: str, name: Optional[str] = None) -> SolverFunc:
+    """find a solver
+
+    Args:
+        captcha_type (str): captcha type
+        name (Optional[str], optional): solver name. Defaults to None(the default one).
+
+    Raises:
+        LookupError: if no such solver
+
+    Returns:
+        SolverFunc: the solver
+    """
+    if name is None:
+        name = _default_solvers.get(captcha_type)
+    solver = _solvers.get(captcha_type, dict()).get(name)
+    if solver is None:
+        raise LookupError('no solver for {} captcha(name: {})'.format(captcha_type, name))
+    return solver
+
+
+def has_solver(captcha_type: str) -> bool:
+    return captcha_type in _default_solvers
+
+
+def list_solvers() -> Dict[str, List[str]]:
+    """names of all solvers, grouped by captcha type"""
+    return {captcha_type: list(solvers.keys()) for captcha_type, solvers in _solvers.items()}
+
+
+def solve(captcha_type: str, data: Dict, name: Optional[str] = None) -> CaptchaSolution:
+    """solve a captcha with a registered solver"""
+    if name is None:
+        name = _default_solvers.get(captcha_type)
+    solution = get_solver(captcha_type, name)(data)
+    solution.solver = name
+    logger.debug('{} captcha solved by {}, confidence: {:.3f}'.format(captcha_type, name, solution.confidence))
+    return solution
+
+
+@register_solver(CAPTCHA_SLIDER, 'boundary')
+def solve_slider_boundary(data: Dict) -> CaptchaSolution:
+    """match the white puzzle boundary, see `slider_captcha`"""
+    params, confidence = solve_captcha_rated(data)
+    return CaptchaSolution(params=params, confidence=confidence)
+
+
+if ddddocr is not None:
+    _ocr = None
+
+    @register_solver(CAPTCHA_TEXT, 'ddddocr')
+    def solve_text_ddddocr(data: Dict) -> CaptchaSolution:
+        """recognize the text with ddddocr, data is {'image': base64 image}"""
+        global _ocr
+        if _ocr is None:  # model loading is slow, do it once per process
+            _ocr = ddddocr.DdddOcr(show_ad=False)
+        answer = _ocr.classification(base64.b64decode(data.get('image')))
+        # ddddocr gives no score, trust answers of the usual length only
+        confidence = 0.5 if len(answer) == 4 else 0.1
+        return CaptchaSolution(params={'captchaResponse': answer}, confidence=confidence)
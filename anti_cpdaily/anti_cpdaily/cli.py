@@ -0,0 +1,181 @@
+"""process a profile folder without the bot
+
+Run from the plugin folder: `python -m anti_cpdaily PROFILES --dry-run`
+
+One JSON line is written per user as soon as it is finished, the timing
+summary goes to stderr.
+"""
+from typing import Optional, List, TextIO
+from datetime import datetime
+from pathlib import Path
+import argparse
+import asyncio
+import json
+import sys
+import time
+from loguru import logger
+
+from .captcha_service import captcha_service
+from .config import UserConfig
+from .journal import run_journal
+from .metrics import metrics
+from .persist import flush_all
+from .policy import request_policy
+from .profile import ProfileRegistry
+from .ratelimit import rate_limiter
+from .runner import UserResult, run_users
+from .school import tenant_cache
+from .session import session_store
+from .sharding import WorkerOptions, SHARD_BY_SCHOOL, SHARD_BY_USERNAME, run_sharded
+from .task.schema_cache import schema_cache
+from .transport import shared_transport
+
+
+def select_users(users: List[UserConfig], schools: Optional[List[str]] = None, usernames: Optional[List[str]] = None) -> List[UserConfig]:
+    """users of the given schools and usernames, all of them if not given"""
+    if schools:
+        users = [user for user in users if user.school_name in set(schools)]
+    if usernames:
+        users = [user for user in users if user.username in set(usernames)]
+    return users
+
+
+def percentile(values: List[float], q: float) -> float:
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def print_summary(results: List[UserResult], total: float, file: TextIO = sys.stderr):
+    """users and forms by outcome, latencies and time spent in each stage"""
+    latencies = [result.elapsed for result in results if not result.skipped]
+    failed = sum(1 for result in results if not result.ok)
+    skipped = sum(1 for result in results if result.skipped)
+    forms = dict()
+    for result in results:
+        for _, status in result.forms_status:
+            forms[status] = forms.get(status, 0) + 1
+    print('{} user(s) in {:.2f}s, {} failed, {} skipped'.format(len(results), total, failed, skipped), file=file)
+    print('  users/min: {:10.1f}'.format(len(results) / total * 60 if total > 0 else 0.0), file=file)
+    print('  p50:       {:10.3f} s'.format(percentile(latencies, 0.5)), file=file)
+    print('  p90:       {:10.3f} s'.format(percentile(latencies, 0.9)), file=file)
+    print('  p99:       {:10.3f} s'.format(percentile(latencies, 0.99)), file=file)
+    print('forms: {}'.format(', '.join('{} {}'.format(count, status) for status, count in sorted(forms.items())) or 'none'), file=file)
+    rows = metrics.summary()
+    if len(rows) > 0:  # worker processes keep their own metrics
+        print('stages(count, not ok, mean, p50, p99):', file=file)
+        for stage, count, errors, mean, p50, p99 in rows:
+            print('  {:16s}{:6d}{:6d}{:10.3f}{:8g}{:8g}'.format(stage, count, errors, mean, p50, p99), file=file)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog='anti_cpdaily', description='fill and submit the collections of every profile in a folder')
+    parser.add_argument('profiles', help='profile folder(`*config.json`)')
+    parser.add_argument('--schools', nargs='+', default=None, help='only process users of these schools')
+    parser.add_argument('--users', nargs='+', default=None, help='only process these usernames')
+    parser.add_argument('--dry-run', action='store_true', help='fill the forms but don\'t submit them')
+    parser.add_argument('-o', '--output', default='-', help='JSON lines result file, - for stdout')
+    parser.add_argument('--cache', default=None, help='cache folder shared with the bot, none by default')
+    parser.add_argument('--journal', action='store_true', help='journal the run in the cache folder')
+    parser.add_argument('--run-id', default=None, help='journaled run to resume, defaults to a new one')
+    parser.add_argument('--concurrency', type=int, default=8, help='users processed at the same time')
+    parser.add_argument('--school-concurrency', type=int, default=4, help='users of one school processed at the same time')
+    parser.add_argument('--form-concurrency', type=int, default=4, help='forms of one user fetched at the same time')
+    parser.add_argument('--page-size', type=int, default=20, help='forms per collection list request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='max random delay in seconds before a user starts')
+    parser.add_argument('--rate', type=float, default=5.0, help='requests per second per host and school, 0 to disable')
+    parser.add_argument('--retries', type=int, default=3, help='retries of idempotent requests')
+    parser.add_argument('--workers', type=int, default=0, help='worker processes, 0 to run in this process')
+    parser.add_argument('--shard-by', choices=[SHARD_BY_SCHOOL, SHARD_BY_USERNAME], default=SHARD_BY_SCHOOL)
+    parser.add_argument('--metrics', default=None, help='write the metrics in the Prometheus text format there')
+    parser.add_argument('--log-level', default='WARNING', help='level of the logs written to stderr')
+    args = parser.parse_args(argv)
+
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level.upper())
+    if args.journal and args.cache is None:
+        parser.error('--journal requires --cache')
+
+    registry = ProfileRegistry(args.profiles)
+    registry.refresh()
+    for name, error in registry.errors.items():
+        print('invalid profile {}: {}'.format(name, error), file=sys.stderr)
+    users = select_users(registry.users, args.schools, args.users)
+    if len(users) == 0:
+        print('no user to process', file=sys.stderr)
+        return 1
+
+    rate_limiter.configure(rate=args.rate)
+    request_policy.configure(retries=args.retries)
+    if args.cache is not None:
+        cache_path = Path(args.cache)
+        tenant_cache.persist_to(cache_path / 'tenants.json')
+        session_store.persist_to(cache_path / 'sessions')
+        schema_cache.persist_to(cache_path / 'forms.json')
+        if args.journal:
+            run_journal.persist_to(cache_path / 'journal.sqlite3')
+    # only resume the run asked for, an old unfinished one may belong to the bot
+    run_id = args.run_id
+    if run_journal.enabled and run_id is None:
+        run_id = datetime.now().strftime('cli-%Y-%m-%d-%H%M%S')
+
+    output = sys.stdout if args.output == '-' else open(args.output, 'a', encoding='utf-8')
+
+    async def write_result(result: UserResult):
+        data = result.to_dict()
+        data.update(ok=result.ok, finished=result.finished, run_id=run_id, dry_run=args.dry_run)
+        output.write(json.dumps(data, ensure_ascii=False) + '\n')
+        output.flush()
+
+    async def run() -> List[UserResult]:
+        try:
+            if args.workers > 0:
+                rate = args.rate / args.workers if args.shard_by == SHARD_BY_USERNAME else args.rate
+                options = WorkerOptions(
+                    concurrency=args.concurrency,
+                    school_concurrency=args.school_concurrency,
+                    form_concurrency=args.form_concurrency,
+                    page_size=args.page_size,
+                    start_jitter=args.jitter,
+                    rate=rate,
+                    retries=args.retries,
+                    dry_run=args.dry_run,
+                    log_level=args.log_level.upper(),
+                    cache_path=args.cache,
+                    journal_path=str(run_journal.path) if run_journal.enabled else None,
+                    run_id=run_id
+                )
+                return await run_sharded(
+                    users, args.workers, options, by=args.shard_by,
+                    journal=run_journal if run_journal.enabled else None,
+                    on_result=write_result
+                )
+            return await run_users(
+                users,
+                concurrency=args.concurrency,
+                school_concurrency=args.school_concurrency,
+                form_concurrency=args.form_concurrency,
+                page_size=args.page_size,
+                start_jitter=args.jitter,
+                journal=run_journal if run_journal.enabled else None,
+                run_id=run_id,
+                on_result=write_result,
+                dry_run=args.dry_run
+            )
+        finally:
+            await shared_transport.shutdown()
+
+    start = time.perf_counter()
+    try:
+        results = asyncio.run(run())
+    finally:
+        captcha_service.shutdown(wait=False)
+        flush_all()
+        run_journal.close()
+        if output is not sys.stdout:
+            output.close()
+    print_summary(results, time.perf_counter() - start)
+    if args.metrics is not None:
+        metrics.write(args.metrics)
+    return 0 if all(result.ok for result in results) else 2
@@ -2,15 +2,22 @@ from typing import Optional, Dict
 from copy import deepcopy
 import random
 import base64
-import re
-from httpx import AsyncClient
+from httpx import AsyncClient, AsyncBaseTransport, Request
 from urllib.parse import urlparse
-from bs4 import BeautifulSoup
 from Crypto.Cipher import AES
 from loguru import logger
 
 from .constant import *
-from .slider_captcha import solve_captcha
+from .captcha_service import CaptchaService, captcha_service as default_captcha_service
+from .captcha_solver import CAPTCHA_SLIDER, CAPTCHA_TEXT, has_solver
+from .login_page import parse_login_page, parse_error_message
+from .metrics import metrics
+from .tracing import tracer
+from .policy import RequestPolicy, PolicyTransport, request_policy as default_request_policy
+from .ratelimit import RateLimiter, rate_limiter as default_rate_limiter
+from .school import TenantCache, tenant_cache as default_tenant_cache
+from .session import SessionStore, session_store as default_session_store
+from .transport import shared_transport
 
 
 def _aes_encrypt_b64(text: str, key: str) -> str:
@@ -28,6 +35,13 @@ def _aes_encrypt_b64(text: str, key: str) -> str:
     return result
 
 
+def _detect_captcha_type(raw_page_html: str) -> str:
+    """guess the captcha type from the login page"""
+    if 'captchaResponse' in raw_page_html and 'sliderCaptcha' not in raw_page_html:
+        return CAPTCHA_TEXT
+    return CAPTCHA_SLIDER
+
+
 class AsyncCpdailyUser:
 
     username: str
@@ -36,20 +50,51 @@ class AsyncCpdailyUser:
     school_info: Optional[Dict]
     client: Optional[AsyncClient]
     school_api: Optional[Dict]
+    tenant_cache: TenantCache
+    session_store: SessionStore
+    captcha_service: CaptchaService
+    rate_limiter: RateLimiter
+    request_policy: RequestPolicy
+    captcha_attempts: int = 3
 
     def __init__(self,
         username: str,
         password: str,
         school_name: Optional[str] = None,
+        tenant_cache: Optional[TenantCache] = None,
+        session_store: Optional[SessionStore] = None,
+        transport: Optional[AsyncBaseTransport] = None,
+        captcha_service: Optional[CaptchaService] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        request_policy: Optional[RequestPolicy] = None,
         *args, **kwargs):
         self.username = username
         self.password = password
         self.school_name = school_name
+        self.tenant_cache = tenant_cache if tenant_cache is not None else default_tenant_cache
+        self.session_store = session_store if session_store is not None else default_session_store
+        self.captcha_service = captcha_service if captcha_service is not None else default_captcha_service
+        self.rate_limiter = rate_limiter if rate_limiter is not None else default_rate_limiter
+        self.request_policy = request_policy if request_policy is not None else default_request_policy
         self.school_api = None
         self.school_info = None
-        self.client = AsyncClient(verify=False)
+        # connections are shared, cookies are not
+        # every request, forms and redirects included, goes through the rate limiter
+        # and the request policy(timeouts, retries and circuit breakers)
+        self.client = AsyncClient(
+            verify=False,
+            transport=PolicyTransport(
+                transport if transport is not None else shared_transport,
+                self.request_policy,
+                throttle=self._throttle
+            ),
+            timeout=self.request_policy.timeout()
+        )
         self.client.headers = {'User-Agent': USER_AGENT_LOGIN}
     
+    async def _throttle(self, request: Request):
+        await self.rate_limiter.acquire(request.url.host, self.school_name)
+
     async def __aenter__(self):
         return self
 
@@ -65,38 +110,56 @@ class AsyncCpdailyUser:
     async def login(self) -> bool:
         logger.info('start to login')
         logger.info('getting school api')
-        await self._get_school_api()
+        with metrics.stage('school_lookup', self.school_name):
+            await self._get_school_api()
+        with metrics.stage('session_restore', self.school_name) as timer:
+            restored = await self._restore_session()
+            timer.outcome = 'ok' if restored else 'miss'
+        if restored:
+            logger.success('session restored')
+            return True
         logger.info('try to login')
         if '/iap' in self.school_api['amp_login_path']:
-            return await self._iap_login()
+            log_in = await self._iap_login()
         else:
-            return await self._cas_login()
+            log_in = await self._cas_login()
+        if log_in:
+            await self.session_store.save_async(self.username, self.school_name, self.school_api['amp_root'], self.client.cookies)
+        return log_in
+
+    async def _restore_session(self) -> bool:
+        """load saved cookies and check if they are still valid
+
+        The check is a cheap authenticated request to the form list.
+        """
+        cookies = await self.session_store.load_async(self.username, self.school_name, self.school_api['amp_root'])
+        if cookies is None:
+            return False
+        logger.debug('validating saved session')
+        self.client.cookies = cookies
+        probe_url = self.school_api['amp_root'] + URI_FORM_LIST
+        try:
+            res = await self.client.post(probe_url, json={'pageSize': 1, 'pageNumber': 1})
+            valid = res.status_code == 200 and res.json().get('code') == '0'
+        except Exception as e:  # unauthenticated requests get a login page instead of json
+            logger.debug('session probe failed: {}'.format(repr(e)))
+            valid = False
+        if not valid:
+            logger.info('saved session expired')
+            await self.session_store.drop_async(self.username, self.school_name)
+            self.client.cookies.clear()
+        return valid
 
     async def _get_school_api(self) -> Dict:
-        # get a list about available schools and find target based on name
-        res = await self.client.get(URL_SCHOOL_LIST, timeout=10)  # data is a bit long
-        schools = res.json().get('data')
-        logger.debug('available school count: {}'.format(len(schools)))
-        school_idx = -1
-        for idx, school in enumerate(schools):
-            if school.get('name') == self.school_name:
-                school_idx = idx
-                break
-        if school_idx < 0:
+        # find target school based on name, the school list is cached
+        school = await self.tenant_cache.get_tenant(self.school_name, self.client)
+        if school is None:
             logger.error('school not found')
             raise ValueError(f'Unsupported school! {self.school_name}')
         # school is supported, load detail infomation
-        school = schools[school_idx]
         self.school_info = school  # save current school info
-        school_param = {
-            'ids': school['id']
-        }
-        res = await self.client.get(URL_SCHOOL_INFO, params=school_param)
-        res_json = res.json()
-        logger.debug('cpdaily response status: {}'.format(res.status_code))
-        logger.debug('cpdaily response detail: {},{}'.format(res_json.get('errCode'), res_json.get('errMsg')))
-        school_info = res_json.get('data')[0]
-        logger.debug(f'school info: {school_info}')
+        school_info = await self.tenant_cache.get_info(school['id'], self.client)
+        tracer.dump('school info: {}', school_info)
         # WTF? generate parameters?
         school_api = {
             'tenant_id': school_info['id'],
@@ -119,24 +182,66 @@ class AsyncCpdailyUser:
     async def _iap_login(self) -> bool:
         raise NotImplementedError()
 
+    async def _solve_slider_captcha(self, cas_root: str) -> str:
+        """solve slider captchas until the server accepts one
+
+        Returns:
+            str: the sign given by the server, empty if all attempts failed
+        """
+        img_url = cas_root + '/authserver/sliderCaptcha.do'
+        verify_url = cas_root + '/authserver/verifySliderImageCode.do'
+        for attempt in range(1, self.captcha_attempts + 1):
+            res = await self.client.get(img_url, params={'username': self.username})
+            data = res.json()
+            solution = await self.captcha_service.solve(CAPTCHA_SLIDER, data)  # solved in another process
+            logger.debug('solution: {}', solution)
+            if solution.confidence < self.captcha_service.min_confidence and attempt < self.captcha_attempts:
+                logger.info('captcha solution not confident({:.3f}), trying another one'.format(solution.confidence))
+                continue
+            res = await self.client.get(verify_url, params=solution.params)
+            signature = res.json()
+            server_code = signature.get('code')
+            server_msg = signature.get('message')
+            logger.debug('server response status: code({}), message({})', server_code, server_msg)
+            if server_code == 0:
+                return signature.get('sign', '')
+            logger.warning('server rejects the captcha(attempt {}/{})'.format(attempt, self.captcha_attempts))
+        logger.warning('captcha not solved, posting anyway')
+        return ''
+
+    async def _solve_text_captcha(self, cas_root: str) -> Dict[str, str]:
+        """solve the text captcha
+
+        Returns:
+            Dict[str, str]: login params to add
+
+        The answer can't be verified before posting the login form.
+        """
+        img_url = cas_root + '/authserver/captcha.html'
+        res = await self.client.get(img_url)
+        data = {'image': base64.b64encode(res.content).decode('utf-8')}
+        solution = await self.captcha_service.solve(CAPTCHA_TEXT, data)  # solved in another process
+        logger.debug('solution: {}', solution)
+        return solution.params
+
     async def _cas_login(self) -> bool:
         logger.info('start cas login')
         login_url = self.school_api['amp_root'] + self.school_api['amp_login_path']
         amp_params = self.school_api['amp_login_params']
         logger.debug('fetching web page')
-        res = await self.client.get(login_url, params=amp_params, follow_redirects=True, timeout=10)  # server speed is slow
+        with metrics.stage('login_page', self.school_name):
+            res = await self.client.get(login_url, params=amp_params, follow_redirects=True)  # server speed is slow, see the read timeout
         logger.debug('current history: {}', res.history)
         logger.debug('current url: {}', res.url)
         cas_target_url = res.url
         raw_page_html = res.text
-        soup = BeautifulSoup(raw_page_html, 'lxml')
         logger.debug('searching for cas login form')
-        cas_login_form = soup.select('#casLoginForm')
-        if len(cas_login_form) < 1:  # no form found
+        login_page = parse_login_page(raw_page_html)
+        if not login_page.form_found:  # no form found
             logger.error('cas form tag not found')
             raise RuntimeError('unable to find cas login form from raw html')
         else:
-            logger.debug('form found: {}'.format(cas_login_form))
+            tracer.dump('form found: {}', lambda: {name: value for name, value in login_page.fields.items() if name != 'password'})
 
         # check if captcha required, and mark the status
         cas_root = cas_target_url.scheme + '://' + cas_target_url.host
@@ -149,30 +254,14 @@ class AsyncCpdailyUser:
 
         # extract the form from html
         logger.debug('extract form components to make params')
-        form = soup.select('#casLoginForm > input')
         required_fields = {'username', 'password', 'lt', 'dllt', 'execution', '_eventId', 'rmShown', 'sign'}
-        login_params = {}
-        for entry in form:
-            logger.debug('form entry: {}'.format(entry))
-            if (entry_name := entry.get('name', '')) in required_fields:
-                login_params[entry_name] = entry.get('value', '')
+        login_params = {name: value for name, value in login_page.fields.items() if name in required_fields}
         # especially, the salt
-        salt_tag = soup.select("#pwdDefaultEncryptSalt")
-        logger.debug('salt component from html: {}'.format(salt_tag))
-        salt = None
-        if len(salt_tag) > 0:
-            # for desktop, salt is stored in an html element
-            single_salt_tag = salt_tag[0]
-            salt = single_salt_tag.get('value')
-            logger.debug(f'salt from HTML: {salt}')
+        salt = login_page.salt
+        if login_page.salt_source is not None:
+            logger.debug(f'salt from {login_page.salt_source}: {salt}')
         else:
-            # on mobile, the salt is stored in a javascript variable
-            salt_result = re.search('(?<=var pwdDefaultEncryptSalt = ")\w{16}(?=")', raw_page_html)
-            if salt_result is not None:
-                logger.debug(f'salt from embedded javascript: {salt_result}')
-                salt = salt_result[0]
-            else:
-                logger.warning('no #pwdDefaultEncryptSalt found')
+            logger.warning('no #pwdDefaultEncryptSalt found')
 
         # prepare identity and captcha, try to login
         login_params['username'] = self.username
@@ -180,31 +269,29 @@ class AsyncCpdailyUser:
             login_params['password'] = self.password
         else:
             login_params['password'] = _aes_encrypt_b64(self.password, salt)
-        # solve the slider captcha
-        # TODO: identify slider captcha and text captcha
+        # solve the captcha, slider or text
         if need_captcha:
-            logger.info('solving the captcha')
-            img_url = cas_root + '/authserver/sliderCaptcha.do'
-            verify_url = cas_root + '/authserver/verifySliderImageCode.do'
-            res = await self.client.get(img_url, params={'username': self.username})
-            data = res.json()
-            params = solve_captcha(data)
-            logger.debug(f'solution: {params}')
-            res = await self.client.get(verify_url, params=params)
-            signature = res.json()
-            server_code = signature.get('code')
-            server_msg = signature.get('message')
-            logger.debug(f'server response status: code({server_code}), message({server_msg})')
-            if signature.get('code') != 0:
-                logger.warning('server rejects the captcha')
-            login_params['sign'] = signature.get('sign', '')
+            captcha_type = _detect_captcha_type(raw_page_html)
+            logger.info('solving the {} captcha'.format(captcha_type))
+            if not has_solver(captcha_type):
+                # the guess may be wrong, sliders were the only captchas before
+                logger.warning('no solver for {} captcha, trying the slider one'.format(captcha_type))
+                captcha_type = CAPTCHA_SLIDER
+            with metrics.stage('captcha', self.school_name) as timer:
+                if captcha_type == CAPTCHA_SLIDER:
+                    login_params['sign'] = await self._solve_slider_captcha(cas_root)
+                    if not login_params['sign']:
+                        timer.outcome = 'failed'
+                else:
+                    login_params.update(await self._solve_text_captcha(cas_root))
 
         # post form
         logger.info('posting form')
-        logger.debug('form data: {}'.format(login_params))
-        logger.debug('target url: {}'.format(cas_target_url))
+        tracer.dump('form data: {}', lambda: {name: value for name, value in login_params.items() if name != 'password'})
+        logger.debug('target url: {}', cas_target_url)
 
-        res = await self.client.post(cas_target_url, params=login_params, follow_redirects=True, timeout=10)
+        with metrics.stage('cas_post', self.school_name):
+            res = await self.client.post(cas_target_url, params=login_params, follow_redirects=True)
         logger.debug('post status: {}', res.status_code)
         logger.debug('current history: {}', res.history)
         logger.debug('current url: {}', res.url)
@@ -222,9 +309,8 @@ class AsyncCpdailyUser:
         logger.warning('login conditions not satisfied')
 
         # parse last response, search for error message
-        soup = BeautifulSoup(res.text, 'lxml')
-        error_msg = soup.select('#errorMsg')
-        if len(error_msg) > 0:
-            logger.warning('error message from server: {}'.format(error_msg[0].get_text()))
+        error_msg = parse_error_message(res.text)
+        if error_msg is not None:
+            logger.warning('error message from server: {}'.format(error_msg))
         logger.warning('login failed')
         return False
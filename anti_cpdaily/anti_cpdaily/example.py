@@ -1,12 +1,20 @@
 import getpass
 import base64
+import csv
 import json
 import asyncio
-from typing import Optional
+import time
+from copy import deepcopy
+from pathlib import Path
+from typing import Optional, Dict, List, Tuple
 from loguru import logger
 
 from anti_cpdaily.cpdaily import AsyncCpdailyUser
 from anti_cpdaily.task import AsyncCollectionTask
+from anti_cpdaily.task.collection import Form
+from anti_cpdaily.task.schema_cache import schema_cache
+from anti_cpdaily.school import tenant_cache
+from anti_cpdaily.persist import flush_all
 from anti_cpdaily.config import UserConfig
 
 
@@ -41,8 +49,8 @@ async def example_helper(
         print(log_in)
         collection_task = AsyncCollectionTask(user=user)
         await collection_task.fetch_form()
+        await collection_task.fetch_details(skip_handled=False)
         for form in collection_task.form_list:
-            await form.fetch_detail(root=user.school_api.get('amp_root'), client=user.client)
             form_example = form.generate_config()
             current_user.collections.append(form_example)
     config_path = config_path if config_path != None else '{}.config.json'.format(current_user.username)
@@ -56,6 +64,128 @@ def generate_config(*args, **kwargs):
     loop.run_until_complete(example_helper(*args, **kwargs))
 
 
+def load_credentials(path: str) -> List[UserConfig]:
+    """read users from a CSV(with a header) or JSON lines file
+
+    Columns/keys are the ones of a config: `username`, `password`,
+    `school_name`, and optionally `qq`, `address`, `longitude`, `latitude`.
+    Invalid rows are skipped.
+    """
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        if path.endswith('.csv'):
+            # empty cells are missing values
+            rows = [{key: value for key, value in row.items() if value not in (None, '')} for row in csv.DictReader(f)]
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+    users = list()
+    for idx, row in enumerate(rows):
+        try:
+            users.append(UserConfig(**row))
+        except Exception as e:
+            logger.error('invalid credential at row {}: {}'.format(idx + 1, repr(e)))
+    return users
+
+
+class _ExampleCache:
+    """form examples by schema, users of a class share them"""
+
+    def __init__(self):
+        self._examples: Dict[Tuple, Dict] = dict()
+        self.hits = 0
+
+    def generate(self, form: Form) -> Optional[Dict]:
+        if form.schema_version is None:
+            return form.generate_config()
+        key = (form.form_wid, form.schema_version, form.subject)
+        example = self._examples.get(key)
+        if example is None:
+            example = self._examples[key] = form.generate_config()
+        else:
+            self.hits += 1
+        return deepcopy(example)  # edited by hand later, don't share it
+
+
+async def bulk_example_helper(
+    credentials_file: str,
+    output_path: str = '.',
+    concurrency: int = 8,
+    school_concurrency: int = 4,
+    cache_path: Optional[str] = None,
+    overwrite: bool = False) -> Dict[str, Optional[str]]:
+    """generate the config templates of many users at once
+
+    Args:
+        credentials_file (str): CSV or JSON lines file of credentials, see `load_credentials`
+        output_path (str, optional): folder of the generated `{username}.config.json`. Defaults to '.'.
+        concurrency (int, optional): max users logged in at the same time. Defaults to 8.
+        school_concurrency (int, optional): max users of one school logged in at the same time. Defaults to 4.
+        cache_path (Optional[str], optional): cache folder of the school list and form fields, e.g. the plugin one. Defaults to None(memory only).
+        overwrite (bool, optional): generate existing configs again. Defaults to False.
+
+    Returns:
+        Dict[str, Optional[str]]: username -> config file, None if it failed
+    """
+    users = load_credentials(credentials_file)
+    output_path = Path(output_path)
+    output_path.mkdir(parents=True, exist_ok=True)
+    if cache_path is not None:
+        tenant_cache.persist_to(Path(cache_path) / 'tenants.json')
+        schema_cache.persist_to(Path(cache_path) / 'forms.json')
+    examples = _ExampleCache()
+    global_slots = asyncio.Semaphore(max(1, concurrency))
+    school_slots: Dict[str, asyncio.Semaphore] = dict()
+    results: Dict[str, Optional[str]] = dict()
+    start = time.perf_counter()
+
+    async def onboard(current_user: UserConfig):
+        config_path = output_path / '{}.config.json'.format(current_user.username)
+        if config_path.exists() and not overwrite:
+            logger.info('config of {} exists, skipped'.format(current_user.username))
+            results[current_user.username] = str(config_path)
+            return
+        school = school_slots.setdefault(current_user.school_name, asyncio.Semaphore(max(1, school_concurrency)))
+        try:
+            async with school, global_slots:
+                async with AsyncCpdailyUser(
+                        username=current_user.username,
+                        password=current_user.password,
+                        school_name=current_user.school_name
+                    ) as user:
+                    if not await user.login():
+                        raise RuntimeError('login failed')
+                    collection_task = AsyncCollectionTask(user=user)
+                    await collection_task.fetch_form()
+                    await collection_task.fetch_details(skip_handled=False)
+            for form in collection_task.form_list:
+                form_example = examples.generate(form)
+                if form_example is not None:
+                    current_user.collections.append(form_example)
+            with open(config_path, 'w', encoding='utf-8') as f:
+                json.dump(current_user.dict(), f, ensure_ascii=False, indent='  ')
+            results[current_user.username] = str(config_path)
+        except Exception as e:
+            logger.error('cannot generate config of {}: {}'.format(current_user.username, repr(e)))
+            results[current_user.username] = None
+        logger.info('[{}/{}] {} done, {:.1f}s elapsed'.format(
+            len(results), len(users), current_user.username, time.perf_counter() - start))
+
+    await asyncio.gather(*[onboard(current_user) for current_user in users])
+    flush_all()
+    failed = [username for username, config_path in results.items() if config_path is None]
+    logger.info('{} config(s) generated in {:.1f}s, {} failed, {} form example(s) reused'.format(
+        len(results) - len(failed), time.perf_counter() - start, len(failed), examples.hits))
+    if len(failed) > 0:
+        logger.warning('failed users: {}'.format(', '.join(failed)))
+    return results
+
+
+def bulk_generate_config(*args, **kwargs) -> Dict[str, Optional[str]]:
+    """warpper for `bulk_example_helper`
+    """
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete(bulk_example_helper(*args, **kwargs))
+
+
 async def fill_and_submit_collections(data_file: str):
     """fill collections using external data
 
@@ -78,8 +208,8 @@ async def fill_and_submit_collections(data_file: str):
         
         collection_task = AsyncCollectionTask(user=cpduser)
         await collection_task.fetch_form()
+        await collection_task.fetch_details(skip_handled=False)
         for form in collection_task.form_list:
-            await form.fetch_detail(root=cpduser.school_api.get('amp_root'), client=cpduser.client)
             if form.fill_form(current_user.dict()):
                 logger.success('form({}) filled'.format(form.subject))
                 logger.info('try to submit collection({})'.format(form.subject))
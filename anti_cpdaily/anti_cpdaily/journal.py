@@ -0,0 +1,240 @@
+from typing import Optional, Set, Union, List, Tuple, Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+import asyncio
+import sqlite3
+import time
+from loguru import logger
+
+
+# user states
+USER_STARTED = 'started'
+USER_LOGGED_IN = 'logged_in'
+USER_DONE = 'done'  # every open form submitted
+USER_IDLE = 'idle'  # nothing submitted, to be checked again
+USER_FAILED = 'failed'
+_USER_OUTCOMES = (USER_DONE, USER_IDLE, USER_FAILED)
+# form states
+FORM_FILLED = 'filled'
+FORM_MISBEHAVE = 'misbehave'
+FORM_SUBMITTED = 'submitted'
+FORM_REJECTED = 'rejected'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    started REAL NOT NULL,
+    finished REAL
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id TEXT NOT NULL,
+    username TEXT NOT NULL,
+    form TEXT,
+    state TEXT NOT NULL,
+    code TEXT,
+    message TEXT,
+    time REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_run_user ON events (run_id, username);
+'''
+
+
+def form_key(wid: Optional[str], instance_wid: Optional[int]) -> str:
+    """identify a form instance within a run"""
+    return '{}/{}'.format(wid, instance_wid)
+
+
+class RunJournal:
+    """append-only journal of runs, users and forms in SQLite
+
+    Users finished in a run are skipped without any request when the run is
+    resumed, and submitted forms are not submitted again. Nothing is recorded
+    if `path` is None.
+
+    The database is used from a single thread of its own: writes are queued
+    without waiting, so a file locked by another process doesn't stall the
+    event loop, and reads come after the writes queued before them.
+    """
+
+    path: Optional[Path]
+
+    def __init__(self, path: Optional[Union[str, Path]] = None):
+        """
+        Args:
+            path (Optional[Union[str, Path]], optional): database file. Defaults to None(disabled).
+        """
+        self.path = None
+        self._db: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        if path is not None:
+            self.persist_to(path)
+
+    def persist_to(self, path: Union[str, Path]):
+        """set the database file and open it"""
+        self.close()
+        self.path = Path(path)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='anti_cpdaily_journal')
+        self._db = self._executor.submit(self._open, self.path).result()
+
+    @staticmethod
+    def _open(path: Path) -> Optional[sqlite3.Connection]:
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(str(path), timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')  # durable enough with WAL, much faster
+            db.executescript(_SCHEMA)
+            return db
+        except sqlite3.Error as e:
+            logger.error('cannot open run journal: {}'.format(repr(e)))
+            return None
+
+    @property
+    def enabled(self) -> bool:
+        return self._db is not None
+
+    def close(self):
+        """write what is queued and close the database"""
+        if self._executor is not None:
+            if self._db is not None:
+                self._executor.submit(self._db.close).result()
+            self._executor.shutdown(wait=True)
+        self._db = None
+        self._executor = None
+
+    def _write(self, query: str, params: Tuple):
+        try:
+            self._db.execute(query, params)
+        except sqlite3.Error as e:
+            logger.warning('cannot write run journal: {}'.format(repr(e)))
+
+    def _queue(self, query: str, params: Tuple):
+        """write in the journal thread, without waiting"""
+        if self.enabled:
+            self._executor.submit(self._write, query, params)
+
+    def _read(self, func: Callable, *args) -> Future:
+        return self._executor.submit(func, *args)
+
+    def begin_run(self, run_id: str) -> str:
+        """start a run, or continue it if it exists"""
+        self._queue('INSERT OR IGNORE INTO runs (run_id, started) VALUES (?, ?)', (run_id, time.time()))
+        return run_id
+
+    def finish_run(self, run_id: str):
+        self._queue('UPDATE runs SET finished = ? WHERE run_id = ?', (time.time(), run_id))
+
+    def latest_unfinished_run(self, max_age: Optional[float] = None, prefix: str = '') -> Optional[str]:
+        """the last run not finished
+
+        Args:
+            max_age (Optional[float], optional): ignore runs started more than `max_age` seconds ago. Defaults to None.
+            prefix (str, optional): only runs whose id starts with it, eg. 'cron-'. Defaults to ''(any run).
+        """
+        if not self.enabled:
+            return None
+        since = time.time() - max_age if max_age is not None else 0.0
+
+        def query() -> Optional[str]:
+            row = self._db.execute(
+                'SELECT run_id FROM runs WHERE finished IS NULL AND started >= ? AND substr(run_id, 1, ?) = ? '
+                'ORDER BY started DESC LIMIT 1',
+                (since, len(prefix), prefix)
+            ).fetchone()
+            return row[0] if row is not None else None
+
+        return self._read(query).result()
+
+    def record(self,
+        run_id: Optional[str],
+        username: str,
+        state: str,
+        form: Optional[str] = None,
+        code: Optional[str] = None,
+        message: Optional[str] = None):
+        """append an event, written in the journal thread
+
+        Args:
+            run_id (Optional[str]): run, nothing is recorded if None
+            username (str): user
+            state (str): user or form state, see the constants
+            form (Optional[str], optional): form key, see `form_key`. Defaults to None(a user event).
+            code (Optional[str], optional): server code. Defaults to None.
+            message (Optional[str], optional): server message or error. Defaults to None.
+        """
+        if run_id is None:
+            return
+        self._queue(
+            'INSERT INTO events (run_id, username, form, state, code, message, time) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (run_id, username, form, state, code, message, time.time())
+        )
+
+    def _completed_users(self, run_id: str) -> Set[str]:
+        rows = self._db.execute(
+            'SELECT username, state FROM events WHERE run_id = ? AND form IS NULL AND state IN (?, ?, ?) ORDER BY id',
+            (run_id, *_USER_OUTCOMES)
+        )
+        outcomes = dict(rows.fetchall())  # the last one of each user wins
+        return {username for username, state in outcomes.items() if state == USER_DONE}
+
+    def completed_users(self, run_id: Optional[str]) -> Set[str]:
+        """users whose last outcome in a run is done"""
+        if not self.enabled or run_id is None:
+            return set()
+        return self._read(self._completed_users, run_id).result()
+
+    def _is_done(self, run_id: str, username: str) -> bool:
+        row = self._db.execute(
+            'SELECT state FROM events WHERE run_id = ? AND username = ? AND form IS NULL AND state IN (?, ?, ?) ORDER BY id DESC LIMIT 1',
+            (run_id, username, *_USER_OUTCOMES)
+        ).fetchone()
+        return row is not None and row[0] == USER_DONE
+
+    def is_done(self, run_id: Optional[str], username: str) -> bool:
+        """if the last outcome of a user in a run is done, a later idle one reopens it"""
+        if not self.enabled or run_id is None:
+            return False
+        return self._read(self._is_done, run_id, username).result()
+
+    async def is_done_async(self, run_id: Optional[str], username: str) -> bool:
+        """`is_done` without blocking the event loop"""
+        if not self.enabled or run_id is None:
+            return False
+        return await asyncio.wrap_future(self._read(self._is_done, run_id, username))
+
+    def _submitted_forms(self, run_id: str, username: str) -> Set[str]:
+        rows = self._db.execute(
+            'SELECT DISTINCT form FROM events WHERE run_id = ? AND username = ? AND state = ?',
+            (run_id, username, FORM_SUBMITTED)
+        )
+        return {row[0] for row in rows}
+
+    def submitted_forms(self, run_id: Optional[str], username: str) -> Set[str]:
+        """forms of a user submitted in a run"""
+        if not self.enabled or run_id is None:
+            return set()
+        return self._read(self._submitted_forms, run_id, username).result()
+
+    async def submitted_forms_async(self, run_id: Optional[str], username: str) -> Set[str]:
+        """`submitted_forms` without blocking the event loop"""
+        if not self.enabled or run_id is None:
+            return set()
+        return await asyncio.wrap_future(self._read(self._submitted_forms, run_id, username))
+
+    def events(self, run_id: str, username: Optional[str] = None) -> List[Tuple]:
+        """events of a run, oldest first
+
+        Returns:
+            List[Tuple]: (username, form, state, code, message, time)
+        """
+        if not self.enabled:
+            return list()
+        if username is None:
+            query, params = 'SELECT username, form, state, code, message, time FROM events WHERE run_id = ? ORDER BY id', (run_id,)
+        else:
+            query, params = 'SELECT username, form, state, code, message, time FROM events WHERE run_id = ? AND username = ? ORDER BY id', (run_id, username)
+        return self._read(lambda: list(self._db.execute(query, params))).result()
+
+
+run_journal = RunJournal()
@@ -0,0 +1,78 @@
+from typing import Optional, Dict
+from dataclasses import dataclass, field
+import re
+from lxml import etree, html
+
+
+# compiled once, evaluated on every login
+_XPATH_LOGIN_FORM = etree.XPath("//*[@id='casLoginForm']")
+_XPATH_LOGIN_INPUTS = etree.XPath("//*[@id='casLoginForm']/input")
+_XPATH_SALT = etree.XPath("//*[@id='pwdDefaultEncryptSalt']")
+_XPATH_ERROR_MSG = etree.XPath("//*[@id='errorMsg']")
+_RE_SALT_JS = re.compile(r'(?<=var pwdDefaultEncryptSalt = ")\w{16}(?=")')
+
+
+@dataclass
+class LoginPage:
+    """what the CAS login needs from the login page"""
+
+    form_found: bool = False
+    fields: Dict[str, str] = field(default_factory=dict)  # named inputs of the login form
+    salt: Optional[str] = None
+    salt_source: Optional[str] = None  # 'html' or 'javascript'
+
+
+def _parse_html(raw_html: str) -> Optional[etree._Element]:
+    try:
+        return html.fromstring(raw_html)
+    except (etree.ParserError, ValueError):  # empty or not html at all
+        return None
+
+
+def parse_login_page(raw_html: str) -> LoginPage:
+    """extract the login form fields and the password salt
+
+    Args:
+        raw_html (str): the login page
+
+    Returns:
+        LoginPage: fields found, `form_found` is False if there is no login form
+    """
+    page = LoginPage()
+    root = _parse_html(raw_html)
+    if root is not None:
+        page.form_found = len(_XPATH_LOGIN_FORM(root)) > 0
+        for entry in _XPATH_LOGIN_INPUTS(root):
+            entry_name = entry.get('name', '')
+            if entry_name:
+                page.fields[entry_name] = entry.get('value', '')
+        salt_tags = _XPATH_SALT(root)
+        if len(salt_tags) > 0:
+            # for desktop, salt is stored in an html element
+            page.salt = salt_tags[0].get('value')
+            page.salt_source = 'html'
+            return page
+    # on mobile, the salt is stored in a javascript variable
+    salt_result = _RE_SALT_JS.search(raw_html)
+    if salt_result is not None:
+        page.salt = salt_result[0]
+        page.salt_source = 'javascript'
+    return page
+
+
+def parse_error_message(raw_html: str) -> Optional[str]:
+    """find the error message on a failed login page
+
+    Args:
+        raw_html (str): the page after posting the login form
+
+    Returns:
+        Optional[str]: the message, None if not found
+    """
+    root = _parse_html(raw_html)
+    if root is None:
+        return None
+    error_msg = _XPATH_ERROR_MSG(root)
+    if len(error_msg) > 0:
+        return error_msg[0].text_content()
+    return None
@@ -0,0 +1,197 @@
+from typing import Optional, Dict, List, Tuple, Sequence
+from contextvars import ContextVar
+from pathlib import Path
+import bisect
+import os
+import time
+import asyncio
+from loguru import logger
+
+
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# school of the user being processed, used when a stage doesn't know it
+current_school: ContextVar[str] = ContextVar('anti_cpdaily_current_school', default='unknown')
+
+
+class Histogram:
+    """cumulative histogram in the Prometheus way"""
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * len(self.buckets)  # not cumulative, see `cumulative`
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        idx = bisect.bisect_left(self.buckets, value)
+        if idx < len(self.counts):
+            self.counts[idx] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[int]:
+        result = list()
+        total = 0
+        for count in self.counts:
+            total += count
+            result.append(total)
+        return result
+
+    def quantile(self, q: float) -> float:
+        """estimated quantile, the upper bound of the bucket reaching it"""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        for bound, total in zip(self.buckets, self.cumulative()):
+            if total >= rank:
+                return bound
+        return float('inf')
+
+
+class _StageTimer:
+
+    def __init__(self, registry: 'MetricsRegistry', stage: str, school: Optional[str]):
+        self.registry = registry
+        self.stage = stage
+        self.school = school
+        self.outcome = 'ok'  # may be changed inside the block
+
+    def __enter__(self) -> '_StageTimer':
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None and self.outcome == 'ok':
+            self.outcome = 'cancelled' if issubclass(exc_type, asyncio.CancelledError) else 'error'
+        self.registry.observe(self.stage, time.perf_counter() - self._start, self.school, self.outcome)
+        return False
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in labels) + '}'
+
+
+class MetricsRegistry:
+    """stage durations and counters, labeled by school and outcome
+
+    Stages are timed with `stage`:
+
+        with metrics.stage('login', school) as timer:
+            ...
+            timer.outcome = 'failed'  # optional, exceptions give 'error'
+
+    `render` gives the Prometheus text format.
+    """
+
+    prefix: str
+
+    def __init__(self, prefix: str = 'anti_cpdaily', buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self._histograms: Dict[Tuple[str, str, str], Histogram] = dict()  # (stage, school, outcome)
+        self._counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = dict()  # (name, labels)
+        self._help: Dict[str, str] = dict()
+
+    def stage(self, stage: str, school: Optional[str] = None) -> _StageTimer:
+        """time a stage
+
+        Args:
+            stage (str): stage name, e.g. 'login_page'
+            school (Optional[str], optional): school name. Defaults to None(`current_school`).
+        """
+        return _StageTimer(self, stage, school)
+
+    def observe(self, stage: str, seconds: float, school: Optional[str] = None, outcome: str = 'ok'):
+        key = (stage, school if school is not None else current_school.get(), outcome)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram(self.buckets)
+        histogram.observe(seconds)
+
+    def inc(self, name: str, value: float = 1, help: Optional[str] = None, **labels: str):
+        """increase a counter
+
+        Args:
+            name (str): counter name without prefix, e.g. 'forms_total'
+            value (float, optional): amount. Defaults to 1.
+            help (Optional[str], optional): description shown in the export. Defaults to None.
+        """
+        if 'school' not in labels:
+            labels['school'] = current_school.get()
+        key = (name, tuple(sorted((label, str(label_value)) for label, label_value in labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + value
+        if help is not None:
+            self._help.setdefault(name, help)
+
+    def render(self) -> str:
+        """metrics in the Prometheus text format"""
+        lines = list()
+        name = '{}_stage_duration_seconds'.format(self.prefix)
+        lines.append('# HELP {} duration of each processing stage'.format(name))
+        lines.append('# TYPE {} histogram'.format(name))
+        for (stage, school, outcome), histogram in sorted(self._histograms.items()):
+            labels = (('stage', stage), ('school', school), ('outcome', outcome))
+            for bound, total in zip(histogram.buckets, histogram.cumulative()):
+                lines.append('{}_bucket{} {}'.format(name, _format_labels(labels + (('le', repr(bound)),)), total))
+            lines.append('{}_bucket{} {}'.format(name, _format_labels(labels + (('le', '+Inf'),)), histogram.count))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(labels), repr(histogram.sum)))
+            lines.append('{}_count{} {}'.format(name, _format_labels(labels), histogram.count))
+
+        counter_names = sorted({counter for counter, _ in self._counters})
+        for counter in counter_names:
+            name = '{}_{}'.format(self.prefix, counter)
+            if counter in self._help:
+                lines.append('# HELP {} {}'.format(name, self._help[counter]))
+            lines.append('# TYPE {} counter'.format(name))
+            for (other, labels), value in sorted(self._counters.items()):
+                if other == counter:
+                    lines.append('{}{} {}'.format(name, _format_labels(labels), repr(value)))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: Path):
+        """write `render` to a file, e.g. for the node exporter textfile collector"""
+        path = Path(path)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(path.suffix + '.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(self.render())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning('cannot write metrics: {}'.format(repr(e)))
+
+    def summary(self) -> List[Tuple[str, int, int, float, float, float]]:
+        """per stage summary over schools
+
+        Returns:
+            List[Tuple[str, int, int, float, float, float]]: (stage, count, errors, mean, p50, p99), in seconds
+        """
+        stages: Dict[str, Histogram] = dict()
+        errors: Dict[str, int] = dict()
+        for (stage, _, outcome), histogram in self._histograms.items():
+            merged = stages.get(stage)
+            if merged is None:
+                merged = stages[stage] = Histogram(self.buckets)
+            merged.counts = [a + b for a, b in zip(merged.counts, histogram.counts)]
+            merged.sum += histogram.sum
+            merged.count += histogram.count
+            if outcome != 'ok':
+                errors[stage] = errors.get(stage, 0) + histogram.count
+        return [
+            (stage, merged.count, errors.get(stage, 0), merged.sum / max(1, merged.count), merged.quantile(0.5), merged.quantile(0.99))
+            for stage, merged in sorted(stages.items())
+        ]
+
+    def reset(self):
+        self._histograms.clear()
+        self._counters.clear()
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,93 @@
+from typing import Optional, Any, Callable, Union
+from pathlib import Path
+import asyncio
+import json
+import os
+import threading
+import weakref
+from loguru import logger
+
+
+# every cache file, for `flush_all`
+_files: 'weakref.WeakSet[JsonFile]' = weakref.WeakSet()
+
+
+class JsonFile:
+    """JSON file of a cache, written in a thread
+
+    Changes are batched over `save_delay` seconds, so a burst of changes is
+    written once without blocking the event loop. Without a running loop they
+    are written at once. Call `flush`(or `flush_all`) before exiting.
+    """
+
+    path: Path
+
+    def __init__(self, path: Union[str, Path], snapshot: Callable[[], Any], name: str, save_delay: float = 5.0):
+        """
+        Args:
+            path (Union[str, Path]): the file
+            snapshot (Callable[[], Any]): JSON compatible data to write, called on the loop
+            name (str): what is saved, for the logs
+            save_delay (float, optional): seconds changes are batched over before being written. Defaults to 5.0.
+        """
+        self.path = Path(path)
+        self.name = name
+        self.save_delay = save_delay
+        self._snapshot = snapshot
+        self._dirty = False
+        self._saving: Optional[asyncio.Task] = None
+        self._write_lock = threading.Lock()  # the executor and `flush` may write at once
+        _files.add(self)
+
+    def load(self) -> Optional[Any]:
+        """the content of the file, None if missing or unreadable"""
+        if not self.path.exists():
+            return None
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning('cannot load {}: {}'.format(self.name, repr(e)))
+            return None
+
+    def _write(self, data: Any):
+        with self._write_lock:
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                # a temporary file per process, worker processes write the same file
+                tmp_path = self.path.with_suffix('{}.{}.tmp'.format(self.path.suffix, os.getpid()))
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                logger.warning('cannot save {}: {}'.format(self.name, repr(e)))
+
+    def save(self):
+        """write the changes soon"""
+        self._dirty = True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:  # no loop to batch on
+            self.flush()
+            return
+        if self._saving is None or self._saving.done():
+            self._saving = loop.create_task(self._save_later())
+
+    async def _save_later(self):
+        await asyncio.sleep(self.save_delay)
+        while self._dirty:
+            self._dirty = False
+            await asyncio.get_running_loop().run_in_executor(None, self._write, self._snapshot())
+
+    def flush(self):
+        """write the pending changes now"""
+        if not self._dirty:
+            return
+        self._dirty = False
+        self._write(self._snapshot())
+
+
+def flush_all():
+    """write the pending changes of every cache file"""
+    for file in list(_files):
+        file.flush()
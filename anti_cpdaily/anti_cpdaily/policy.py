@@ -0,0 +1,206 @@
+from typing import Optional, Dict, FrozenSet, Callable, Awaitable
+from dataclasses import dataclass, asdict
+import asyncio
+import random
+import time
+from httpx import AsyncBaseTransport, Request, Response, Timeout, TransportError
+from loguru import logger
+
+from .constant import URI_FORM_LIST, URI_FORM_DETAIL, URI_FORM_ENTRIES
+
+
+# POST requests that only read data, safe to send again
+IDEMPOTENT_POSTS = frozenset({URI_FORM_LIST, URI_FORM_DETAIL, URI_FORM_ENTRIES})
+# GET requests with side effects, never sent twice
+NON_IDEMPOTENT_GETS = frozenset({'/authserver/verifySliderImageCode.do'})  # consumes the captcha
+RETRY_STATUS = frozenset({429, 502, 503, 504})
+
+
+class CircuitOpenError(TransportError):
+    """the host failed too often recently, the request was not sent"""
+
+
+@dataclass
+class PolicyStats:
+    retries: int = 0
+    failures: int = 0  # transport errors and 5xx responses
+    rejected: int = 0  # requests refused by an open circuit
+
+    def as_dict(self) -> Dict:
+        return asdict(self)
+
+
+class _CircuitBreaker:
+    """opens after `threshold` failures in a row, then lets a single probe
+    through after `cooldown` seconds, the probe failing opens it once more"""
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probe_at: Optional[float] = None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self.opened_at < self.cooldown:
+            return False
+        # half open, one probe at a time, another one if it never came back
+        if self.probe_at is not None and now - self.probe_at < self.cooldown:
+            return False
+        self.probe_at = now
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probe_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.threshold > 0 and self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+            self.probe_at = None
+
+
+class RequestPolicy:
+    """timeouts, retries and per-host circuit breakers of all cpdaily requests
+
+    Only idempotent requests(GET and the read-only form POSTs) are retried,
+    with exponential backoff. Breakers are kept here, so share one policy to
+    share them between users.
+    """
+
+    stats: PolicyStats
+
+    def __init__(self,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 15.0,
+        retries: int = 3,
+        backoff: float = 0.5,
+        backoff_max: float = 8.0,
+        breaker_threshold: int = 5,
+        breaker_cooldown: float = 60.0,
+        idempotent_posts: FrozenSet[str] = IDEMPOTENT_POSTS):
+        """
+        Args:
+            connect_timeout (float, optional): seconds to open a connection. Defaults to 5.0.
+            read_timeout (float, optional): seconds to wait for response data. Defaults to 15.0.
+            retries (int, optional): retries of an idempotent request. Defaults to 3.
+            backoff (float, optional): delay in seconds before the first retry, doubled each time. Defaults to 0.5.
+            backoff_max (float, optional): max delay in seconds between retries. Defaults to 8.0.
+            breaker_threshold (int, optional): failures in a row opening a host's circuit, 0 to disable. Defaults to 5.
+            breaker_cooldown (float, optional): seconds a circuit stays open. Defaults to 60.0.
+            idempotent_posts (FrozenSet[str], optional): paths of POST requests safe to retry. Defaults to IDEMPOTENT_POSTS.
+        """
+        self.stats = PolicyStats()
+        self._breakers: Dict[str, _CircuitBreaker] = dict()
+        self.configure(
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+            retries=retries,
+            backoff=backoff,
+            backoff_max=backoff_max,
+            breaker_threshold=breaker_threshold,
+            breaker_cooldown=breaker_cooldown,
+            idempotent_posts=idempotent_posts
+        )
+
+    def configure(self,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 15.0,
+        retries: int = 3,
+        backoff: float = 0.5,
+        backoff_max: float = 8.0,
+        breaker_threshold: int = 5,
+        breaker_cooldown: float = 60.0,
+        idempotent_posts: FrozenSet[str] = IDEMPOTENT_POSTS):
+        """change the settings, breakers are reset"""
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.idempotent_posts = frozenset(idempotent_posts)
+        self._breakers = dict()
+
+    def timeout(self) -> Timeout:
+        return Timeout(self.read_timeout, connect=self.connect_timeout)
+
+    def is_idempotent(self, request: Request) -> bool:
+        if request.method in {'GET', 'HEAD', 'OPTIONS'}:
+            return request.url.path not in NON_IDEMPOTENT_GETS
+        return request.method == 'POST' and request.url.path in self.idempotent_posts
+
+    def backoff_delay(self, attempt: int) -> float:
+        """jittered delay before retry `attempt`(starting from 1)"""
+        delay = min(self.backoff * 2 ** (attempt - 1), self.backoff_max)
+        return delay * random.uniform(0.5, 1.0)
+
+    def breaker(self, host: str) -> _CircuitBreaker:
+        breaker = self._breakers.get(host)
+        if breaker is None:
+            breaker = self._breakers[host] = _CircuitBreaker(self.breaker_threshold, self.breaker_cooldown)
+        return breaker
+
+    def reset_stats(self):
+        self.stats = PolicyStats()
+
+
+class PolicyTransport(AsyncBaseTransport):
+    """applies a `RequestPolicy` on top of another transport
+
+    `throttle` is awaited before every attempt, retries and redirects included.
+    """
+
+    def __init__(self,
+        transport: AsyncBaseTransport,
+        policy: RequestPolicy,
+        throttle: Optional[Callable[[Request], Awaitable]] = None):
+        self.transport = transport
+        self.policy = policy
+        self.throttle = throttle
+
+    async def handle_async_request(self, request: Request) -> Response:
+        policy = self.policy
+        host = request.url.host
+        breaker = policy.breaker(host)
+        retries = policy.retries if policy.is_idempotent(request) else 0
+        attempt = 0
+        while True:
+            if self.throttle is not None:
+                await self.throttle(request)
+            if not breaker.allow():
+                policy.stats.rejected += 1
+                raise CircuitOpenError('circuit open for {}'.format(host), request=request)
+            try:
+                response = await self.transport.handle_async_request(request)
+            except TransportError as e:  # timeouts included
+                breaker.record_failure()
+                policy.stats.failures += 1
+                if attempt >= retries:
+                    raise
+                logger.debug('{} {} failed: {}'.format(request.method, request.url, repr(e)))
+            else:
+                if response.status_code >= 500:
+                    breaker.record_failure()
+                    policy.stats.failures += 1
+                else:
+                    breaker.record_success()
+                if response.status_code not in RETRY_STATUS or attempt >= retries:
+                    return response
+                logger.debug('{} {} got status {}'.format(request.method, request.url, response.status_code))
+                await response.aclose()
+            attempt += 1
+            policy.stats.retries += 1
+            await asyncio.sleep(policy.backoff_delay(attempt))
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+request_policy = RequestPolicy()
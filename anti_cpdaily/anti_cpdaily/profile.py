@@ -0,0 +1,132 @@
+from typing import Optional, Dict, List, Tuple, Union
+from dataclasses import dataclass
+from pathlib import Path
+import asyncio
+import hashlib
+import json
+import os
+from loguru import logger
+
+from .config import UserConfig
+
+
+@dataclass
+class _ProfileEntry:
+    mtime_ns: int
+    size: int
+    digest: str
+    config: Optional[UserConfig]  # None if the file is invalid
+
+
+class ProfileRegistry:
+    """user profiles(`*config.json`) of a folder, parsed once and kept in memory
+
+    `refresh` compares the files' stats with the last ones and only reads the
+    changed files, a file whose content hash didn't change is not parsed again.
+    Invalid files are skipped and reported in `errors`.
+    """
+
+    path: Path
+    suffix: str
+    errors: Dict[str, str]  # file name -> error
+
+    def __init__(self, path: Union[str, Path], suffix: str = 'config.json'):
+        """
+        Args:
+            path (Union[str, Path]): profile folder
+            suffix (str, optional): suffix of profile files. Defaults to 'config.json'.
+        """
+        self.path = Path(path)
+        self.suffix = suffix
+        self.errors = dict()
+        self._entries: Dict[str, _ProfileEntry] = dict()
+        self._lock: Optional[asyncio.Lock] = None
+
+    def refresh(self) -> Tuple[int, int, int]:
+        """reload changed profiles
+
+        Returns:
+            Tuple[int, int, int]: count of added, changed and removed files
+        """
+        self._entries, self.errors, counts = self._scan(self._entries, self.errors)
+        return counts
+
+    def _scan(self,
+        entries: Dict[str, _ProfileEntry],
+        errors: Dict[str, str]) -> Tuple[Dict[str, _ProfileEntry], Dict[str, str], Tuple[int, int, int]]:
+        """read the folder into new dicts, the given ones are left untouched
+
+        Returns:
+            Tuple[Dict[str, _ProfileEntry], Dict[str, str], Tuple[int, int, int]]: entries, errors and counts
+        """
+        entries = dict(entries)
+        errors = dict(errors)
+        added = changed = 0
+        seen = set()
+        try:
+            dir_entries = list(os.scandir(self.path))
+        except OSError as e:
+            logger.error('cannot list profiles: {}'.format(repr(e)))
+            return entries, errors, (0, 0, 0)
+        for dir_entry in dir_entries:
+            if not dir_entry.name.endswith(self.suffix) or not dir_entry.is_file():
+                continue
+            seen.add(dir_entry.name)
+            stat = dir_entry.stat()
+            entry = entries.get(dir_entry.name)
+            if entry is not None and entry.mtime_ns == stat.st_mtime_ns and entry.size == stat.st_size:
+                continue
+            new_entry = self._load(dir_entry.name, stat, entry, errors)
+            if new_entry is None:
+                continue
+            if entry is None:
+                added += 1
+            elif new_entry.digest != entry.digest:
+                changed += 1
+            entries[dir_entry.name] = new_entry
+
+        removed = [name for name in entries if name not in seen]
+        for name in removed:
+            del entries[name]
+            errors.pop(name, None)
+        if added or changed or removed:
+            logger.info('profiles reloaded: {} added, {} changed, {} removed'.format(added, changed, len(removed)))
+        return entries, errors, (added, changed, len(removed))
+
+    def _load(self, name: str, stat: os.stat_result, entry: Optional[_ProfileEntry], errors: Dict[str, str]) -> Optional[_ProfileEntry]:
+        try:
+            with open(self.path / name, 'rb') as f:
+                raw = f.read()
+        except OSError as e:
+            logger.warning('cannot read profile {}: {}'.format(name, repr(e)))
+            return None
+        digest = hashlib.md5(raw).hexdigest()
+        if entry is not None and entry.digest == digest:  # touched only
+            return _ProfileEntry(stat.st_mtime_ns, stat.st_size, digest, entry.config)
+        try:
+            config = UserConfig(**json.loads(raw.decode('utf-8')))
+            errors.pop(name, None)
+        except Exception as e:
+            logger.error('invalid profile {}: {}'.format(name, repr(e)))
+            errors[name] = repr(e)
+            config = None
+        return _ProfileEntry(stat.st_mtime_ns, stat.st_size, digest, config)
+
+    async def refresh_async(self) -> Tuple[int, int, int]:
+        """`refresh` in a thread, without blocking the event loop
+
+        The thread works on copies, readers on the loop never see a half refreshed state.
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            entries, errors, counts = await asyncio.get_running_loop().run_in_executor(
+                None, self._scan, self._entries, self.errors
+            )
+            self._entries, self.errors = entries, errors  # swapped on the loop
+            return counts
+
+    @property
+    def users(self) -> List[UserConfig]:
+        """valid profiles, ordered by file name"""
+        return [entry.config for _, entry in sorted(self._entries.items()) if entry.config is not None]
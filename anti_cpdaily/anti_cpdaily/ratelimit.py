@@ -0,0 +1,117 @@
+from typing import Optional, Dict, Tuple
+from dataclasses import dataclass, asdict
+import asyncio
+import time
+from loguru import logger
+
+
+@dataclass
+class LimiterStats:
+    requests: int = 0
+    throttled: int = 0  # requests that had to wait
+    wait_time: float = 0.0  # seconds spent waiting for a token
+    max_wait: float = 0.0
+
+    def as_dict(self) -> Dict:
+        return asdict(self)
+
+
+class TokenBucket:
+    """token bucket refilled at `rate` tokens per second, holding up to `burst` tokens
+
+    Tokens are reserved rather than awaited, the bucket may go negative and the
+    caller sleeps for the returned delay. No lock is needed and waiters are
+    served in arrival order.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """take a token
+
+        Returns:
+            float: seconds to wait before the token is available
+        """
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= 1
+        if self._tokens >= 0:
+            return 0.0
+        return -self._tokens / self.rate
+
+
+class RateLimiter:
+    """token buckets keyed by host and tenant
+
+    All users of a school share the buckets of its hosts, so a burst of users
+    is smoothed out instead of being throttled by the servers.
+    """
+
+    stats: LimiterStats
+
+    def __init__(self, rate: float = 5.0, burst: float = 10, host_rates: Optional[Dict[str, float]] = None):
+        """
+        Args:
+            rate (float, optional): requests per second per host and tenant, 0 to disable. Defaults to 5.0.
+            burst (float, optional): requests allowed at once. Defaults to 10.
+            host_rates (Optional[Dict[str, float]], optional): rates of specific hosts. Defaults to None.
+        """
+        self.stats = LimiterStats()
+        self.wait_by_key: Dict[str, float] = dict()  # 'host|tenant' -> seconds waited
+        self._buckets: Dict[Tuple[str, Optional[str]], TokenBucket] = dict()
+        self.configure(rate=rate, burst=burst, host_rates=host_rates)
+
+    def configure(self, rate: float = 5.0, burst: float = 10, host_rates: Optional[Dict[str, float]] = None):
+        """change the rates, existing buckets are dropped"""
+        self.rate = rate
+        self.burst = burst
+        self.host_rates = dict(host_rates) if host_rates is not None else dict()
+        self._buckets = dict()
+
+    def _bucket(self, host: str, tenant: Optional[str]) -> Optional[TokenBucket]:
+        key = (host, tenant)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            rate = self.host_rates.get(host, self.rate)
+            if rate <= 0:  # unlimited
+                return None
+            bucket = self._buckets[key] = TokenBucket(rate, self.burst)
+        return bucket
+
+    async def acquire(self, host: str, tenant: Optional[str] = None) -> float:
+        """wait until a request to `host` is allowed
+
+        Args:
+            host (str): target host
+            tenant (Optional[str], optional): tenant the request is made for. Defaults to None.
+
+        Returns:
+            float: seconds waited
+        """
+        self.stats.requests += 1
+        bucket = self._bucket(host, tenant)
+        if bucket is None:
+            return 0.0
+        delay = bucket.reserve()
+        if delay <= 0:
+            return 0.0
+        self.stats.throttled += 1
+        self.stats.wait_time += delay
+        self.stats.max_wait = max(self.stats.max_wait, delay)
+        key = '{}|{}'.format(host, tenant)
+        self.wait_by_key[key] = self.wait_by_key.get(key, 0.0) + delay
+        logger.debug('request to {} delayed {:.3f}s'.format(host, delay))
+        await asyncio.sleep(delay)
+        return delay
+
+    def reset_stats(self):
+        self.stats = LimiterStats()
+        self.wait_by_key = dict()
+
+
+rate_limiter = RateLimiter()
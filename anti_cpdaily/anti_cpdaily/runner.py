@@ -0,0 +1,362 @@
+from typing import Optional, Dict, List, Tuple, Callable, Awaitable, Iterable
+from dataclasses import dataclass, field, asdict
+from datetime import datetime
+import asyncio
+import random
+import time
+from httpx import AsyncBaseTransport
+from loguru import logger
+
+from .cpdaily import AsyncCpdailyUser
+from .task import AsyncCollectionTask
+from .task.collection import Form
+from .task.submission import SubmissionContext
+from .config import UserConfig
+from .metrics import metrics, current_school
+from .tracing import tracer
+from .journal import RunJournal, form_key
+from .journal import USER_STARTED, USER_LOGGED_IN, USER_DONE, USER_IDLE, USER_FAILED
+from .journal import FORM_FILLED, FORM_MISBEHAVE, FORM_SUBMITTED, FORM_REJECTED
+
+
+STATUS_DRY_RUN = 'DryRun'  # filled but not submitted on purpose
+
+
+@dataclass
+class UserResult:
+    """outcome of processing one user"""
+
+    username: str
+    school_name: str
+    qq: Optional[int] = None
+    logged_in: bool = False
+    forms_status: List[Tuple[str, str]] = field(default_factory=list)
+    error: Optional[str] = None
+    elapsed: float = 0.0  # seconds spent on this user, waiting time excluded
+    open_forms: List[Tuple[datetime, datetime]] = field(default_factory=list)  # (start, end) of unhandled forms
+    handled_forms: List[Tuple[datetime, datetime]] = field(default_factory=list)  # (start, end) of forms handled before
+    skipped: bool = False  # already done in the journaled run, nothing was sent
+
+    @property
+    def finished(self) -> bool:
+        """every open form was submitted(or filled in a dry run)"""
+        return self.ok and all(status in {'OK', STATUS_DRY_RUN} for _, status in self.forms_status)
+
+    @property
+    def ok(self) -> bool:
+        return (self.logged_in or self.skipped) and self.error is None
+
+    def to_dict(self) -> Dict:
+        """JSON compatible dict"""
+        data = asdict(self)
+        for key in ('open_forms', 'handled_forms'):
+            data[key] = [
+                [start.isoformat() if start else None, end.isoformat() if end else None]
+                for start, end in getattr(self, key)
+            ]
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'UserResult':
+        """the reverse of `to_dict`"""
+        data = dict(data)
+        data['forms_status'] = [tuple(status) for status in data.get('forms_status', [])]
+        for key in ('open_forms', 'handled_forms'):
+            data[key] = [
+                (datetime.fromisoformat(start) if start else None, datetime.fromisoformat(end) if end else None)
+                for start, end in data.get(key, [])
+            ]
+        return cls(**data)
+
+
+async def process_user(
+    current_user: UserConfig,
+    form_concurrency: int = 4,
+    page_size: int = 20,
+    transport: Optional[AsyncBaseTransport] = None,
+    journal: Optional[RunJournal] = None,
+    run_id: Optional[str] = None,
+    dry_run: bool = False
+    ) -> UserResult:
+    """login, fetch, fill and submit collections for one user
+
+    Args:
+        current_user (UserConfig): user configuration
+        form_concurrency (int, optional): max form details fetched at the same time. Defaults to 4.
+        page_size (int, optional): forms per collection list request. Defaults to 20.
+        transport (Optional[AsyncBaseTransport], optional): transport of the user's client. Defaults to None(the shared pool).
+        journal (Optional[RunJournal], optional): journal to record progress and resume from. Defaults to None.
+        run_id (Optional[str], optional): run in the journal. Defaults to None(not journaled).
+        dry_run (bool, optional): fill the forms but don't submit them, nothing is journaled. Defaults to False.
+
+    Returns:
+        UserResult: the outcome, exceptions are recorded instead of raised
+
+    The log of a user not finished is written out at WARNING level. A user
+    already done in the journaled run is skipped without any request.
+    """
+    if journal is None or dry_run:
+        journal = RunJournal()  # a disabled one records nothing
+    if await journal.is_done_async(run_id, current_user.username):
+        logger.info('user {} already done in run {}, skipped'.format(current_user.username, run_id))
+        return UserResult(
+            username=current_user.username,
+            school_name=current_user.school_name,
+            qq=current_user.qq,
+            skipped=True
+        )
+    with tracer.trace() as trace:
+        result = await _process_user(current_user, form_concurrency, page_size, transport, journal, run_id, dry_run)
+    if not result.finished:
+        state = USER_FAILED
+    elif len(result.forms_status) > 0:
+        state = USER_DONE
+    else:  # forms handled earlier don't tell if another one will be published
+        state = USER_IDLE
+    journal.record(run_id, result.username, state, message=result.error)
+    if trace is not None and not result.finished:
+        logger.opt(lazy=True).warning('trace of user {}:\n{}', lambda: result.username, trace.render)
+    metrics.observe('user', result.elapsed, outcome='ok' if result.ok else 'error')
+    metrics.inc('users_total', outcome='ok' if result.ok else 'error', help='users processed')
+    for _, status in result.forms_status:
+        metrics.inc('forms_total', outcome=status, help='forms handled, by submission status')
+    return result
+
+
+async def _process_user(
+    current_user: UserConfig,
+    form_concurrency: int,
+    page_size: int,
+    transport: Optional[AsyncBaseTransport],
+    journal: RunJournal,
+    run_id: Optional[str],
+    dry_run: bool
+    ) -> UserResult:
+    result = UserResult(
+        username=current_user.username,
+        school_name=current_user.school_name,
+        qq=current_user.qq
+    )
+    start = time.perf_counter()
+    current_school.set(current_user.school_name)  # label of the stages below
+    journal.record(run_id, current_user.username, USER_STARTED)
+    try:
+        async with AsyncCpdailyUser(
+            username=current_user.username,
+            password=current_user.password,
+            school_name=current_user.school_name,
+            transport=transport
+            ) as cpduser:
+
+            result.logged_in = await cpduser.login()
+            if not result.logged_in:
+                logger.error('login failed({})'.format(current_user.username))
+                result.error = 'login failed'
+                return result
+            journal.record(run_id, current_user.username, USER_LOGGED_IN)
+            submitted = await journal.submitted_forms_async(run_id, current_user.username)
+
+            collection_task = AsyncCollectionTask(user=cpduser)
+            root = cpduser.school_api.get('amp_root')
+            form_slots = asyncio.Semaphore(max(1, form_concurrency))
+            user_data = current_user.dict()
+            submission = SubmissionContext(user_data)  # device id and signature, once per user
+
+            async def handle_form(form: Form) -> Tuple[str, str]:
+                async with form_slots:
+                    await form.fetch_detail(root=root, client=cpduser.client)
+                with metrics.stage('fill') as timer:
+                    filled = form.fill_form(user_data)
+                    timer.outcome = 'ok' if filled else 'failed'
+                if not filled and form.schema_cached:
+                    logger.info('cannot fill form({}) with cached fields, fetching them again'.format(form.subject))
+                    await form.refetch_entries(root=root, client=cpduser.client)
+                    with metrics.stage('fill') as timer:
+                        filled = form.fill_form(user_data)
+                        timer.outcome = 'ok' if filled else 'failed'
+                key = form_key(form.wid, form.instance_wid)
+                if filled:
+                    logger.success('form({}) filled'.format(form.subject))
+                    journal.record(run_id, current_user.username, FORM_FILLED, form=key)
+                    if dry_run:
+                        logger.info('dry run, collection({}) not submitted'.format(form.subject))
+                        return (form.subject, STATUS_DRY_RUN)
+                    logger.info('try to submit collection({})'.format(form.subject))
+                    submission_status = await form.post_form(apis=cpduser.school_api, client=cpduser.client, context=submission)
+                    logger.info(f'submission status: {submission_status}')
+                    journal.record(
+                        run_id,
+                        current_user.username,
+                        FORM_SUBMITTED if submission_status else FORM_REJECTED,
+                        form=key,
+                        code=form.submit_code,
+                        message=form.submit_message
+                    )
+                    text_status = 'OK' if submission_status else 'Failed'
+                    return (form.subject, text_status)
+                logger.warning('cannot fill form({})'.format(form.subject))
+                journal.record(run_id, current_user.username, FORM_MISBEHAVE, form=key)
+                return (form.subject, 'misbehave')
+
+            # forms are handled while later pages are still loading
+            form_count = 0
+            pending = list()
+            try:
+                async for form in collection_task.iter_forms(page_size=page_size):
+                    form_count += 1
+                    # ingore finished forms, including those submitted earlier in this run
+                    if form.handled or form_key(form.wid, form.instance_wid) in submitted:
+                        result.handled_forms.append((form.start_time, form.end_time))
+                        continue
+                    result.open_forms.append((form.start_time, form.end_time))
+                    pending.append(asyncio.ensure_future(handle_form(form)))
+            except BaseException:
+                for task in pending:
+                    task.cancel()
+                raise
+            logger.info('processing {} collection(s) for user {}'.format(form_count, current_user.username))
+            statuses = await asyncio.gather(*pending, return_exceptions=True)
+            # keep the forms handled before reporting the error
+            errors = [status for status in statuses if isinstance(status, BaseException)]
+            result.forms_status.extend(status for status in statuses if not isinstance(status, BaseException))
+            if len(errors) > 0:
+                raise errors[0]
+    except Exception as e:
+        logger.error('exception occured for user {}: {}'.format(current_user.username, repr(e)))
+        result.error = repr(e)
+    finally:
+        result.elapsed = time.perf_counter() - start
+    return result
+
+
+class WorkerPool:
+    """limits how many users are processed at the same time, globally and per school
+
+    Share one pool between callers to share the limits.
+    """
+
+    def __init__(self,
+        concurrency: int = 8,
+        school_concurrency: int = 4,
+        form_concurrency: int = 4,
+        page_size: int = 20,
+        start_jitter: float = 0.0,
+        transport: Optional[AsyncBaseTransport] = None,
+        journal: Optional[RunJournal] = None,
+        dry_run: bool = False):
+        """
+        Args:
+            concurrency (int, optional): max users processed at the same time. Defaults to 8.
+            school_concurrency (int, optional): max users of one school processed at the same time. Defaults to 4.
+            form_concurrency (int, optional): max form details of one user fetched at the same time. Defaults to 4.
+            page_size (int, optional): forms per collection list request. Defaults to 20.
+            start_jitter (float, optional): max random delay in seconds before a user starts. Defaults to 0.0.
+            transport (Optional[AsyncBaseTransport], optional): transport of the users' clients. Defaults to None(the shared pool).
+            journal (Optional[RunJournal], optional): journal to record progress and resume from. Defaults to None.
+            dry_run (bool, optional): fill the forms but don't submit them. Defaults to False.
+        """
+        self.school_concurrency = max(1, school_concurrency)
+        self.form_concurrency = form_concurrency
+        self.page_size = page_size
+        self.start_jitter = start_jitter
+        self.transport = transport
+        self.journal = journal
+        self.dry_run = dry_run
+        self._global_slots = asyncio.Semaphore(max(1, concurrency))
+        self._school_slots: Dict[str, asyncio.Semaphore] = dict()
+
+    async def run(self, current_user: UserConfig, run_id: Optional[str] = None) -> UserResult:
+        """process one user once there is a place for it
+
+        Args:
+            current_user (UserConfig): user configuration
+            run_id (Optional[str], optional): run in the journal. Defaults to None(not journaled).
+        """
+        if self.journal is not None and not self.dry_run and await self.journal.is_done_async(run_id, current_user.username):
+            # nothing will be sent, no need to wait for a slot
+            return await process_user(current_user, journal=self.journal, run_id=run_id)
+        if self.start_jitter > 0:  # don't let a whole batch hit the servers in the same second
+            await asyncio.sleep(random.uniform(0, self.start_jitter))
+        school = self._school_slots.setdefault(current_user.school_name, asyncio.Semaphore(self.school_concurrency))
+        # take the school slot first so a busy school never holds global slots
+        async with school:
+            async with self._global_slots:
+                result = await process_user(
+                    current_user,
+                    form_concurrency=self.form_concurrency,
+                    page_size=self.page_size,
+                    transport=self.transport,
+                    journal=self.journal,
+                    run_id=run_id,
+                    dry_run=self.dry_run
+                )
+        logger.info('user {} finished in {:.2f}s, ok: {}'.format(result.username, result.elapsed, result.ok))
+        return result
+
+
+async def run_users(
+    users: Iterable[UserConfig],
+    concurrency: int = 8,
+    school_concurrency: int = 4,
+    form_concurrency: int = 4,
+    page_size: int = 20,
+    start_jitter: float = 0.0,
+    transport: Optional[AsyncBaseTransport] = None,
+    journal: Optional[RunJournal] = None,
+    run_id: Optional[str] = None,
+    on_result: Optional[Callable[[UserResult], Awaitable]] = None,
+    dry_run: bool = False
+    ) -> List[UserResult]:
+    """process users concurrently
+
+    Args:
+        users (Iterable[UserConfig]): users to process
+        concurrency (int, optional): max users processed at the same time. Defaults to 8.
+        school_concurrency (int, optional): max users of one school processed at the same time. Defaults to 4.
+        form_concurrency (int, optional): max form details of one user fetched at the same time. Defaults to 4.
+        page_size (int, optional): forms per collection list request. Defaults to 20.
+        start_jitter (float, optional): max random delay in seconds before a user starts. Defaults to 0.0.
+        transport (Optional[AsyncBaseTransport], optional): transport of the users' clients. Defaults to None(the shared pool).
+        journal (Optional[RunJournal], optional): journal to record progress and resume from. Defaults to None.
+        run_id (Optional[str], optional): run in the journal, finished once every user has been tried. Defaults to None.
+        on_result (Optional[Callable[[UserResult], Awaitable]], optional): called once a user is finished. Defaults to None.
+        dry_run (bool, optional): fill the forms but don't submit them, nothing is journaled. Defaults to False.
+
+    Returns:
+        List[UserResult]: results, in the same order as `users`
+
+    A failed user never aborts the batch, check `UserResult.error` instead.
+    """
+    pool = WorkerPool(
+        concurrency=concurrency,
+        school_concurrency=school_concurrency,
+        form_concurrency=form_concurrency,
+        page_size=page_size,
+        start_jitter=start_jitter,
+        transport=transport,
+        journal=journal,
+        dry_run=dry_run
+    )
+    if dry_run:
+        journal = None
+    if journal is not None and run_id is not None:
+        journal.begin_run(run_id)
+
+    async def worker(current_user: UserConfig) -> UserResult:
+        result = await pool.run(current_user, run_id=run_id)
+        if on_result is not None:
+            try:
+                await on_result(result)
+            except Exception as e:
+                logger.error('result callback failed: {}'.format(repr(e)))
+        return result
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*[worker(current_user) for current_user in users])
+    total = time.perf_counter() - start
+    failed = sum(1 for result in results if not result.ok)
+    logger.info('processed {} user(s) in {:.2f}s, {} failed'.format(len(results), total, failed))
+    # failed users are left to the next run, resuming this one would only fail them again
+    if journal is not None and run_id is not None:
+        journal.finish_run(run_id)
+    return list(results)
@@ -0,0 +1,151 @@
+from typing import Optional, Dict, Callable, Awaitable, Union
+from pathlib import Path
+import asyncio
+import time
+from httpx import AsyncClient
+from loguru import logger
+
+from .constant import *
+from .persist import JsonFile
+
+
+class TenantCache:
+    """process-wide cache of the tenant(school) list and tenant infos
+
+    Tenants are indexed by name, both the list and the infos expire after `ttl`
+    seconds. Concurrent lookups share one request(single-flight). If `path` is
+    given, the cache is persisted there so restarts start warm: changes are
+    written in a thread, batched over `save_delay` seconds, call `flush` before
+    exiting.
+    """
+
+    path: Optional[Path]
+    ttl: float
+    miss_refresh_interval: float
+
+    def __init__(self,
+        path: Optional[Union[str, Path]] = None,
+        ttl: float = 24 * 3600,
+        miss_refresh_interval: float = 600,
+        save_delay: float = 5.0):
+        """
+        Args:
+            path (Optional[Union[str, Path]], optional): file to persist the cache. Defaults to None(memory only).
+            ttl (float, optional): seconds before an entry expires. Defaults to one day.
+            miss_refresh_interval (float, optional): min seconds between refreshes caused by unknown names. Defaults to 600.
+            save_delay (float, optional): seconds changes are batched over before being written. Defaults to 5.0.
+        """
+        self.path = None
+        self.ttl = ttl
+        self.miss_refresh_interval = miss_refresh_interval
+        self.save_delay = save_delay
+        self._file: Optional[JsonFile] = None
+        self._tenants: Dict[str, Dict] = dict()  # name -> tenant summary
+        self._list_time: float = 0.0
+        self._infos: Dict[str, Dict] = dict()  # tenant id -> {'time': float, 'data': Dict}
+        self._inflight: Dict[str, asyncio.Future] = dict()
+        if path is not None:
+            self.persist_to(path)
+
+    def persist_to(self, path: Union[str, Path]):
+        """set the persistence file and load it if exists"""
+        self.path = Path(path)
+        self._file = JsonFile(self.path, self._snapshot, 'tenant cache', self.save_delay)
+        data = self._file.load()
+        if isinstance(data, dict):
+            self._tenants = data.get('tenants', {})
+            self._list_time = data.get('list_time', 0.0)
+            self._infos = data.get('infos', {})
+            logger.debug('tenant cache loaded: {} tenant(s), {} info(s)'.format(len(self._tenants), len(self._infos)))
+
+    def _snapshot(self) -> Dict:
+        # the list and the infos are replaced, never modified, shallow copies are consistent
+        return {
+            'list_time': self._list_time,
+            'tenants': self._tenants,
+            'infos': dict(self._infos),
+        }
+
+    def _save(self):
+        if self._file is not None:
+            self._file.save()
+
+    def flush(self):
+        """write the pending changes now"""
+        if self._file is not None:
+            self._file.flush()
+
+    async def _single_flight(self, key: str, factory: Callable[[], Awaitable]):
+        """run `factory` once for all concurrent callers with the same key"""
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(factory())
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(future)
+
+    def _expired(self, timestamp: float) -> bool:
+        return time.time() - timestamp > self.ttl
+
+    async def _refresh_list(self, client: AsyncClient):
+        res = await client.get(URL_SCHOOL_LIST)  # data is a bit long, see the read timeout
+        schools = res.json().get('data')
+        logger.debug('available school count: {}', len(schools))
+        tenants = dict()
+        for school in schools:
+            # keep the first one, like a linear search does
+            tenants.setdefault(school.get('name'), school)
+        self._tenants = tenants
+        self._list_time = time.time()
+        self._save()
+
+    async def get_tenant(self, name: str, client: AsyncClient) -> Optional[Dict]:
+        """find a tenant by school name
+
+        Args:
+            name (str): school name
+            client (AsyncClient): client used if a download is required
+
+        Returns:
+            Optional[Dict]: tenant summary from the school list, None if not found
+        """
+        if len(self._tenants) == 0 or self._expired(self._list_time):
+            await self._single_flight('list', lambda: self._refresh_list(client))
+        elif name not in self._tenants and time.time() - self._list_time > self.miss_refresh_interval:
+            logger.debug('school not in cache, refreshing the school list')
+            await self._single_flight('list', lambda: self._refresh_list(client))
+        return self._tenants.get(name)
+
+    async def _fetch_info(self, tenant_id: str, client: AsyncClient) -> Dict:
+        res = await client.get(URL_SCHOOL_INFO, params={'ids': tenant_id})
+        res_json = res.json()
+        logger.debug('cpdaily response status: {}', res.status_code)
+        logger.debug('cpdaily response detail: {},{}', res_json.get('errCode'), res_json.get('errMsg'))
+        school_info = res_json.get('data')[0]
+        self._infos[tenant_id] = {'time': time.time(), 'data': school_info}
+        self._save()
+        return school_info
+
+    async def get_info(self, tenant_id: str, client: AsyncClient) -> Dict:
+        """get detailed tenant info
+
+        Args:
+            tenant_id (str): tenant id
+            client (AsyncClient): client used if a download is required
+
+        Returns:
+            Dict: tenant info
+        """
+        entry = self._infos.get(tenant_id)
+        if entry is not None and not self._expired(entry.get('time', 0.0)):
+            return entry.get('data')
+        return await self._single_flight('info:' + tenant_id, lambda: self._fetch_info(tenant_id, client))
+
+    def clear(self):
+        self._tenants = dict()
+        self._list_time = 0.0
+        self._infos = dict()
+        self._save()
+
+
+tenant_cache = TenantCache()
@@ -0,0 +1,173 @@
+from typing import Optional, Dict, Union
+from http.cookiejar import Cookie
+from pathlib import Path
+import asyncio
+import hashlib
+import json
+import os
+import time
+from httpx import Cookies
+from loguru import logger
+
+
+def _cookie_to_dict(cookie: Cookie) -> Dict:
+    return {
+        'name': cookie.name,
+        'value': cookie.value,
+        'domain': cookie.domain,
+        'path': cookie.path,
+        'expires': cookie.expires,
+        'secure': cookie.secure,
+    }
+
+
+def _dict_to_cookie(data: Dict) -> Cookie:
+    domain = data.get('domain', '')
+    path = data.get('path', '/')
+    return Cookie(
+        version=0,
+        name=data['name'],
+        value=data['value'],
+        port=None,
+        port_specified=False,
+        domain=domain,
+        domain_specified=bool(domain),
+        domain_initial_dot=domain.startswith('.'),
+        path=path,
+        path_specified=bool(path),
+        secure=data.get('secure', False),
+        expires=data.get('expires'),
+        discard=data.get('expires') is None,
+        comment=None,
+        comment_url=None,
+        rest={},
+    )
+
+
+class SessionStore:
+    """store authenticated cookies per user on disk
+
+    Each user has a json file holding the cookie jar and the `amp_root` it
+    belongs to. Nothing is stored if `path` is None.
+    """
+
+    path: Optional[Path]
+
+    def __init__(self, path: Optional[Union[str, Path]] = None):
+        """
+        Args:
+            path (Optional[Union[str, Path]], optional): directory to store sessions. Defaults to None(disabled).
+        """
+        self.path = None
+        if path is not None:
+            self.persist_to(path)
+
+    def persist_to(self, path: Union[str, Path]):
+        """set the directory to store sessions"""
+        self.path = Path(path)
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def _file(self, username: str, school_name: str) -> Path:
+        # usernames are not always safe as file names
+        key = hashlib.md5((school_name + '\n' + username).encode('utf-8')).hexdigest()
+        return self.path / '{}.session.json'.format(key)
+
+    def load(self, username: str, school_name: str, amp_root: str) -> Optional[Cookies]:
+        """load saved cookies
+
+        Args:
+            username (str): username
+            school_name (str): school name
+            amp_root (str): the amp_root the session must belong to
+
+        Returns:
+            Optional[Cookies]: cookies not expired yet, None if nothing usable
+        """
+        if not self.enabled:
+            return None
+        session_file = self._file(username, school_name)
+        if not session_file.exists():
+            return None
+        try:
+            with open(session_file, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning('cannot load session: {}'.format(repr(e)))
+            return None
+        if data.get('amp_root') != amp_root:
+            logger.debug('session belongs to another amp_root, ignored')
+            return None
+        now = time.time()
+        cookies = Cookies()
+        for cookie_data in data.get('cookies', []):
+            expires = cookie_data.get('expires')
+            if expires is not None and expires < now:
+                continue
+            cookies.jar.set_cookie(_dict_to_cookie(cookie_data))
+        if len(cookies.jar) == 0:
+            return None
+        return cookies
+
+    def save(self, username: str, school_name: str, amp_root: str, cookies: Cookies):
+        """save cookies of an authenticated client
+
+        Args:
+            username (str): username
+            school_name (str): school name
+            amp_root (str): the amp_root the session belongs to
+            cookies (Cookies): the client's cookies
+        """
+        if not self.enabled:
+            return
+        data = {
+            'saved': time.time(),
+            'amp_root': amp_root,
+            'cookies': [_cookie_to_dict(cookie) for cookie in cookies.jar],
+        }
+        session_file = self._file(username, school_name)
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+            tmp_file = session_file.with_suffix('.tmp')
+            # cookies are credentials, keep them private
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with open(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp_file, session_file)
+        except OSError as e:
+            logger.warning('cannot save session: {}'.format(repr(e)))
+
+    def drop(self, username: str, school_name: str):
+        """forget the session of a user"""
+        if not self.enabled:
+            return
+        try:
+            self._file(username, school_name).unlink()
+        except FileNotFoundError:
+            pass
+
+    # the file operations in a thread, without blocking the event loop
+
+    async def load_async(self, username: str, school_name: str, amp_root: str) -> Optional[Cookies]:
+        if not self.enabled:
+            return None
+        return await asyncio.get_running_loop().run_in_executor(None, self.load, username, school_name, amp_root)
+
+    async def save_async(self, username: str, school_name: str, amp_root: str, cookies: Cookies):
+        if not self.enabled:
+            return
+        # copied on the loop, the client keeps using its jar
+        jar = Cookies()
+        for cookie in cookies.jar:
+            jar.jar.set_cookie(cookie)
+        await asyncio.get_running_loop().run_in_executor(None, self.save, username, school_name, amp_root, jar)
+
+    async def drop_async(self, username: str, school_name: str):
+        if not self.enabled:
+            return
+        await asyncio.get_running_loop().run_in_executor(None, self.drop, username, school_name)
+
+
+session_store = SessionStore()
@@ -0,0 +1,581 @@
+from typing import Optional, Dict, List, Tuple, Callable, Awaitable, Iterable
+from dataclasses import dataclass, field, asdict, replace
+from pathlib import Path
+import asyncio
+import bisect
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from loguru import logger
+
+from .config import UserConfig
+from .journal import RunJournal
+from .runner import UserResult, WorkerPool
+
+
+SHARD_BY_USERNAME = 'username'
+SHARD_BY_SCHOOL = 'school'
+
+
+def _hash(key: str) -> int:
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing:
+    """consistent hash ring, a key keeps its node when nodes are added or removed"""
+
+    def __init__(self, nodes: Iterable[str], replicas: int = 64):
+        """
+        Args:
+            nodes (Iterable[str]): node names
+            replicas (int, optional): points per node on the ring. Defaults to 64.
+        """
+        self._ring: List[Tuple[int, str]] = sorted(
+            (_hash('{}#{}'.format(node, idx)), node) for node in nodes for idx in range(replicas)
+        )
+        self._keys = [point for point, _ in self._ring]
+        if len(self._ring) == 0:
+            raise ValueError('a hash ring needs at least one node')
+
+    def node_for(self, key: str) -> str:
+        idx = bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._ring[idx][1]
+
+
+def shard_key(user: UserConfig, by: str = SHARD_BY_SCHOOL) -> str:
+    """sharding by school keeps the per-school limits within one worker"""
+    if by == SHARD_BY_SCHOOL:
+        return user.school_name
+    if by == SHARD_BY_USERNAME:
+        return user.username
+    raise ValueError('unknown shard key {}'.format(by))
+
+
+def partition(users: Iterable[UserConfig], shards: int, by: str = SHARD_BY_SCHOOL) -> List[List[UserConfig]]:
+    """split users into `shards` groups
+
+    Args:
+        users (Iterable[UserConfig]): users
+        shards (int): number of groups
+        by (str, optional): 'school' or 'username'. Defaults to 'school'.
+
+    Returns:
+        List[List[UserConfig]]: users of each shard, some may be empty
+    """
+    shards = max(1, shards)
+    ring = HashRing(['shard-{}'.format(idx) for idx in range(shards)])
+    groups = [list() for _ in range(shards)]
+    for user in users:
+        groups[int(ring.node_for(shard_key(user, by)).split('-')[1])].append(user)
+    return groups
+
+
+@dataclass
+class WorkerOptions:
+    """settings of a worker process, must be picklable"""
+
+    concurrency: int = 8
+    school_concurrency: int = 4
+    form_concurrency: int = 4
+    page_size: int = 20
+    start_jitter: float = 0.0
+    rate: float = 5.0  # requests per second per host and school, in this worker
+    rate_burst: float = 10
+    host_rates: Dict[str, float] = field(default_factory=dict)  # host -> requests per second, in this worker
+    connect_timeout: float = 5.0
+    read_timeout: float = 15.0
+    retries: int = 3
+    retry_backoff: float = 0.5
+    breaker_threshold: int = 5
+    breaker_cooldown: float = 60.0
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 30.0
+    max_per_host: int = 10
+    http2: bool = True
+    captcha_workers: int = 1
+    captcha_timeout: float = 20.0
+    captcha_min_confidence: float = 0.3
+    tenant_cache_ttl: float = 24 * 3600
+    form_cache_ttl: float = 7 * 24 * 3600
+    trace: bool = True  # keep the trace of users not finished
+    trace_limit: int = 512
+    dry_run: bool = False  # fill the forms but don't submit them
+    log_level: str = 'INFO'  # of the logs written to stderr
+    cache_path: Optional[str] = None  # caches are shared through files if given
+    journal_path: Optional[str] = None
+    run_id: Optional[str] = None
+
+
+def _setup_worker(options: WorkerOptions):
+    from .captcha_service import captcha_service
+    from .journal import run_journal
+    from .policy import request_policy
+    from .ratelimit import rate_limiter
+    from .school import tenant_cache
+    from .session import session_store
+    from .task.schema_cache import schema_cache
+    from .tracing import tracer
+    from .transport import shared_transport
+
+    rate_limiter.configure(rate=options.rate, burst=options.rate_burst, host_rates=options.host_rates)
+    request_policy.configure(
+        connect_timeout=options.connect_timeout,
+        read_timeout=options.read_timeout,
+        retries=options.retries,
+        backoff=options.retry_backoff,
+        breaker_threshold=options.breaker_threshold,
+        breaker_cooldown=options.breaker_cooldown
+    )
+    shared_transport.configure(
+        max_connections=options.max_connections,
+        max_keepalive_connections=options.max_keepalive_connections,
+        keepalive_expiry=options.keepalive_expiry,
+        max_per_host=options.max_per_host,
+        http2=options.http2
+    )
+    captcha_service.configure(
+        max_workers=options.captcha_workers,
+        timeout=options.captcha_timeout,
+        min_confidence=options.captcha_min_confidence
+    )
+    tracer.configure(enabled=options.trace, limit=options.trace_limit)
+    tenant_cache.ttl = options.tenant_cache_ttl
+    schema_cache.ttl = options.form_cache_ttl
+    if options.cache_path is not None:
+        cache_path = Path(options.cache_path)
+        tenant_cache.persist_to(cache_path / 'tenants.json')
+        session_store.persist_to(cache_path / 'sessions')
+        schema_cache.persist_to(cache_path / 'forms.json')
+    if options.journal_path is not None and not run_journal.enabled:
+        run_journal.persist_to(options.journal_path)
+
+
+async def run_shard(
+    users: List[UserConfig],
+    options: WorkerOptions,
+    on_result: Optional[Callable[[UserResult], None]] = None
+    ) -> List[UserResult]:
+    """process a shard in this process, the run itself is begun and finished by the coordinator
+
+    Args:
+        users (List[UserConfig]): users of the shard
+        options (WorkerOptions): worker settings
+        on_result (Optional[Callable[[UserResult], None]], optional): called once a user is finished. Defaults to None.
+
+    Returns:
+        List[UserResult]: results, in the same order as `users`
+    """
+    from .journal import run_journal
+
+    pool = WorkerPool(
+        concurrency=options.concurrency,
+        school_concurrency=options.school_concurrency,
+        form_concurrency=options.form_concurrency,
+        page_size=options.page_size,
+        start_jitter=options.start_jitter,
+        journal=run_journal if run_journal.enabled else None,
+        dry_run=options.dry_run
+    )
+
+    async def worker(current_user: UserConfig) -> UserResult:
+        result = await pool.run(current_user, run_id=options.run_id)
+        if on_result is not None:
+            on_result(result)
+        return result
+
+    return list(await asyncio.gather(*[worker(current_user) for current_user in users]))
+
+
+def _worker_main():
+    """worker process: read the options and users from stdin, write one result per line to stdout"""
+    from .captcha_service import captcha_service
+    from .journal import run_journal
+    from .persist import flush_all
+    from .transport import shared_transport
+
+    task = json.loads(sys.stdin.read())
+    options = WorkerOptions(**task['options'])
+    logger.remove()
+    logger.add(sys.stderr, level=options.log_level)
+    _setup_worker(options)
+
+    def emit(result: UserResult):
+        sys.stdout.write(json.dumps(result.to_dict(), ensure_ascii=False) + '\n')
+        sys.stdout.flush()
+
+    async def run():
+        try:
+            await run_shard([UserConfig(**user) for user in task['users']], options, on_result=emit)
+        finally:
+            await shared_transport.shutdown()
+
+    try:
+        asyncio.run(run())
+    finally:
+        captcha_service.shutdown(wait=False)
+        flush_all()
+        run_journal.close()  # writes the queued events
+
+
+# workers import the library on its own, not through the bot plugin
+_LIBRARY_ROOT = Path(__file__).resolve().parents[1]
+_LIBRARY_NAME = __package__.rsplit('.', 1)[-1] if __package__ else 'anti_cpdaily'
+
+
+async def _spawn_shard(users: List[UserConfig], options: WorkerOptions, on_result: Callable[[UserResult], Awaitable]):
+    """run a shard in a worker process, results are passed to `on_result` as they come"""
+    options = replace(
+        options,
+        cache_path=str(Path(options.cache_path).resolve()) if options.cache_path is not None else None,
+        journal_path=str(Path(options.journal_path).resolve()) if options.journal_path is not None else None
+    )
+    task = json.dumps({'options': asdict(options), 'users': [user.dict() for user in users]}, ensure_ascii=False)
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, '-m', '{}.sharding'.format(_LIBRARY_NAME), 'worker',
+        cwd=str(_LIBRARY_ROOT),
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        limit=2 ** 24  # a result line can be long
+    )
+    try:
+        process.stdin.write(task.encode('utf-8'))
+        await process.stdin.drain()
+        process.stdin.close()
+        while True:
+            line = await process.stdout.readline()
+            if not line:
+                break
+            await on_result(UserResult.from_dict(json.loads(line.decode('utf-8'))))
+    except BaseException:  # cancelled or failed, don't leave the worker running
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    code = await process.wait()
+    if code != 0:
+        raise RuntimeError('worker exited with code {}'.format(code))
+
+
+async def run_sharded(
+    users: List[UserConfig],
+    processes: int,
+    options: WorkerOptions,
+    by: str = SHARD_BY_SCHOOL,
+    journal: Optional[RunJournal] = None,
+    on_result: Optional[Callable[[UserResult], Awaitable]] = None
+    ) -> List[UserResult]:
+    """process users in local worker processes
+
+    Args:
+        users (List[UserConfig]): users to process
+        processes (int): worker processes, one shard each
+        options (WorkerOptions): worker settings
+        by (str, optional): shard key, 'school' or 'username'. Defaults to 'school'.
+        journal (Optional[RunJournal], optional): journal of the run, workers open `options.journal_path` themselves. Defaults to None.
+        on_result (Optional[Callable[[UserResult], Awaitable]], optional): called once a user is finished. Defaults to None.
+
+    Returns:
+        List[UserResult]: results, in the same order as `users`
+    """
+    shards = [shard for shard in partition(users, processes, by) if len(shard) > 0]
+    logger.info('processing {} user(s) in {} worker process(es)'.format(len(users), len(shards)))
+    if options.dry_run:
+        journal = None
+    if journal is not None and options.run_id is not None:
+        journal.begin_run(options.run_id)
+    results: Dict[str, UserResult] = dict()
+    crashed = False
+
+    async def collect(result: UserResult):
+        results[result.username] = result
+        if on_result is not None:
+            try:
+                await on_result(result)
+            except Exception as e:
+                logger.error('result callback failed: {}'.format(repr(e)))
+
+    async def run(shard: List[UserConfig]):
+        nonlocal crashed
+        try:
+            await _spawn_shard(shard, options, collect)
+        except Exception as e:  # a crashed worker fails its unfinished users only
+            crashed = True
+            logger.error('worker failed: {}'.format(repr(e)))
+            for user in shard:
+                if user.username not in results:
+                    await collect(UserResult(username=user.username, school_name=user.school_name, qq=user.qq, error=repr(e)))
+
+    await asyncio.gather(*[run(shard) for shard in shards])
+    ordered = [results[user.username] for user in users]
+    # users of a crashed worker may not have been tried, the run is left to be resumed
+    if journal is not None and options.run_id is not None and not crashed:
+        journal.finish_run(options.run_id)
+    return ordered
+
+
+class LeaseTable:
+    """shards of a run leased to nodes through a shared SQLite file
+
+    A node takes a shard no one holds, or whose lease expired, and stores the
+    results when done. Nodes share the profile folder and the same shard count,
+    so they compute the same partition.
+    """
+
+    def __init__(self, path: str, ttl: float = 600.0):
+        """
+        Args:
+            path (str): SQLite file reachable by all nodes
+            ttl (float, optional): seconds a lease lasts without renewal. Defaults to 600.0.
+        """
+        self.path = Path(path)
+        self.ttl = ttl
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()  # the connection is used from executor threads
+        self._db = sqlite3.connect(str(self.path), timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS leases (
+                run_id TEXT NOT NULL,
+                shard INTEGER NOT NULL,
+                owner TEXT,
+                expires REAL,
+                done INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (run_id, shard)
+            );
+            CREATE TABLE IF NOT EXISTS results (
+                run_id TEXT NOT NULL,
+                username TEXT NOT NULL,
+                result TEXT NOT NULL,
+                PRIMARY KEY (run_id, username)
+            );
+        ''')
+
+    def acquire(self, run_id: str, shards: int, owner: str) -> Optional[int]:
+        """lease a shard
+
+        Returns:
+            Optional[int]: the shard, None if every shard is taken or done
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')  # one node at a time
+            try:
+                for shard in range(shards):
+                    self._db.execute('INSERT OR IGNORE INTO leases (run_id, shard) VALUES (?, ?)', (run_id, shard))
+                row = self._db.execute(
+                    'SELECT shard FROM leases WHERE run_id = ? AND done = 0 AND (owner IS NULL OR expires < ?) ORDER BY shard LIMIT 1',
+                    (run_id, now)
+                ).fetchone()
+                if row is not None:
+                    self._db.execute(
+                        'UPDATE leases SET owner = ?, expires = ? WHERE run_id = ? AND shard = ?',
+                        (owner, now + self.ttl, run_id, row[0])
+                    )
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+        return row[0] if row is not None else None
+
+    def renew(self, run_id: str, shard: int, owner: str) -> bool:
+        with self._lock:
+            cursor = self._db.execute(
+                'UPDATE leases SET expires = ? WHERE run_id = ? AND shard = ? AND owner = ? AND done = 0',
+                (time.time() + self.ttl, run_id, shard, owner)
+            )
+            return cursor.rowcount > 0
+
+    def complete(self, run_id: str, shard: int, owner: str, results: List[UserResult]):
+        """store the results of a shard and mark it done"""
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO results (run_id, username, result) VALUES (?, ?, ?)',
+                    [(run_id, result.username, json.dumps(result.to_dict(), ensure_ascii=False)) for result in results]
+                )
+                self._db.execute(
+                    'UPDATE leases SET done = 1, owner = ? WHERE run_id = ? AND shard = ?',
+                    (owner, run_id, shard)
+                )
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+
+    def remaining(self, run_id: str, shards: int) -> int:
+        """shards not done yet"""
+        with self._lock:
+            row = self._db.execute('SELECT COUNT(*) FROM leases WHERE run_id = ? AND done = 1', (run_id,)).fetchone()
+        return shards - row[0]
+
+    def results(self, run_id: str) -> List[UserResult]:
+        with self._lock:
+            rows = self._db.execute('SELECT result FROM results WHERE run_id = ?', (run_id,)).fetchall()
+        return [UserResult.from_dict(json.loads(row[0])) for row in rows]
+
+    # the same in a thread, the shared file may be slow or locked by another node
+
+    async def acquire_async(self, run_id: str, shards: int, owner: str) -> Optional[int]:
+        return await asyncio.get_running_loop().run_in_executor(None, self.acquire, run_id, shards, owner)
+
+    async def renew_async(self, run_id: str, shard: int, owner: str) -> bool:
+        return await asyncio.get_running_loop().run_in_executor(None, self.renew, run_id, shard, owner)
+
+    async def complete_async(self, run_id: str, shard: int, owner: str, results: List[UserResult]):
+        await asyncio.get_running_loop().run_in_executor(None, self.complete, run_id, shard, owner, results)
+
+    async def remaining_async(self, run_id: str, shards: int) -> int:
+        return await asyncio.get_running_loop().run_in_executor(None, self.remaining, run_id, shards)
+
+    async def results_async(self, run_id: str) -> List[UserResult]:
+        return await asyncio.get_running_loop().run_in_executor(None, self.results, run_id)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def default_owner() -> str:
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+async def run_leased(
+    users: List[UserConfig],
+    leases: LeaseTable,
+    run_id: str,
+    shards: int,
+    options: WorkerOptions,
+    by: str = SHARD_BY_SCHOOL,
+    owner: Optional[str] = None,
+    processes: int = 1,
+    journal: Optional[RunJournal] = None,
+    in_process: bool = False
+    ) -> int:
+    """process the shards this node can lease, until none is left
+
+    Args:
+        users (List[UserConfig]): all users, the same on every node
+        leases (LeaseTable): shared lease table
+        run_id (str): run shared by the nodes
+        shards (int): shard count, the same on every node
+        options (WorkerOptions): worker settings
+        by (str, optional): shard key, 'school' or 'username'. Defaults to 'school'.
+        owner (Optional[str], optional): name of this node. Defaults to None(host and pid).
+        processes (int, optional): shards processed at the same time on this node. Defaults to 1.
+        journal (Optional[RunJournal], optional): journal of the run, finished by the node completing the last shard. Defaults to None.
+        in_process (bool, optional): process the shards in this process instead of worker processes. Defaults to False.
+
+    Returns:
+        int: shards processed by this node
+    """
+    owner = owner or default_owner()
+    options = replace(options, run_id=run_id)
+    if journal is not None:
+        journal.begin_run(run_id)
+    groups = partition(users, shards, by)
+    processed = 0
+
+    async def lease_loop():
+        nonlocal processed
+        while True:
+            shard = await leases.acquire_async(run_id, shards, owner)
+            if shard is None:
+                return
+            logger.info('{} leased shard {}/{} of run {}({} user(s))'.format(owner, shard, shards, run_id, len(groups[shard])))
+            if in_process:
+                shard_run = asyncio.ensure_future(run_shard(groups[shard], options))
+            else:
+                shard_run = asyncio.ensure_future(run_sharded(groups[shard], 1, options, by))
+            lost = False
+
+            async def keep_lease():
+                nonlocal lost
+                while True:
+                    await asyncio.sleep(leases.ttl / 3)
+                    try:
+                        renewed = await leases.renew_async(run_id, shard, owner)
+                    except sqlite3.Error as e:  # tried again before the lease expires
+                        logger.warning('cannot renew the lease of shard {}: {}'.format(shard, repr(e)))
+                        continue
+                    if not renewed:
+                        # another node may hold the shard now, don't process it twice
+                        logger.warning('lease of shard {} lost, stopping it'.format(shard))
+                        lost = True
+                        shard_run.cancel()
+                        return
+
+            keeper = asyncio.ensure_future(keep_lease())
+            try:
+                results = await shard_run
+            except asyncio.CancelledError:
+                if lost:
+                    continue
+                raise
+            finally:
+                keeper.cancel()
+            await leases.complete_async(run_id, shard, owner, results)
+            processed += 1
+            if journal is not None and await leases.remaining_async(run_id, shards) == 0:
+                journal.finish_run(run_id)
+
+    await asyncio.gather(*[lease_loop() for _ in range(max(1, processes))])
+    return processed
+
+
+def main():
+    """join a multi-node run: `python -m anti_cpdaily.sharding node --profiles DIR --leases FILE --run-id ID`"""
+    import argparse
+    from .journal import run_journal
+    from .profile import ProfileRegistry
+
+    if sys.argv[1:2] == ['worker']:  # spawned by `run_sharded`
+        _worker_main()
+        return
+    if sys.argv[1:2] == ['node']:
+        del sys.argv[1]
+    parser = argparse.ArgumentParser(description='process the shards of a run leased through a shared SQLite file')
+    parser.add_argument('--profiles', required=True, help='profile folder, the same on every node')
+    parser.add_argument('--leases', required=True, help='lease table file shared by the nodes')
+    parser.add_argument('--run-id', required=True, help='run shared by the nodes')
+    parser.add_argument('--shards', type=int, default=16, help='shard count, the same on every node')
+    parser.add_argument('--by', choices=[SHARD_BY_SCHOOL, SHARD_BY_USERNAME], default=SHARD_BY_SCHOOL)
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help='shards processed at the same time')
+    parser.add_argument('--cache', default=None, help='cache folder')
+    parser.add_argument('--journal', default=None, help='run journal file')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--rate', type=float, default=5.0, help='requests per second per host and school, per process')
+    parser.add_argument('--ttl', type=float, default=600.0, help='lease duration in seconds')
+    parser.add_argument('--owner', default=None, help='node name, defaults to host:pid')
+    args = parser.parse_args()
+
+    registry = ProfileRegistry(args.profiles)
+    registry.refresh()
+    options = WorkerOptions(
+        concurrency=args.concurrency,
+        rate=args.rate,
+        cache_path=args.cache,
+        journal_path=args.journal
+    )
+    if args.journal is not None:
+        run_journal.persist_to(args.journal)
+    leases = LeaseTable(args.leases, ttl=args.ttl)
+    try:
+        processed = asyncio.run(run_leased(
+            registry.users, leases, args.run_id, args.shards, options,
+            by=args.by, owner=args.owner, processes=args.processes,
+            journal=run_journal if run_journal.enabled else None
+        ))
+        logger.info('{} shard(s) processed by this node, {} left'.format(processed, leases.remaining(args.run_id, args.shards)))
+    finally:
+        leases.close()
+        run_journal.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,4 @@
-from typing import Optional, Dict
+from typing import Optional, Dict, Tuple
 from io import BytesIO
 import base64
 import numpy as np
@@ -20,6 +20,41 @@ def solve_captcha(data: dict) -> Optional[Dict[str, int]]:
     pure white pixel. Search the bigger one with the border from the small one for a minimal  
     distance.
     """
+    params, _ = solve_captcha_rated(data)
+    return params
+
+
+def solve_captcha_rated(data: dict) -> Tuple[Dict[str, int], float]:
+    """solve slider captcha and rate the solution
+
+    Args:
+        data (dict): original data from the server
+
+    Returns:
+        Tuple[Dict[str, int], float]: the paramaters, and the confidence between 0 and 1
+
+    The confidence compares the best distance with the median one: a clear
+    white boundary gives a distance far below the others.
+    """
+    ar_big, ar_small = _load_images(data)
+    scores = _score_offsets(ar_big, ar_small)
+    logger.debug(f'result shape: {scores.shape[0]}')
+
+    # now get real offset, apply scale to it
+    best = np.argmin(scores)
+    offset = best / ar_big.shape[1] * 280
+    
+    params = {
+        'canvasLength': 280,
+        'moveLength': int(offset)
+    }
+    median = np.median(scores)
+    confidence = float(np.clip(1 - scores[best] / median, 0.0, 1.0)) if median > 0 else 0.0
+    return params, confidence
+
+
+def _load_images(data: dict) -> Tuple[np.ndarray, np.ndarray]:
+    """decode both images as RGB arrays"""
     # load and convert image
     im_big = Image.open(BytesIO(base64.b64decode(data.get('bigImage')))).convert('RGBA')
     im_small = Image.open(BytesIO(base64.b64decode(data.get('smallImage')))).convert('RGBA')
@@ -30,25 +65,32 @@ def solve_captcha(data: dict) -> Optional[Dict[str, int]]:
     logger.debug('image size: big{}, small{}'.format(ar_big.shape, ar_small.shape))
 
     # drop alpha channel
-    ar_big = ar_big[:, :, :3]
-    ar_small = ar_small[:, :, :3]
+    return ar_big[:, :, :3], ar_small[:, :, :3]
+
+
+def _score_offsets(ar_big: np.ndarray, ar_small: np.ndarray) -> np.ndarray:
+    """score every horizontal offset of the small image's boundary on the big image
+
+    Args:
+        ar_big (np.ndarray): big image, RGB
+        ar_small (np.ndarray): small image, RGB
 
+    Returns:
+        np.ndarray: distance to pure white for each offset, lower is better
+
+    All offsets are gathered at once: the flat indices of the boundary pixels are
+    computed once, then shifted by one column per offset.
+    """
     # get puzzle boundary from small one (and is more accurate)
-    boundary = np.where(ar_small == [255,255,255])
-    
-    # scan the big image and create sum result
-    mul_result = np.zeros((ar_big.shape[1] - ar_small.shape[1]))
-    logger.debug(f'result shape: {mul_result.shape[0]}')
-    selection = [ar for ar in boundary]
-    for offset in range(mul_result.shape[0]):
-        mul_result[offset] = np.sum(255 - ar_big[tuple(selection)])
-        selection[1] += 1
+    # comparing with a scalar avoids upcasting the whole image
+    rows, cols, channels = np.nonzero(ar_small == 255)
 
-    # now get real offset, apply scale to it
-    offset = np.argmin(mul_result) / ar_big.shape[1] * 280
-    
-    params = {
-        'canvasLength': 280,
-        'moveLength': int(offset)
-    }
-    return params
+    offset_count = ar_big.shape[1] - ar_small.shape[1]
+    height, width, depth = ar_big.shape
+    flat_big = np.ascontiguousarray(ar_big).reshape(-1)
+    flat_boundary = (rows * width + cols) * depth + channels
+    flat_shift = np.arange(offset_count) * depth
+    selection = flat_big[flat_shift[:, None] + flat_boundary[None, :]]
+
+    # same sums as scanning one offset at a time
+    return np.sum(255 - selection, axis=1).astype(np.float64)
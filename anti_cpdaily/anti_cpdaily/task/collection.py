@@ -1,70 +1,20 @@
-from typing import Optional, Dict, List, Callable
-from Crypto.Cipher import DES, AES
-from Crypto.Util.Padding import pad
+from typing import Optional, Dict, List, Callable, AsyncIterator
 from datetime import datetime
 from httpx import AsyncClient
-from copy import deepcopy
-import base64, json, uuid
+import asyncio
 import hashlib
 from loguru import logger
 
 from .base import AsyncBaseTask
+from .schema_cache import FormSchemaCache, schema_fingerprint, schema_cache as default_schema_cache
+from .fill_plan import FillPlanCache, find_user_fields, fill_plan_cache as default_fill_plan_cache
+from .submission import SubmissionContext
 from ..cpdaily import AsyncCpdailyUser
+from ..metrics import metrics
+from ..tracing import tracer
 from ..constant import *
 
 
-def _des_encrypt_b64(text: str) -> str:
-    key = b'b3L26XNL'
-    iv = b'\x01\x02\x03\x04\x05\x06\x07\x08'
-    des = DES.new(key=key, mode=DES.MODE_CBC, iv=iv)
-    data_to_en = pad(text.encode('utf-8'), block_size=8, style='pkcs7')
-    encrypted = des.encrypt(data_to_en)
-    result = base64.b64encode(encrypted).decode('utf-8')
-    return result
-
-
-def _aes_encrypt_b64(text: str) -> str:
-    key = b'ytUQ7l2ZZu8mLvJZ'
-    iv = b'\x01\x02\x03\x04\x05\x06\x07\x08\t\x01\x02\x03\x04\x05\x06\x07'
-    aes = AES.new(key=key, mode=AES.MODE_CBC, iv=iv)
-    data_to_en = pad(text.encode('utf-8'), block_size=16, style='pkcs7')
-    encrypted = aes.encrypt(data_to_en)
-    result = base64.b64encode(encrypted).decode('utf-8')
-    return result
-
-
-def _generate_extension_signature(extension: Dict) -> str:
-    """extract data from extension and generate signature
-
-    Args:
-        extension (Dict): extention
-
-    Returns:
-        str: signature
-    """
-    data_tosign = {
-        "appVersion": extension.get('appVersion'),
-        "bodyString": extension.get('bodyString'),
-        "deviceId": extension.get("deviceId"),
-        "lat": extension.get("lat"),
-        "lon": extension.get("lon"),
-        "model": extension.get("model"),
-        "systemName": extension.get("systemName"),
-        "systemVersion": extension.get("systemVersion"),
-        "userId": extension.get("userId"),
-    }
-
-    kv_pairs = list()
-
-    for key, value in zip(extension.keys(), extension.values()):
-        kv_pairs.append("{}={}".format(key,value))
-    
-    kv_pairs.append(CPDAILY_KEY_AES.decode('utf-8'))
-    string_to_hash = "&".join(kv_pairs)
-    signature = hashlib.md5(string_to_hash.encode('utf-8')).hexdigest()
-    return signature
-
-
 class Form:
 
     subject: str
@@ -83,8 +33,12 @@ class Form:
     read: Optional[bool]
     description: Optional[Dict]  # server side description of the form
     form_data: Optional[Dict]  # actual form data containing the form entries
+    schema_cached: bool
+    schema_version: Optional[str]
     user_data: Optional[Dict]  # user configurations and user information(username, lon, lat, uuid)
     form_to_submit: Optional[List[Dict]]
+    submit_code: Optional[str]  # server response of the last submission
+    submit_message: Optional[str]
 
     def __init__(self, data: Dict):
         """initialize form from summary
@@ -107,37 +61,84 @@ class Form:
         self.read: Optional[bool] = data.get('isRead') == 1
         self.detail = None
         self.form_data = None
+        self.schema_cached = False  # if `form_data` comes from the cache
+        self.schema_version = None  # changes when `form_data` changes
         self.school_task_wid = None
         self.form_to_submit = None
+        self.submit_code = None
+        self.submit_message = None
 
-    async def fetch_detail(self, root: str, client: Optional[AsyncClient] = None):
+    async def fetch_detail(self,
+        root: str,
+        client: Optional[AsyncClient] = None,
+        schema_cache: Optional[FormSchemaCache] = None):
         """fetch form detail, including `description` and `form_data`
 
         Args:
             root (str): the amp_root of the school(TODO: make clearer explaination)
             client (Optional[AsyncClient], optional): The client to use. Defaults to None(create new client).
+            schema_cache (Optional[FormSchemaCache], optional): cache of form fields. Defaults to None(the shared one).
 
-        Use this method to update `content`.
+        Use this method to update `content`. Form fields are downloaded only if the
+        cached ones are missing or outdated.
         """
         # check client, generate new if required
         if not isinstance(client, AsyncClient):
             client = AsyncClient()  # i dont think it will work without cookies
+        schema_cache = schema_cache if schema_cache is not None else default_schema_cache
+
+        if schema_cache.get(root, self.form_wid) is None:
+            # description and entries don't depend on each other
+            await asyncio.gather(
+                self._fetch_description(root, client),
+                self._fetch_entries(root, client)
+            )
+            schema_cache.put(root, self.form_wid, schema_fingerprint(self.description), self.form_data, self.schema_version)
+            return
+
+        # a cached schema exists, the description tells if it's still valid
+        await self._fetch_description(root, client)
+        fingerprint = schema_fingerprint(self.description)
+        entry = schema_cache.lookup(root, self.form_wid, fingerprint)
+        if entry is not None:
+            logger.debug(f'form({self.wid}) fields loaded from cache')
+            self.form_data = entry.get('data')
+            self.schema_version = entry.get('version')
+            self.schema_cached = True
+            return
+        await self._fetch_entries(root, client)
+        schema_cache.put(root, self.form_wid, fingerprint, self.form_data, self.schema_version)
+
+    async def refetch_entries(self,
+        root: str,
+        client: AsyncClient,
+        schema_cache: Optional[FormSchemaCache] = None):
+        """download form fields again, ignoring the cache
+
+        Use it when cached fields don't work.
+        """
+        schema_cache = schema_cache if schema_cache is not None else default_schema_cache
+        await self._fetch_entries(root, client)
+        schema_cache.put(root, self.form_wid, schema_fingerprint(self.description), self.form_data, self.schema_version)
 
+    async def _fetch_description(self, root: str, client: AsyncClient):
         # load form decription, extract schoolTaskWid
         source_url = root + URI_FORM_DETAIL
         payload = {
             "collectorWid": self.wid,
             "instanceWid": self.instance_wid
         }
-        res = await client.post(source_url, json=payload, timeout=10)
+        with metrics.stage('detail'):
+            res = await client.post(source_url, json=payload)
         res_j = res.json()
         response_code = res_j.get('code')
         response_message = res_j.get('message')
-        logger.debug(f'server response status: code({response_code}), msg({response_message})')
+        logger.debug('server response status: code({}), msg({})', response_code, response_message)
         self.description = res_j.get('datas')
-        logger.debug(f'Form({self.wid}) description: {self.description}')
+        tracer.dump('form({}) description: {}', self.wid, self.description)
         self.school_task_wid = self.description.get('collector').get('schoolTaskWid')
 
+    async def _fetch_entries(self, root: str, client: AsyncClient):
         # then fetch form entries(fields)
         form_entries_url = root + URI_FORM_ENTRIES
         payload = {
@@ -146,116 +147,55 @@ class Form:
             "formWid": self.form_wid,
             "collectorWid": self.wid
         }
-        res = await client.post(form_entries_url, json=payload)
+        with metrics.stage('entries'):
+            res = await client.post(form_entries_url, json=payload)
         res_j = res.json()
         response_code = res_j.get('code')
         response_message = res_j.get('message')
-        logger.debug(f'server response status: code({response_code}), msg({response_message})')
+        logger.debug('server response status: code({}), msg({})', response_code, response_message)
         self.form_data = res_j.get('datas')
-        logger.debug(f'form({self.wid}) data: {self.form_data}')
+        self.schema_version = hashlib.md5(res.content).hexdigest()
+        self.schema_cached = False
+        tracer.dump('form({}) data: {}', self.wid, self.form_data)
 
-    def fill_form(self, user_data: Dict) -> bool:
+    def fill_form(self, user_data: Dict, plan_cache: Optional[FillPlanCache] = None) -> bool:
         """fill form with given data, also set user data
 
         Args:
             user_data (Dict): user configuration
+            plan_cache (Optional[FillPlanCache], optional): cache of filled items. Defaults to None(the shared one).
 
         Returns:
             bool: True if a matched form found
+
+        The filled items are reused while the form schema and the user defined
+        fields stay the same.
         """
         if not isinstance(self.form_data, dict):
             logger.warning('missing form data, please fetch the data first')
             return False
+        plan_cache = plan_cache if plan_cache is not None else default_fill_plan_cache
         self.user_data = user_data  # reference attention!
         logger.info(f'filling the form({self.subject})')
-        user_defined_form_data = None
         user_forms = self.user_data.get('collections', [])
         logger.info('searching among {} form(s)'.format(len(user_forms)))
-        for form in user_forms:
-            if form.get('subject') == self.subject:
-                user_defined_form_data = form.get('fields')
-                break
+        user_defined_form_data = find_user_fields(user_forms, self.subject)
         if user_defined_form_data == None:
             logger.info('no matching form found')
             return False
         # fill the form
         logger.info('find a matched form, filling the form now')
-        form_filled = list()
-        for current_form_item in self.form_data.get('rows'):
-            # TODO: fill unnecessary items
-            if not current_form_item.get('isRequired'):
-                continue
-            item_title = current_form_item.get('title', '').replace('\xa0', ' ')  # replace non-breaking space to normal space
-            item_col_name = current_form_item.get('colName')
-            logger.info('next item: "{}"'.format(item_col_name))
-            logger.info('item title: "{}"'.format(item_title))
-
-            matched_item = None
-            for uitem in user_defined_form_data:  # scanning user provided form data
-                # compare items
-                match_title = uitem.get('title') == item_title
-                match_col_name = uitem.get('col_name') == item_col_name
-                if match_title:
-                    if match_col_name:
-                        matched_item = uitem
-                        break
-                    else:  # partial match, misbehaved form
-                        raise ValueError(
-                            'form title match but colName({},{}) not, '
-                            'form maybe changed!'
-                            .format(item_col_name, uitem.get('col_name'))
-                        )
-            if matched_item == None:  # no matched entry for a required field, thus forms are different
-                logger.warning('missing definition for "{}"'.format(item_title))
-                logger.warning('form detail: {}'.format(current_form_item))
-                return False
-            # fill this item
-            new_item = deepcopy(current_form_item)
-            logger.debug('fill in item: "{}"'.format(new_item))
-            item_type = new_item.get('fieldType')
-            answer = matched_item.get('answer')
-            if not isinstance(answer, list):
-                logger.warning('bad answer list')
-                return False
-            logger.debug(f'current user definition: {matched_item}')
-            logger.debug(f'answer candidates: {answer}')
-
-            if item_type in {'1', '5'}:  # text
-                if not len(answer) == 1:
-                    logger.warning('expecting one answer but got {}'.format(len(answer)))
-                    return False
-                new_item['value'] = answer[0]
-
-            elif item_type in {'2', '3'}:  # single/multiple choice
-                # only keep those content is in answer
-                if item_type == '2':
-                    if not len(answer) == 1:
-                        logger.warning('expecting one answer but got {}'.format(len(answer)))
-                        return False
-
-                new_field_items = list()
-                for choice in new_item.get('fieldItems', []):
-                    if choice.get('content') in answer:
-                        new_field_items.append(choice)
-
-                logger.debug('fill with: {}'.format(new_field_items))
-                if not len(new_field_items) > 0:
-                    logger.warning('no choice made, bug?')
-                    return False
-                new_item['fieldItems'] = new_field_items
-                new_item['value'] = ' '.join(map(lambda x: x['content'], new_field_items))
-
-            elif item_type == '4':  # ignored choice ?
-                logger.warning('found type-4 item, but dont know what to do')
-                pass
-            else:
-                raise ValueError('unexpected item type {}'.format(item_type))
-
-            form_filled.append(new_item)
-            logger.info('filled form value: "{}"'.format(new_item['value']))
+        form_filled = plan_cache.get_or_compile(
+            key=(self.user_data.get('username'), self.form_wid, self.subject),
+            schema_version=self.schema_version,
+            form_data=self.form_data,
+            user_fields=user_defined_form_data
+        )
+        if form_filled is None:
+            return False
 
         self.form_to_submit = form_filled
-        logger.debug('form to submit: {}'.format(form_filled))
+        tracer.dump('form to submit: {}', form_filled)
         return True
 
     def generate_config(self, only_required: bool = True) -> Optional[Dict]:
@@ -295,15 +235,16 @@ class Form:
             }
             fields.append(new_example_field)
         form_example['size'] = len(fields)
-        logger.debug(f'form example: {form_example}')
+        tracer.dump('form example: {}', form_example)
         return form_example
 
-    async def post_form(self, apis: Dict, client: AsyncClient) -> bool:
+    async def post_form(self, apis: Dict, client: AsyncClient, context: Optional[SubmissionContext] = None) -> bool:
         """post form to cpdaily
 
         Args:
             apis (Dict): necessary school info (amp_root, tenant_id)
             client (AsyncClient): client to use
+            context (Optional[SubmissionContext], optional): submission material of the user. Defaults to None(built from `user_data`).
 
         Returns:
             bool: True if succeeded
@@ -328,58 +269,23 @@ class Form:
             "uaIsCpadaily": True
         }
 
-        # UUID use username and school name as seed
-        generated_device_uuid = self.user_data.get('device_uuid', None)
-        if generated_device_uuid == None:
-            seed_string = self.user_data.get('username') + self.user_data.get('school_name')
-            seed_hash = hashlib.md5(seed_string.encode('utf-8'))
-            seed = int(seed_hash.hexdigest(), 16)
-            generated_device_uuid = str(uuid.UUID(int=seed))
-
-        # cpdaily encrypted 'Cpdaily-Extension'
-        # extension works as a wrapper of payload
-        # part of it is used to verify the authenticity of data
-        # it has taken the place of json of the request since cpdaily 9.x
-        # (before that, json=payload)
-        # TODO: utilize 'fetchStuLocation' from original form detail 
-        extension = {
-            "appVersion": CPDAILY_APP_VERSION,
-            "model": "MI 6",
-            "systemName": "android",
-            "systemVersion": "7.1.1",
-            "userId": self.user_data.get('username'),
-            "lon": self.user_data.get('longitude'),
-            "lat": self.user_data.get('latitude'),
-            "deviceId": generated_device_uuid,
-            "calVersion": "firstv",
-            "version": "first_v2"
-        }
-
-        partial_extension = _des_encrypt_b64(json.dumps(extension))
-
-        body_string = _aes_encrypt_b64(json.dumps(payload))
-        signature = _generate_extension_signature(extension)
-        extension['bodyString'] = body_string
-        extension['sign'] = signature
-
-        # cpdaily extra headers
-        headers = {
-            'tenantId': tenant_id,
-            'CpdailyStandAlone': '0',
-            'extension': '1',
-            'sign': '1',
-            'Cpdaily-Extension': _des_encrypt_b64(json.dumps(extension)),
-            'User-Agent': USER_AGENT_SUBMIT
-        }
+        if context is None:
+            context = SubmissionContext(self.user_data)
+        headers, extension = context.build(payload, tenant_id)
 
         submit_url = root + URI_FORM_SUBMIT
         logger.info('submitting form')
-        res = await client.post(submit_url, headers=headers, json=extension, timeout=10)
-        logger.debug('server status_code: {}', res.status_code)
-        res_j = res.json()
-        server_code = res_j.get('code')
-        server_msg = res_j.get('message')
-        logger.debug(f'server response status: code({server_code}), message({server_msg})')
+        with metrics.stage('submit') as timer:
+            res = await client.post(submit_url, headers=headers, json=extension)
+            logger.debug('server status_code: {}', res.status_code)
+            res_j = res.json()
+            server_code = res_j.get('code')
+            server_msg = res_j.get('message')
+            self.submit_code = server_code
+            self.submit_message = server_msg
+            if server_code != '0':
+                timer.outcome = 'rejected'
+        logger.debug('server response status: code({}), message({})', server_code, server_msg)
         if server_code == '0':
             logger.success('collection form submitted ("{}")'.format(self.subject))
             return True
@@ -407,24 +313,102 @@ class AsyncCollectionTask(AsyncBaseTask):
         self.form_list = None
         self.form_ans = form_ans
 
-    async def fetch_form(self):
+    async def iter_forms(self, page_size: int = 20) -> AsyncIterator[Form]:
+        """page through the collection list lazily
+
+        Args:
+            page_size (int, optional): forms per request. Defaults to 20.
+
+        Raises:
+            RuntimeError: the server refused the list, eg. the session expired
+
+        Yields:
+            Form: forms in server order, the next page is requested only when needed
+        """
         client = self.user.client
         school_api = self.user.school_api
         source_url = school_api.get('amp_root') + URI_FORM_LIST
-        payload = {
-            'pageSize': 6,
-            "pageNumber": 1
-        }
-        res = await client.post(source_url, json=payload)
-        res_j = res.json()
-        response_code = res_j.get('code')
-        response_message = res_j.get('message')
-        logger.debug(f'server response status: code({response_code}), msg({response_message})')
-        if response_code != '0':
-            logger.warning('server response status is unusual')
-        data = res_j.get('datas')
-        logger.debug(f'server response data: {data}')
-        form_list = list()
-        for form_summary in data.get('rows'):
-            form_list.append(Form(form_summary))
-        self.form_list = form_list
+        page_number = 1
+        fetched = 0
+        while True:
+            payload = {
+                'pageSize': page_size,
+                "pageNumber": page_number
+            }
+            with metrics.stage('form_list'):
+                res = await client.post(source_url, json=payload)
+            res_j = res.json()
+            response_code = res_j.get('code')
+            response_message = res_j.get('message')
+            logger.debug('server response status: code({}), msg({})', response_code, response_message)
+            data = res_j.get('datas')
+            tracer.dump('server response data: {}', data)
+            # not "no forms", the user must be reported or tried again
+            if response_code != '0' or not isinstance(data, dict):
+                raise RuntimeError('cannot list collections: code({}), message({})'.format(response_code, response_message))
+            rows = data.get('rows') or []
+            for form_summary in rows:
+                yield Form(form_summary)
+            fetched += len(rows)
+            try:
+                total_size = int(data.get('totalSize'))
+            except (TypeError, ValueError):
+                total_size = None
+            if len(rows) == 0:
+                return
+            if total_size is not None:
+                # the server may cap the page size, trust the total instead
+                if fetched >= total_size:
+                    return
+            elif len(rows) < page_size:
+                return
+            page_number += 1
+
+    async def fetch_form(self, page_size: int = 20):
+        """fetch all forms into `form_list`"""
+        self.form_list = [form async for form in self.iter_forms(page_size=page_size)]
+
+    async def fetch_details(self, forms: Optional[List[Form]] = None, concurrency: int = 4, skip_handled: bool = True):
+        """fetch details of many forms concurrently
+
+        Args:
+            forms (Optional[List[Form]], optional): forms to fetch. Defaults to None(`form_list`).
+            concurrency (int, optional): max forms fetched at the same time. Defaults to 4.
+            skip_handled (bool, optional): ignore finished forms. Defaults to True.
+        """
+        forms = forms if forms is not None else self.form_list
+        slots = asyncio.Semaphore(max(1, concurrency))
+        root = self.user.school_api.get('amp_root')
+
+        async def fetch(form: Form):
+            async with slots:
+                await form.fetch_detail(root=root, client=self.user.client)
+
+        await asyncio.gather(*[fetch(form) for form in forms if not (skip_handled and form.handled)])
+
+    async def submit_forms(self, forms: Optional[List[Form]] = None, concurrency: int = 4) -> List[bool]:
+        """submit many filled forms concurrently, sharing one submission context
+
+        Args:
+            forms (Optional[List[Form]], optional): forms to submit. Defaults to None(filled forms of `form_list`).
+            concurrency (int, optional): max forms submitted at the same time. Defaults to 4.
+
+        Returns:
+            List[bool]: submission status of each form
+        """
+        if forms is None:
+            forms = [form for form in self.form_list if isinstance(form.form_to_submit, list)]
+        slots = asyncio.Semaphore(max(1, concurrency))
+        contexts: Dict[int, SubmissionContext] = dict()  # forms may be filled by different user data
+
+        async def submit(form: Form) -> bool:
+            if not isinstance(form.user_data, dict):
+                logger.warning('user data not provided')
+                return False
+            context = contexts.get(id(form.user_data))
+            if context is None:
+                context = contexts[id(form.user_data)] = SubmissionContext(form.user_data)
+            async with slots:
+                return await form.post_form(apis=self.user.school_api, client=self.user.client, context=context)
+
+        return list(await asyncio.gather(*[submit(form) for form in forms]))
@@ -0,0 +1,165 @@
+from typing import Optional, Dict, List, Tuple
+from collections import OrderedDict
+from copy import deepcopy
+import hashlib
+import json
+from loguru import logger
+
+from ..tracing import tracer
+
+
+def find_user_fields(user_forms: List[Dict], subject: str) -> Optional[List[Dict]]:
+    """find the user defined fields of a form by subject, the first one wins"""
+    index = dict()
+    for form in user_forms:
+        index.setdefault(form.get('subject'), form)
+    form = index.get(subject)
+    return form.get('fields') if form is not None else None
+
+
+def user_fields_version(user_fields: List[Dict]) -> str:
+    """fingerprint of the user defined fields"""
+    text = json.dumps(user_fields, sort_keys=True, ensure_ascii=False)
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+
+def compile_fill_plan(form_data: Dict, user_fields: List[Dict]) -> Optional[List[Dict]]:
+    """fill the required form items with the user defined fields
+
+    Args:
+        form_data (Dict): form fields from the server
+        user_fields (List[Dict]): user defined fields
+
+    Raises:
+        ValueError: if the form doesn't look like the user defined one
+
+    Returns:
+        Optional[List[Dict]]: the filled items, None if the form can't be filled
+    """
+    # user items indexed by title, the first one wins like a linear search
+    user_items = dict()
+    for uitem in user_fields:
+        user_items.setdefault(uitem.get('title'), uitem)
+
+    form_filled = list()
+    for current_form_item in form_data.get('rows'):
+        # TODO: fill unnecessary items
+        if not current_form_item.get('isRequired'):
+            continue
+        item_title = current_form_item.get('title', '').replace('\xa0', ' ')  # replace non-breaking space to normal space
+        item_col_name = current_form_item.get('colName')
+        logger.info('next item: "{}"', item_col_name)
+        logger.info('item title: "{}"', item_title)
+
+        matched_item = user_items.get(item_title)
+        if matched_item is not None and matched_item.get('col_name') != item_col_name:
+            # partial match, misbehaved form
+            raise ValueError(
+                'form title match but colName({},{}) not, '
+                'form maybe changed!'
+                .format(item_col_name, matched_item.get('col_name'))
+            )
+        if matched_item == None:  # no matched entry for a required field, thus forms are different
+            logger.warning('missing definition for "{}"'.format(item_title))
+            logger.warning('form detail: {}'.format(current_form_item))
+            return None
+        # fill this item
+        new_item = deepcopy(current_form_item)
+        tracer.dump('fill in item: "{}"', new_item)
+        item_type = new_item.get('fieldType')
+        answer = matched_item.get('answer')
+        if not isinstance(answer, list):
+            logger.warning('bad answer list')
+            return None
+        tracer.dump('current user definition: {}', matched_item)
+        tracer.dump('answer candidates: {}', answer)
+
+        if item_type in {'1', '5'}:  # text
+            if not len(answer) == 1:
+                logger.warning('expecting one answer but got {}'.format(len(answer)))
+                return None
+            new_item['value'] = answer[0]
+
+        elif item_type in {'2', '3'}:  # single/multiple choice
+            # only keep those content is in answer
+            if item_type == '2':
+                if not len(answer) == 1:
+                    logger.warning('expecting one answer but got {}'.format(len(answer)))
+                    return None
+
+            new_field_items = list()
+            for choice in new_item.get('fieldItems', []):
+                if choice.get('content') in answer:
+                    new_field_items.append(choice)
+
+            tracer.dump('fill with: {}', new_field_items)
+            if not len(new_field_items) > 0:
+                logger.warning('no choice made, bug?')
+                return None
+            new_item['fieldItems'] = new_field_items
+            new_item['value'] = ' '.join(map(lambda x: x['content'], new_field_items))
+
+        elif item_type == '4':  # ignored choice ?
+            logger.warning('found type-4 item, but dont know what to do')
+            pass
+        else:
+            raise ValueError('unexpected item type {}'.format(item_type))
+
+        form_filled.append(new_item)
+        logger.info('filled form value: "{}"', new_item['value'])
+    return form_filled
+
+
+class FillPlanCache:
+    """filled form items per (user, formWid, subject), reused while nothing changed
+
+    A plan is rebuilt when the form schema version or the user defined fields
+    change. Plans are shared, don't modify them.
+    """
+
+    max_size: int
+
+    def __init__(self, max_size: int = 4096):
+        self.max_size = max_size
+        self._plans: 'OrderedDict[Tuple, Tuple[Tuple, Optional[List[Dict]]]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_compile(self,
+        key: Tuple,
+        schema_version: Optional[str],
+        form_data: Dict,
+        user_fields: List[Dict]) -> Optional[List[Dict]]:
+        """get the plan for `key`, compile it if missing or outdated
+
+        Args:
+            key (Tuple): (username, formWid, subject)
+            schema_version (Optional[str]): version of `form_data`, None to skip the cache
+            form_data (Dict): form fields from the server
+            user_fields (List[Dict]): user defined fields
+
+        Returns:
+            Optional[List[Dict]]: the filled items, None if the form can't be filled
+        """
+        if schema_version is None:
+            return compile_fill_plan(form_data, user_fields)
+        version = (schema_version, user_fields_version(user_fields))
+        cached = self._plans.get(key)
+        if cached is not None and cached[0] == version:
+            self.hits += 1
+            self._plans.move_to_end(key)
+            logger.debug('fill plan reused for {}'.format(key))
+            return cached[1]
+        self.misses += 1
+        plan = compile_fill_plan(form_data, user_fields)
+        self._plans[key] = (version, plan)
+        self._plans.move_to_end(key)
+        while len(self._plans) > self.max_size:
+            self._plans.popitem(last=False)
+        return plan
+
+    def clear(self):
+        self._plans.clear()
+
+
+fill_plan_cache = FillPlanCache()
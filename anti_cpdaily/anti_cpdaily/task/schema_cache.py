@@ -0,0 +1,123 @@
+from typing import Optional, Dict, Union
+from pathlib import Path
+import hashlib
+import json
+import time
+from loguru import logger
+
+from ..persist import JsonFile
+
+
+def schema_fingerprint(description: Optional[Dict]) -> Optional[str]:
+    """fingerprint of the form part of a form description
+
+    Args:
+        description (Optional[Dict]): form description(`detailCollector` datas)
+
+    Returns:
+        Optional[str]: the fingerprint, None if the description has no form part
+    """
+    if not isinstance(description, dict) or not isinstance(description.get('form'), dict):
+        return None
+    text = json.dumps(description.get('form'), sort_keys=True, ensure_ascii=False)
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+
+class FormSchemaCache:
+    """cache of form fields(`getFormFields` datas) keyed by tenant and formWid
+
+    Daily collections reuse the same formWid with the same fields, so the entries
+    are downloaded only if the cached ones are expired or the form part of the
+    description changed. If `path` is given, the cache is persisted there:
+    changes are written in a thread, batched over `save_delay` seconds, call
+    `flush` before exiting.
+    """
+
+    path: Optional[Path]
+    ttl: float
+
+    def __init__(self, path: Optional[Union[str, Path]] = None, ttl: float = 7 * 24 * 3600, save_delay: float = 5.0):
+        """
+        Args:
+            path (Optional[Union[str, Path]], optional): file to persist the cache. Defaults to None(memory only).
+            ttl (float, optional): seconds before an entry expires. Defaults to 7 days.
+            save_delay (float, optional): seconds changes are batched over before being written. Defaults to 5.0.
+        """
+        self.path = None
+        self.ttl = ttl
+        self.save_delay = save_delay
+        self._file: Optional[JsonFile] = None
+        self._entries: Dict[str, Dict] = dict()  # key -> {'time', 'fingerprint', 'version', 'data'}
+        self.hits = 0
+        self.misses = 0
+        if path is not None:
+            self.persist_to(path)
+
+    def persist_to(self, path: Union[str, Path]):
+        """set the persistence file and load it if exists"""
+        self.path = Path(path)
+        # entries are replaced, never modified, a shallow copy is a consistent snapshot
+        self._file = JsonFile(self.path, lambda: dict(self._entries), 'form schema cache', self.save_delay)
+        entries = self._file.load()
+        if isinstance(entries, dict):
+            self._entries = entries
+            logger.debug('form schema cache loaded: {} form(s)'.format(len(self._entries)))
+
+    def _save(self):
+        if self._file is not None:
+            self._file.save()
+
+    def flush(self):
+        """write the pending changes now"""
+        if self._file is not None:
+            self._file.flush()
+
+    @staticmethod
+    def _key(tenant: str, form_wid: str) -> str:
+        return '{}|{}'.format(tenant, form_wid)
+
+    def get(self, tenant: str, form_wid: str) -> Optional[Dict]:
+        """get an entry not expired yet
+
+        Returns:
+            Optional[Dict]: {'time', 'fingerprint', 'version', 'data'}, None if missing or expired
+        """
+        entry = self._entries.get(self._key(tenant, form_wid))
+        if entry is None or time.time() - entry.get('time', 0.0) > self.ttl:
+            return None
+        return entry
+
+    def lookup(self, tenant: str, form_wid: str, fingerprint: Optional[str]) -> Optional[Dict]:
+        """get the cached entry if still valid
+
+        Args:
+            tenant (str): tenant, the amp_root is fine
+            form_wid (str): formWid
+            fingerprint (Optional[str]): fingerprint of the current description
+
+        Returns:
+            Optional[Dict]: {'time', 'fingerprint', 'version', 'data'}, None if the fields must be fetched
+        """
+        entry = self.get(tenant, form_wid)
+        # a description without form part can only rely on the ttl
+        if entry is None or entry.get('fingerprint') != fingerprint:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def put(self, tenant: str, form_wid: str, fingerprint: Optional[str], data: Dict, version: Optional[str] = None):
+        self._entries[self._key(tenant, form_wid)] = {
+            'time': time.time(),
+            'fingerprint': fingerprint,
+            'version': version,  # version of the fields themselves
+            'data': data,
+        }
+        self._save()
+
+    def invalidate(self, tenant: str, form_wid: str):
+        if self._entries.pop(self._key(tenant, form_wid), None) is not None:
+            self._save()
+
+
+schema_cache = FormSchemaCache()
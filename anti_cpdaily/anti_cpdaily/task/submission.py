@@ -0,0 +1,135 @@
+from typing import Optional, Dict, Tuple
+import base64, json, uuid
+import hashlib
+from Crypto.Cipher import DES, AES
+from Crypto.Util.Padding import pad
+
+from ..constant import *
+
+
+_DES_KEY = b'b3L26XNL'
+_DES_IV = b'\x01\x02\x03\x04\x05\x06\x07\x08'
+_AES_KEY = b'ytUQ7l2ZZu8mLvJZ'
+_AES_IV = b'\x01\x02\x03\x04\x05\x06\x07\x08\t\x01\x02\x03\x04\x05\x06\x07'
+
+
+def _des_encrypt_b64(text: str) -> str:
+    # CBC cipher objects keep their chaining state, a new one is needed per message
+    des = DES.new(key=_DES_KEY, mode=DES.MODE_CBC, iv=_DES_IV)
+    data_to_en = pad(text.encode('utf-8'), block_size=8, style='pkcs7')
+    encrypted = des.encrypt(data_to_en)
+    result = base64.b64encode(encrypted).decode('utf-8')
+    return result
+
+
+def _aes_encrypt_b64(text: str) -> str:
+    aes = AES.new(key=_AES_KEY, mode=AES.MODE_CBC, iv=_AES_IV)
+    data_to_en = pad(text.encode('utf-8'), block_size=16, style='pkcs7')
+    encrypted = aes.encrypt(data_to_en)
+    result = base64.b64encode(encrypted).decode('utf-8')
+    return result
+
+
+def _generate_extension_signature(extension: Dict) -> str:
+    """extract data from extension and generate signature
+
+    Args:
+        extension (Dict): extention
+
+    Returns:
+        str: signature
+    """
+    data_tosign = {
+        "appVersion": extension.get('appVersion'),
+        "bodyString": extension.get('bodyString'),
+        "deviceId": extension.get("deviceId"),
+        "lat": extension.get("lat"),
+        "lon": extension.get("lon"),
+        "model": extension.get("model"),
+        "systemName": extension.get("systemName"),
+        "systemVersion": extension.get("systemVersion"),
+        "userId": extension.get("userId"),
+    }
+
+    kv_pairs = list()
+    for key, value in zip(extension.keys(), extension.values()):
+        kv_pairs.append("{}={}".format(key,value))
+    
+    kv_pairs.append(CPDAILY_KEY_AES.decode('utf-8'))
+    string_to_hash = "&".join(kv_pairs)
+    signature = hashlib.md5(string_to_hash.encode('utf-8')).hexdigest()
+    return signature
+
+
+def device_uuid(user_data: Dict) -> str:
+    """device id of a user, the configured one or one seeded by username and school name"""
+    generated_device_uuid = user_data.get('device_uuid', None)
+    if generated_device_uuid == None:
+        seed_string = user_data.get('username') + user_data.get('school_name')
+        seed_hash = hashlib.md5(seed_string.encode('utf-8'))
+        seed = int(seed_hash.hexdigest(), 16)
+        generated_device_uuid = str(uuid.UUID(int=seed))
+    return generated_device_uuid
+
+
+class SubmissionContext:
+    """submission material of one user, computed once and reused for all its forms
+
+    The device id, the static extension fields and the signature don't depend
+    on the form, only the payload is encrypted per submission.
+    """
+
+    extension: Dict
+    signature: str
+
+    def __init__(self, user_data: Dict):
+        """
+        Args:
+            user_data (Dict): user configuration
+        """
+        self.user_data = user_data
+        # cpdaily encrypted 'Cpdaily-Extension'
+        # extension works as a wrapper of payload
+        # part of it is used to verify the authenticity of data
+        # it has taken the place of json of the request since cpdaily 9.x
+        # (before that, json=payload)
+        # TODO: utilize 'fetchStuLocation' from original form detail 
+        self.extension = {
+            "appVersion": CPDAILY_APP_VERSION,
+            "model": "MI 6",
+            "systemName": "android",
+            "systemVersion": "7.1.1",
+            "userId": user_data.get('username'),
+            "lon": user_data.get('longitude'),
+            "lat": user_data.get('latitude'),
+            "deviceId": device_uuid(user_data),
+            "calVersion": "firstv",
+            "version": "first_v2"
+        }
+        # signed before `bodyString` is added, thus the same for every submission
+        self.signature = _generate_extension_signature(self.extension)
+
+    def build(self, payload: Dict, tenant_id: Optional[str]) -> Tuple[Dict, Dict]:
+        """encrypt a payload
+
+        Args:
+            payload (Dict): form payload
+            tenant_id (Optional[str]): tenant id of the school
+
+        Returns:
+            Tuple[Dict, Dict]: request headers and json body
+        """
+        extension = dict(self.extension)
+        extension['bodyString'] = _aes_encrypt_b64(json.dumps(payload))
+        extension['sign'] = self.signature
+
+        # cpdaily extra headers
+        headers = {
+            'tenantId': tenant_id,
+            'CpdailyStandAlone': '0',
+            'extension': '1',
+            'sign': '1',
+            'Cpdaily-Extension': _des_encrypt_b64(json.dumps(extension)),
+            'User-Agent': USER_AGENT_SUBMIT
+        }
+        return headers, extension
@@ -0,0 +1,117 @@
+from typing import Optional, Any, List, Tuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+from collections import deque
+from datetime import datetime
+from loguru import logger
+
+
+def truncated(value: Any, limit: int = 512) -> str:
+    """text of `value`, cut to `limit` characters"""
+    if callable(value):
+        value = value()
+    text = value if isinstance(value, str) else str(value)
+    if limit > 0 and len(text) > limit:
+        return '{}...({} chars)'.format(text[:limit], len(text))
+    return text
+
+
+class TraceBuffer:
+    """recent log entries of one user, kept unformatted until `render`"""
+
+    def __init__(self, size: int = 200, limit: int = 512):
+        self.limit = limit
+        self._entries: 'deque[Tuple[datetime, str, str, Tuple]]' = deque(maxlen=size)
+
+    def add(self, level: str, message: str, values: Tuple = ()):
+        self._entries.append((datetime.now(), level, message, values))
+
+    def render(self) -> str:
+        lines = list()
+        for time, level, message, values in self._entries:
+            if len(values) > 0:
+                message = message.format(*[truncated(value, self.limit) for value in values])
+            lines.append('{} | {:<7} | {}'.format(time.strftime('%H:%M:%S.%f')[:-3], level, message))
+        return '\n'.join(lines)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_current_trace: ContextVar[Optional[TraceBuffer]] = ContextVar('anti_cpdaily_trace', default=None)
+
+
+def _trace_sink(message):
+    buffer = _current_trace.get()
+    if buffer is not None:
+        record = message.record
+        buffer.add(record['level'].name, record['message'])
+
+
+class Tracer:
+    """deferred payload logging and per-user trace buffers
+
+    `dump` logs a payload at DEBUG level, the payload is only turned into text,
+    truncated, if a handler accepts DEBUG messages. Inside `trace`, dumps and
+    messages at INFO level and above are also kept in a buffer, which the caller
+    writes out only when something failed.
+    """
+
+    enabled: bool
+    limit: int
+    size: int
+
+    def __init__(self, enabled: bool = True, limit: int = 512, size: int = 200):
+        self._sink_id: Optional[int] = None
+        self.configure(enabled=enabled, limit=limit, size=size)
+
+    def configure(self, enabled: bool = True, limit: int = 512, size: int = 200):
+        """
+        Args:
+            enabled (bool, optional): keep trace buffers. Defaults to True.
+            limit (int, optional): max characters of a dumped payload, 0 for no limit. Defaults to 512.
+            size (int, optional): entries kept per trace. Defaults to 200.
+        """
+        self.enabled = enabled
+        self.limit = limit
+        self.size = size
+
+    def dump(self, message: str, *values: Any):
+        """log payloads lazily
+
+        Args:
+            message (str): message with a `{}` per value
+            values (Any): payloads, callables are called only when needed
+        """
+        buffer = _current_trace.get()
+        if buffer is not None:
+            buffer.add('DEBUG', message, values)  # references only, formatted on failure
+        limit = self.limit
+        logger.opt(lazy=True, depth=1).debug(message, *[lambda value=value: truncated(value, limit) for value in values])
+
+    @contextmanager
+    def trace(self):
+        """collect a trace buffer for the current task
+
+        Yields:
+            Optional[TraceBuffer]: the buffer, None if disabled
+        """
+        if not self.enabled:
+            yield None
+            return
+        if self._sink_id is None:
+            self._sink_id = logger.add(
+                _trace_sink,
+                level='INFO',
+                format='{message}',
+                filter=lambda record: _current_trace.get() is not None
+            )
+        buffer = TraceBuffer(self.size, self.limit)
+        token = _current_trace.set(buffer)
+        try:
+            yield buffer
+        finally:
+            _current_trace.reset(token)
+
+
+tracer = Tracer()
@@ -0,0 +1,189 @@
+from typing import Optional, Dict, List
+from dataclasses import dataclass, asdict
+import asyncio
+import time
+import weakref
+from httpx import AsyncBaseTransport, AsyncByteStream, AsyncHTTPTransport, Limits, Request, Response
+from loguru import logger
+
+try:  # HTTP/2 is optional, it requires `h2`
+    import h2
+except ImportError:
+    h2 = None
+
+
+@dataclass
+class PoolStats:
+    requests: int = 0
+    new_connections: int = 0
+    # seconds spent waiting for a per-host slot(`max_per_host`), httpx's own
+    # wait for a free connection(`max_connections`) comes after and isn't included
+    wait_time: float = 0.0
+
+    @property
+    def hits(self) -> int:
+        """requests sent over a connection already opened"""
+        return max(0, self.requests - self.new_connections)
+
+    def as_dict(self) -> Dict:
+        data = asdict(self)
+        data['hits'] = self.hits
+        return data
+
+
+def _pool_connections(transport: AsyncBaseTransport) -> List:
+    """connections of the httpcore pool of an httpx transport, empty if unknown"""
+    pool = getattr(transport, '_pool', None)
+    connections = getattr(pool, 'connections', None)  # httpcore 0.14 and later
+    if connections is None:  # httpcore 0.13, connections by origin
+        connections = [
+            connection
+            for origin_connections in (getattr(pool, '_connections', None) or dict()).values()
+            for connection in origin_connections
+        ]
+    return list(connections)
+
+
+class _SlotReleasingStream(AsyncByteStream):
+    """response stream releasing the per-host slot once closed"""
+
+    def __init__(self, stream: AsyncByteStream, slot: asyncio.Semaphore):
+        self._stream = stream
+        self._slot = slot
+        self._released = False
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            if not self._released:
+                self._released = True
+                self._slot.release()
+
+
+class SharedTransport(AsyncBaseTransport):
+    """connection pool shared by many clients
+
+    Clients keep their own cookies, while connections are reused between them.
+    Closing a client doesn't close the pool, call `shutdown` instead.
+    """
+
+    stats: PoolStats
+
+    def __init__(self,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 30.0,
+        max_per_host: int = 10,
+        http2: bool = True,
+        verify: bool = False,
+        transport: Optional[AsyncBaseTransport] = None):
+        """
+        Args:
+            max_connections (int, optional): max connections in the pool. Defaults to 100.
+            max_keepalive_connections (int, optional): max idle connections kept. Defaults to 20.
+            keepalive_expiry (float, optional): seconds an idle connection is kept. Defaults to 30.0.
+            max_per_host (int, optional): max concurrent requests per host. Defaults to 10.
+            http2 (bool, optional): use HTTP/2 where the server supports it, requires `h2`. Defaults to True.
+            verify (bool, optional): verify certificates. Defaults to False.
+            transport (AsyncBaseTransport, optional): send the requests there instead of over
+                pooled network connections, eg. a mock server. Defaults to None.
+        """
+        self.stats = PoolStats()
+        self._inner = transport
+        self._transport: Optional[AsyncBaseTransport] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._host_slots: Dict[str, asyncio.Semaphore] = dict()
+        # pool connections seen so far, forgotten once closed and collected
+        self._seen_connections: 'weakref.WeakSet' = weakref.WeakSet()
+        self.configure(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+            max_per_host=max_per_host,
+            http2=http2,
+            verify=verify
+        )
+
+    def configure(self,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 30.0,
+        max_per_host: int = 10,
+        http2: bool = True,
+        verify: bool = False):
+        """change the pool settings, takes effect on the next new pool"""
+        self.limits = Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.max_per_host = max_per_host
+        self.http2 = http2
+        self.verify = verify
+
+    def _get_transport(self) -> AsyncBaseTransport:
+        # connections belong to an event loop, start a new pool in a new loop
+        loop = asyncio.get_running_loop()
+        if self._transport is None or self._loop is not loop:
+            self._loop = loop
+            self._host_slots = dict()
+            self._seen_connections = weakref.WeakSet()
+            if self._inner is not None:
+                self._transport = self._inner
+                return self._transport
+            http2 = self.http2
+            if http2 and h2 is None:
+                logger.warning('h2 not installed, HTTP/2 disabled')
+                http2 = False
+            logger.debug('creating connection pool(http2: {})'.format(http2))
+            self._transport = AsyncHTTPTransport(verify=self.verify, http2=http2, limits=self.limits)
+        return self._transport
+
+    async def handle_async_request(self, request: Request) -> Response:
+        transport = self._get_transport()
+        slot = self._host_slots.setdefault(request.url.host, asyncio.Semaphore(self.max_per_host))
+        start = time.perf_counter()
+        await slot.acquire()
+        self.stats.wait_time += time.perf_counter() - start
+        self.stats.requests += 1
+        try:
+            response = await transport.handle_async_request(request)
+        except BaseException:
+            slot.release()
+            raise
+
+        # connections the pool holds and weren't seen yet were opened meanwhile,
+        # other requests reused one(or shared an HTTP/2 one)
+        for connection in _pool_connections(transport):
+            if connection not in self._seen_connections:
+                self._seen_connections.add(connection)
+                self.stats.new_connections += 1
+
+        return Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_SlotReleasingStream(response.stream, slot),
+            extensions=response.extensions
+        )
+
+    async def aclose(self):
+        # shared by clients, closing one client must not close the pool
+        pass
+
+    async def shutdown(self):
+        """close all pooled connections"""
+        if self._transport is not None:
+            await self._transport.aclose()
+            self._transport = None
+            self._loop = None
+
+    def reset_stats(self):
+        self.stats = PoolStats()
+
+
+shared_transport = SharedTransport()
@@ -1,4 +1,5 @@
 import nonebot
+from datetime import datetime
 from nonebot import on_command
 from nonebot.rule import to_me
 from nonebot.typing import T_State
@@ -7,15 +8,18 @@ from nonebot.log import logger
 
 from .config import global_config
 from .schedule import anti_cpdaily_check_routine
+from .anti_cpdaily.metrics import metrics
 
 
 cpdaily = on_command('cpdaily')
+cpdaily_metrics = on_command('cpdaily_metrics')
 scheduler = nonebot.require("nonebot_plugin_apscheduler").scheduler
 
 
 async def one_shot_routine():
     scheduler.remove_job('anti_cpdaily_oneshot')
-    await anti_cpdaily_check_routine()
+    # a run of its own, scheduled runs are resumed and finished by themselves
+    await anti_cpdaily_check_routine(datetime.now().strftime('manual-%Y-%m-%d-%H%M%S'))
 
 
 @cpdaily.handle()
@@ -28,3 +32,17 @@ async def handle_command(bot: Bot, event: Event, state: T_State):
         scheduler.add_job(one_shot_routine, trigger='interval', minutes=1, id='anti_cpdaily_oneshot', replace_existing=True)
         logger.debug('manual process end')
         await cpdaily.finish('启动今日校园打卡程序ing')
+
+
+@cpdaily_metrics.handle()
+async def handle_metrics_command(bot: Bot, event: Event, state: T_State):
+    """ Show the time spent in each stage
+    """
+    if event.get_user_id() in bot.config.superusers:
+        rows = metrics.summary()
+        if len(rows) == 0:
+            await cpdaily_metrics.finish('暂无统计数据')
+        lines = ['stage: count/not ok, mean p50 p99(s)']
+        for stage, count, errors, mean, p50, p99 in rows:
+            lines.append('{}: {}/{}, {:.3f} {:g} {:g}'.format(stage, count, errors, mean, p50, p99))
+        await cpdaily_metrics.finish('\n'.join(lines))
@@ -1,3 +1,4 @@
+from typing import Dict
 from pydantic import BaseSettings
 from nonebot import get_driver
 
@@ -5,6 +6,50 @@ from nonebot import get_driver
 class Config(BaseSettings):
 
     anti_cpdaily_profile_path: str = 'profiles/anti_cpdaily'
+    anti_cpdaily_profile_watch_interval: int = 60  # seconds between profile checks, 0 to disable
+    anti_cpdaily_cache_path: str = 'cache/anti_cpdaily'
+    anti_cpdaily_notify_window: float = 10.0  # seconds messages to one recipient are merged over
+    anti_cpdaily_notify_rate: float = 1.0  # max messages sent per second
+    anti_cpdaily_trace_on_failure: bool = True  # log the trace of users not finished
+    anti_cpdaily_log_dump_limit: int = 512  # max characters of a logged payload, 0 for no limit
+    anti_cpdaily_metrics_file: str = 'metrics.prom'  # Prometheus text file in the cache path, empty to disable
+    anti_cpdaily_journal: bool = True  # record runs to resume them after a restart
+    anti_cpdaily_resume_max_age: int = 6 * 3600  # seconds an unfinished run can still be resumed
+    anti_cpdaily_schedule_mode: str = 'cron'  # 'cron' or 'adaptive'
+    anti_cpdaily_adaptive_start: str = '08:00'  # daily polling window
+    anti_cpdaily_adaptive_end: str = '22:00'
+    anti_cpdaily_adaptive_spread: int = 1800  # seconds over which first checks are spread
+    anti_cpdaily_adaptive_min_interval: int = 600  # seconds
+    anti_cpdaily_adaptive_max_interval: int = 7200  # seconds
+    anti_cpdaily_tenant_cache_ttl: int = 24 * 3600  # seconds
+    anti_cpdaily_form_cache_ttl: int = 7 * 24 * 3600  # seconds
+    anti_cpdaily_concurrency: int = 8  # users processed at the same time
+    anti_cpdaily_school_concurrency: int = 4  # users of one school processed at the same time
+    anti_cpdaily_form_concurrency: int = 4  # forms of one user fetched at the same time
+    anti_cpdaily_page_size: int = 20  # forms per collection list request
+    anti_cpdaily_workers: int = 0  # worker processes of a run, 0 to run in the bot process
+    anti_cpdaily_shard_by: str = 'school'  # 'school' or 'username'
+    anti_cpdaily_lease_path: str = ''  # SQLite lease table shared with other nodes, empty for local workers only
+    anti_cpdaily_shards: int = 16  # shards of a run shared with other nodes
+    anti_cpdaily_lease_ttl: float = 600.0  # seconds
+    anti_cpdaily_start_jitter: float = 10.0  # max random delay in seconds before a user starts
+    anti_cpdaily_rate_limit: float = 5.0  # requests per second per host and school, 0 to disable
+    anti_cpdaily_rate_burst: int = 10
+    anti_cpdaily_host_rate_limits: Dict[str, float] = {}  # host -> requests per second
+    anti_cpdaily_connect_timeout: float = 5.0  # seconds
+    anti_cpdaily_read_timeout: float = 15.0  # seconds
+    anti_cpdaily_retries: int = 3  # retries of idempotent requests
+    anti_cpdaily_retry_backoff: float = 0.5  # seconds before the first retry, doubled each time
+    anti_cpdaily_breaker_threshold: int = 5  # failures in a row opening a host's circuit, 0 to disable
+    anti_cpdaily_breaker_cooldown: float = 60.0  # seconds
+    anti_cpdaily_max_connections: int = 100
+    anti_cpdaily_max_keepalive_connections: int = 20
+    anti_cpdaily_keepalive_expiry: float = 30.0  # seconds
+    anti_cpdaily_max_connections_per_host: int = 10
+    anti_cpdaily_http2: bool = True  # requires `h2`
+    anti_cpdaily_captcha_workers: int = 0  # captcha solving processes, 0 for cpu count
+    anti_cpdaily_captcha_timeout: float = 20.0  # seconds
+    anti_cpdaily_captcha_min_confidence: float = 0.3  # less confident solutions are replaced by a new captcha
 
     class Config:
         extra = "ignore"
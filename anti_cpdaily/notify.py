@@ -0,0 +1,137 @@
+from typing import Optional, Dict, List
+from datetime import datetime
+import asyncio
+import time
+import nonebot
+from loguru import logger
+
+
+class NotificationDispatcher:
+    """queue of QQ messages, sent in the background
+
+    Messages to the same recipient within `window` seconds are merged into one,
+    errors are merged into a single digest for the superusers, and messages are
+    sent at most `rate` per second so the OneBot API isn't flooded.
+    """
+
+    def __init__(self, window: float = 10.0, rate: float = 1.0, max_length: int = 3000):
+        """
+        Args:
+            window (float, optional): seconds to wait for more messages before sending. Defaults to 10.0.
+            rate (float, optional): max messages sent per second. Defaults to 1.0.
+            max_length (int, optional): max characters of a merged message. Defaults to 3000.
+        """
+        self._pending: Dict[int, List[str]] = dict()  # user_id -> texts
+        self._errors: Dict[str, int] = dict()  # error -> occurrences, in arrival order
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._last_sent = 0.0
+        self.sent = 0
+        self.configure(window=window, rate=rate, max_length=max_length)
+
+    def configure(self, window: float = 10.0, rate: float = 1.0, max_length: int = 3000):
+        self.window = window
+        self.rate = rate
+        self.max_length = max_length
+
+    def send(self, user_id: int, text: str):
+        """queue a message"""
+        self._pending.setdefault(int(user_id), list()).append(text)
+        self._schedule()
+
+    def send_superusers(self, text: str):
+        """queue a message to every superuser"""
+        for user_id in nonebot.get_driver().config.superusers:
+            self.send(int(user_id), text)
+
+    def report_error(self, text: str):
+        """add an error to the next digest of the superusers"""
+        self._errors[text] = self._errors.get(text, 0) + 1
+        self._schedule()
+
+    def _schedule(self):
+        if self._task is None or self._task.done():
+            # bound to the running loop, created on first use
+            self._wakeup = asyncio.Event()
+            self._lock = asyncio.Lock()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(self.window)  # let more messages come
+            self._wakeup.clear()
+            await self.flush()
+
+    def _digest(self, errors: Dict[str, int]) -> str:
+        lines = [str(datetime.now()), 'anti_cpdaily: {} error(s)'.format(sum(errors.values()))]
+        for text, count in errors.items():
+            lines.append(text if count == 1 else '{} (x{})'.format(text, count))
+        return '\n'.join(lines)
+
+    def _merge(self, texts: List[str]) -> List[str]:
+        """join texts into as few messages as the length allows"""
+        messages = list()
+        current = ''
+        for text in texts:
+            text = text[:self.max_length]
+            if current and len(current) + 2 + len(text) > self.max_length:
+                messages.append(current)
+                current = ''
+            current = current + '\n\n' + text if current else text
+        if current:
+            messages.append(current)
+        return messages
+
+    async def _throttle(self):
+        if self.rate <= 0:
+            return
+        delay = self._last_sent + 1 / self.rate - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self._last_sent = time.monotonic()
+
+    async def flush(self):
+        """send everything queued now"""
+        if self._lock is None:
+            return
+        async with self._lock:
+            if len(self._pending) == 0 and len(self._errors) == 0:
+                return
+            try:
+                bot = nonebot.get_bot()
+            except ValueError:
+                # keep everything queued and try again after the next window
+                logger.warning('no bot connected, {} notification(s) and {} error(s) kept for later'.format(
+                    len(self._pending), len(self._errors)))
+                if self._wakeup is not None:
+                    self._wakeup.set()
+                return
+            pending, self._pending = self._pending, dict()
+            errors, self._errors = self._errors, dict()
+            if len(errors) > 0:
+                digest = self._digest(errors)
+                for user_id in nonebot.get_driver().config.superusers:
+                    pending.setdefault(int(user_id), list()).append(digest)
+            for user_id, texts in pending.items():
+                for message in self._merge(texts):
+                    await self._throttle()
+                    try:
+                        res = await bot.call_api('send_msg', user_id=user_id, message=message)
+                        self.sent += 1
+                        logger.debug('notify to {} result: {}'.format(user_id, res))
+                    except Exception as e:
+                        logger.error('cannot notify {}: {}'.format(user_id, repr(e)))
+
+    async def shutdown(self):
+        """send what is left and stop"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+
+# shared by the plugin
+dispatcher = NotificationDispatcher()
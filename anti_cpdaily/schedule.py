@@ -1,18 +1,30 @@
-import os
-import json
+from typing import Optional, List, Dict, Callable, Awaitable
+from pathlib import Path
+import asyncio
 import functools
+import os
 import nonebot
-from pathlib import Path
 from datetime import datetime
 from loguru import logger
 
-from .anti_cpdaily.cpdaily import AsyncCpdailyUser
-from .anti_cpdaily.task import AsyncCollectionTask
+from .anti_cpdaily.profile import ProfileRegistry
 from .anti_cpdaily.config import UserConfig
+from .anti_cpdaily.runner import run_users, UserResult
+from .anti_cpdaily.transport import shared_transport
+from .anti_cpdaily.ratelimit import rate_limiter
+from .anti_cpdaily.policy import request_policy
+from .anti_cpdaily.metrics import metrics
+from .anti_cpdaily.journal import run_journal
+from .anti_cpdaily.persist import flush_all
+from .anti_cpdaily.sharding import WorkerOptions, LeaseTable, SHARD_BY_USERNAME, run_sharded, run_leased
 from .config import plugin_config
+from .notify import dispatcher
 
 
 scheduler = nonebot.require("nonebot_plugin_apscheduler").scheduler
+profile_registry = ProfileRegistry(plugin_config.anti_cpdaily_profile_path)
+_reported_profiles: Dict[str, str] = dict()  # invalid profile -> error already reported
+_profile_listeners: List[Callable[[], Awaitable]] = list()
 
 
 def exception_notification(func):
@@ -23,80 +35,217 @@ def exception_notification(func):
         except Exception as e:
             logger.error('exception occured: {}'.format(repr(e)))
             logger.warning(f'warning all superusers')
-            current_time = str(datetime.now())
-            bot = nonebot.get_bot()
-            for user_id in bot.config.superusers:
-                data = {
-                    'user_id': int(user_id),
-                    'message': '{time}\nanti_cpdaily exception occured\n{exp}'.format(time=current_time, exp=repr(e))
-                }
-                res = await bot.call_api('send_msg', **data)
+            dispatcher.report_error('exception occured: {}'.format(repr(e)))
     return exception_notification
 
 
-@scheduler.scheduled_job("cron", hour='11,12,13,14', minute=30, id='anti_cpdaily_check_routine')
+async def _notify_user(result: UserResult):
+    """queue the form status for the user"""
+    if isinstance(result.qq, int) and len(result.forms_status) > 0:
+        logger.info('sending notification to {}'.format(result.qq))
+        text = '\n'.join(map(str, result.forms_status))
+        text = str(datetime.now()) + '\n表格收集填写状况：\n' + text
+        dispatcher.send(result.qq, text)
+
+
+def _export_metrics():
+    """write the metrics for a Prometheus textfile collector"""
+    if plugin_config.anti_cpdaily_metrics_file:
+        metrics.write(Path(plugin_config.anti_cpdaily_cache_path) / plugin_config.anti_cpdaily_metrics_file)
+
+
+async def _report_failures(failed: List[UserResult]):
+    """report failed users and newly invalid profiles to superusers, in one digest
+
+    An invalid profile is reported once, until its error changes.
+    """
+    errors = profile_registry.errors
+    invalid = {name: error for name, error in errors.items() if _reported_profiles.get(name) != error}
+    for name in list(_reported_profiles):
+        if name not in errors:  # fixed or removed
+            del _reported_profiles[name]
+    _reported_profiles.update(invalid)
+    if len(failed) > 0 or len(invalid) > 0:
+        logger.warning('{} user(s) failed, {} invalid profile(s), warning all superusers'.format(len(failed), len(invalid)))
+        for result in failed:
+            dispatcher.report_error('failed user {}: {}'.format(result.username, result.error))
+        for name, error in invalid.items():
+            dispatcher.report_error('invalid profile {}: {}'.format(name, error))
+
+
+def cron_run_id(now: Optional[datetime] = None) -> str:
+    """run id of a cron slot"""
+    return (now or datetime.now()).strftime('cron-%Y-%m-%d-%H')
+
+
+def resumable_run_id() -> Optional[str]:
+    """the latest unfinished cron run recent enough to be resumed"""
+    return run_journal.latest_unfinished_run(max_age=plugin_config.anti_cpdaily_resume_max_age, prefix='cron-')
+
+
+def _worker_options(run_id: str) -> WorkerOptions:
+    """the settings the bot process uses, for the worker processes"""
+    workers = max(1, plugin_config.anti_cpdaily_workers)
+    rate = plugin_config.anti_cpdaily_rate_limit
+    host_rates = dict(plugin_config.anti_cpdaily_host_rate_limits)
+    if plugin_config.anti_cpdaily_shard_by == SHARD_BY_USERNAME:
+        # a school is spread over the workers, so is its rate
+        rate = rate / workers
+        host_rates = {host: host_rate / workers for host, host_rate in host_rates.items()}
+    return WorkerOptions(
+        concurrency=plugin_config.anti_cpdaily_concurrency,
+        school_concurrency=plugin_config.anti_cpdaily_school_concurrency,
+        form_concurrency=plugin_config.anti_cpdaily_form_concurrency,
+        page_size=plugin_config.anti_cpdaily_page_size,
+        start_jitter=plugin_config.anti_cpdaily_start_jitter,
+        rate=rate,
+        rate_burst=plugin_config.anti_cpdaily_rate_burst,
+        host_rates=host_rates,
+        connect_timeout=plugin_config.anti_cpdaily_connect_timeout,
+        read_timeout=plugin_config.anti_cpdaily_read_timeout,
+        retries=plugin_config.anti_cpdaily_retries,
+        retry_backoff=plugin_config.anti_cpdaily_retry_backoff,
+        breaker_threshold=plugin_config.anti_cpdaily_breaker_threshold,
+        breaker_cooldown=plugin_config.anti_cpdaily_breaker_cooldown,
+        max_connections=plugin_config.anti_cpdaily_max_connections,
+        max_keepalive_connections=plugin_config.anti_cpdaily_max_keepalive_connections,
+        keepalive_expiry=plugin_config.anti_cpdaily_keepalive_expiry,
+        max_per_host=plugin_config.anti_cpdaily_max_connections_per_host,
+        http2=plugin_config.anti_cpdaily_http2,
+        # 0 is the cpu count for the whole bot, not for each worker
+        captcha_workers=plugin_config.anti_cpdaily_captcha_workers or max(1, (os.cpu_count() or 1) // workers),
+        captcha_timeout=plugin_config.anti_cpdaily_captcha_timeout,
+        captcha_min_confidence=plugin_config.anti_cpdaily_captcha_min_confidence,
+        tenant_cache_ttl=plugin_config.anti_cpdaily_tenant_cache_ttl,
+        form_cache_ttl=plugin_config.anti_cpdaily_form_cache_ttl,
+        trace=plugin_config.anti_cpdaily_trace_on_failure,
+        trace_limit=plugin_config.anti_cpdaily_log_dump_limit,
+        cache_path=plugin_config.anti_cpdaily_cache_path,
+        journal_path=str(run_journal.path) if run_journal.enabled else None,
+        run_id=run_id
+    )
+
+
+async def _run_leased(users: List[UserConfig], run_id: str) -> List[UserResult]:
+    """take part in a run shared with other nodes, then wait for them"""
+    leases = LeaseTable(plugin_config.anti_cpdaily_lease_path, ttl=plugin_config.anti_cpdaily_lease_ttl)
+    shards = plugin_config.anti_cpdaily_shards
+    try:
+        await run_leased(
+            users, leases, run_id, shards, _worker_options(run_id),
+            by=plugin_config.anti_cpdaily_shard_by,
+            processes=max(1, plugin_config.anti_cpdaily_workers),
+            journal=run_journal if run_journal.enabled else None,
+            in_process=plugin_config.anti_cpdaily_workers == 0
+        )
+        deadline = datetime.now().timestamp() + leases.ttl
+        while await leases.remaining_async(run_id, shards) > 0 and datetime.now().timestamp() < deadline:
+            await asyncio.sleep(10)
+        remaining = await leases.remaining_async(run_id, shards)
+        if remaining > 0:
+            dispatcher.report_error('{} shard(s) of run {} not done by other nodes'.format(remaining, run_id))
+        stored = {result.username: result for result in await leases.results_async(run_id)}
+    finally:
+        leases.close()
+    # users of shards not done in time fail, so they are reported like the others
+    results = [
+        stored.get(user.username) or UserResult(
+            username=user.username, school_name=user.school_name, qq=user.qq,
+            error='shard not done by any node in time'
+        )
+        for user in users
+    ]
+    for result in results:
+        await _notify_user(result)
+    return results
+
+
+async def _run(users: List[UserConfig], run_id: str) -> List[UserResult]:
+    """process users in the bot process, in worker processes, or with other nodes"""
+    if plugin_config.anti_cpdaily_lease_path:
+        return await _run_leased(users, run_id)
+    if plugin_config.anti_cpdaily_workers > 0:
+        return await run_sharded(
+            users,
+            plugin_config.anti_cpdaily_workers,
+            _worker_options(run_id),
+            by=plugin_config.anti_cpdaily_shard_by,
+            journal=run_journal if run_journal.enabled else None,
+            on_result=_notify_user
+        )
+    return await run_users(
+        users,
+        concurrency=plugin_config.anti_cpdaily_concurrency,
+        school_concurrency=plugin_config.anti_cpdaily_school_concurrency,
+        form_concurrency=plugin_config.anti_cpdaily_form_concurrency,
+        page_size=plugin_config.anti_cpdaily_page_size,
+        start_jitter=plugin_config.anti_cpdaily_start_jitter,
+        journal=run_journal,
+        run_id=run_id,
+        on_result=_notify_user
+    )
+
+
 @exception_notification
-async def anti_cpdaily_check_routine():
-    # TODO: change strategy: add periodic jobs which can remove themselves after form finished when empty form detected
-    logger.info('start collecting users for `collection form`')
-    config_path = Path(plugin_config.anti_cpdaily_profile_path)
-    configs = os.listdir(config_path)
-    users = list()
-    for cfg in configs:
-        if cfg.endswith('config.json'):
-            with open(config_path / cfg, encoding='utf-8') as f:
-                data = json.load(f)
-            user_data = UserConfig(**data)
-            users.append(user_data)
+async def anti_cpdaily_check_routine(run_id: Optional[str] = None):
+    """process all users at once
+
+    Users already done in the run(by default the current cron slot) are skipped.
+    """
+    run_id = run_id or cron_run_id()
+    logger.info('start collecting users for `collection form`, run {}'.format(run_id))
+    await profile_registry.refresh_async()  # only changed profiles are parsed
+    users = profile_registry.users
     
     logger.info('collected user count: {}'.format(len(users)))
-    for current_user in users:
-        async with AsyncCpdailyUser(
-            username=current_user.username,
-            password=current_user.password,
-            school_name=current_user.school_name
-            ) as cpduser:
-
-            log_in = await cpduser.login()
-            if not log_in:
-                logger.error('login failed')
-                return
-            
-            collection_task = AsyncCollectionTask(user=cpduser)
-            await collection_task.fetch_form()
-            logger.info('processing {} collection(s) for user {}'.format(len(collection_task.form_list), current_user.username))
-            forms_status = list()
-            for form in collection_task.form_list:
-                if form.handled:  # ingore finished forms
-                    continue
-                await form.fetch_detail(root=cpduser.school_api.get('amp_root'), client=cpduser.client)
-                if form.fill_form(current_user.dict()):
-                    logger.success('form({}) filled'.format(form.subject))
-                    logger.info('try to submit collection({})'.format(form.subject))
-                    submission_status = await form.post_form(apis=cpduser.school_api, client=cpduser.client)
-                    logger.info(f'submission status: {submission_status}')
-                    text_status = 'OK' if submission_status else 'Failed'
-                    forms_status.append((form.subject, text_status))
-                else:
-                    logger.warning('cannot fill form({})'.format(form.subject))
-                    forms_status.append((form.subject, 'misbehave'))
-            
-        # send notification
-        if isinstance(current_user.qq, int) and len(forms_status) > 0:
-            logger.info('sending notification to {}'.format(current_user.qq))
-            result = '\n'.join(map(str, forms_status))
-            result = str(datetime.now()) + '\n表格收集填写状况：\n' + result
-            data = {
-                'user_id': current_user.qq,
-                'message': result
-            }
-            bot = nonebot.get_bot()
-            res = await bot.call_api('send_msg', **data)
-            logger.debug('notify result: {}'.format(res))
-    
+    results = await _run(users, run_id)
+    await _report_failures([result for result in results if not result.ok])
+
+    # worker processes keep their own stats and metrics, these are the bot process' ones
+    logger.info('connection pool stats: {}'.format(shared_transport.stats.as_dict()))
+    logger.info('rate limiter stats: {}'.format(rate_limiter.stats.as_dict()))
+    logger.info('request policy stats: {}'.format(request_policy.stats.as_dict()))
+    _export_metrics()
+    flush_all()
+    await dispatcher.flush()  # the run is over, no need to wait for more messages
     logger.info('operation finished')
 
 
+if plugin_config.anti_cpdaily_schedule_mode == 'cron':
+    scheduler.add_job(
+        anti_cpdaily_check_routine,
+        'cron',
+        hour='11,12,13,14',
+        minute=30,
+        id='anti_cpdaily_check_routine',
+        replace_existing=True
+    )
+
+
+def on_profiles_changed(func: Callable[[], Awaitable]) -> Callable[[], Awaitable]:
+    """register a coroutine function called when the profile watch finds changes"""
+    _profile_listeners.append(func)
+    return func
+
+
+async def anti_cpdaily_profile_watch():
+    """reload changed profiles in the background"""
+    added, changed, removed = await profile_registry.refresh_async()
+    if added or changed or removed:
+        for listener in _profile_listeners:
+            await listener()
+
+
+if plugin_config.anti_cpdaily_profile_watch_interval > 0:
+    scheduler.add_job(
+        anti_cpdaily_profile_watch,
+        'interval',
+        seconds=plugin_config.anti_cpdaily_profile_watch_interval,
+        id='anti_cpdaily_profile_watch',
+        replace_existing=True
+    )
+
+
 @scheduler.scheduled_job('interval', minutes=1, id='anti_cpdaily_launch_notice')
 @exception_notification
 async def anti_cpdaily_launch():
@@ -104,12 +253,9 @@ async def anti_cpdaily_launch():
     """
     logger.info('send launched notice to all superusers')
     scheduler.remove_job('anti_cpdaily_launch_notice')
-    current_time = str(datetime.now())
-    bot = nonebot.get_bot()
-    for user_id in bot.config.superusers:
-        data = {
-            'user_id': int(user_id),
-            'message': '{time}\nanti_cpdaily started'.format(time=current_time)
-        }
-        res = await bot.call_api('send_msg', **data)
-        logger.debug('notify to {} result: {}'.format(user_id, res))
+    dispatcher.send_superusers('{time}\nanti_cpdaily started'.format(time=str(datetime.now())))
+    # finish a run interrupted by the restart, the adaptive mode resumes by itself
+    run_id = resumable_run_id()
+    if run_id is not None and plugin_config.anti_cpdaily_schedule_mode == 'cron':
+        logger.info('resuming unfinished run {}'.format(run_id))
+        await anti_cpdaily_check_routine(run_id)
@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-from anti_cpdaily.example import generate_config, auto_submit_collections
+from anti_cpdaily.example import generate_config, bulk_generate_config, auto_submit_collections
 from loguru import logger
 
 if __name__ == "__main__":
@@ -8,6 +8,9 @@ if __name__ == "__main__":
     # to generate a configuration
     generate_config()
 
+    # to generate the configurations of many users(CSV or JSON lines credentials)
+    # bulk_generate_config('path/to/credentials.csv', output_path='path/to/profiles', concurrency=8)
+
     # to submit collections
     # auto_submit_collections(data_file='path/to/username.config.json')
 